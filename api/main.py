@@ -1,6 +1,7 @@
 from fastapi import APIRouter
-from api.routers import trajectories, social
+from api.routers import trajectories, social, signals
 
 api_router = APIRouter()
 api_router.include_router(trajectories.router, tags=['trajectories'])
-api_router.include_router(social.router, tags=['social'])
\ No newline at end of file
+api_router.include_router(social.router, tags=['social'])
+api_router.include_router(signals.router, tags=['signals'])
\ No newline at end of file
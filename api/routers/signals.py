@@ -0,0 +1,21 @@
+from fastapi import APIRouter
+from models.signal import SignalIngestRequest, SignalIngestResponse
+from crud.signal import ingest_signals as db_ingest_signals, get_signal_buffer_stats as db_get_signal_buffer_stats
+
+router = APIRouter()
+
+@router.post("/signals/ingest", response_model=SignalIngestResponse, status_code=202)
+async def ingest_signals(request: SignalIngestRequest):
+    """
+    Accept live location signals of a user. They are written to location_signal in the background
+    """
+    response = await db_ingest_signals(request)
+    return response
+
+@router.get("/signals/stats")
+async def get_signal_buffer_stats():
+    """
+    Pending rows and accepted, rejected, written and dropped counters of the signal buffer
+    """
+    response = await db_get_signal_buffer_stats()
+    return response
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, HTTPException
 from models.social import  SocialSimRequest, SocialSimResponse, SocialRatingResponse
-from process.socialalgo.supabase_client import get_matched_user_ids, get_ratings_for_users
+from process.socialalgo.supabase_client import get_matched_user_ids_async, get_ratings_for_users_async
 from crud.social import get_rating_sim as db_get_rating_sim
 
 
@@ -11,7 +11,7 @@ router = APIRouter()
 async def calculate_similarity(request: SocialSimRequest):
 
     # Step 1: Get matched user IDs
-    matched_user_ids = get_matched_user_ids(request.user_id)
+    matched_user_ids = await get_matched_user_ids_async(request.user_id)
     print(f"Matched user IDs: {matched_user_ids}")
 
     if not matched_user_ids:
@@ -19,7 +19,7 @@ async def calculate_similarity(request: SocialSimRequest):
 
     # Step 2: Get ratings for the matched users
     print("Pass this step 1")
-    ratings_data = get_ratings_for_users(matched_user_ids)
+    ratings_data = await get_ratings_for_users_async(matched_user_ids)
     print(f"Ratings data: {ratings_data}")
 
     if not ratings_data:
@@ -31,6 +31,6 @@ async def calculate_similarity(request: SocialSimRequest):
     # return {"matched_user_ids": matched_user_ids, "ratings": ratings_data}
 
 @router.post("/social/calculate_similarity", response_model=SocialRatingResponse)
-def calculate_similarity(request: SocialSimRequest):
-    response = db_get_rating_sim(request)
+async def calculate_similarity(request: SocialSimRequest):
+    response = await db_get_rating_sim(request)
     return response
@@ -1,8 +1,12 @@
 from fastapi import APIRouter, HTTPException
-from models.trajectory import (RequestMatch, RequestMatchResponse, RequestMatchLocation, RequestMatchLocationResponse
+from fastapi.responses import StreamingResponse
+from models.trajectory import (RequestMatch, RequestMatchResponse, RequestMatchBatch, RequestMatchLocation, RequestMatchLocationResponse
 , PolylineRequestList, PolylineResponse, RequestMatchResponseDetail, TripRequestResponse, TripRequest, TrajectoryCreateRequest, TrajectoryCreateResponse
-                               , TripRequestV2, TripRequestResponseV2)
+                               , TripRequestV2, TripRequestResponseV2, RequestCorridorMatch, RequestCorridorMatchResponse)
 from crud.trajectory import (match_trajectory_by_location, match_trajectory_by_user as db_match_trajectory_by_user
+, match_trajectory_by_users as db_match_trajectory_by_users, get_match_cache_stats as db_get_match_cache_stats, get_directions_cache_stats as db_get_directions_cache_stats
+, get_routing_stats as db_get_routing_stats
+, match_trajectory_by_corridor as db_match_trajectory_by_corridor
 , get_polyline_users as db_get_polyline_users, match_trajectory_by_user_detail as db_match_trajectory_by_user_detail
 , get_trip_info as db_get_trip_info
 , create_trajectory_by_id as db_create_trajectory
@@ -11,65 +15,104 @@ from crud.trajectory import (match_trajectory_by_location, match_trajectory_by_u
 router = APIRouter()
 
 @router.post("/match/location", response_model=RequestMatchLocationResponse)
-def match_trajectory(request: RequestMatchLocation):
+async def match_trajectory(request: RequestMatchLocation):
     """
     Match trajectories based on start and end location
     """
     # Implement your logic to match trajectories here
     # For now, let's return a dummy response
-    response = match_trajectory_by_location(request)
+    response = await match_trajectory_by_location(request)
     return response
 
 @router.post("/match/user", response_model=RequestMatchResponse)
-def match_trajectory_by_user(request: RequestMatch):
+async def match_trajectory_by_user(request: RequestMatch):
     """
     Match trajectories based on user id
     """
-    response = db_match_trajectory_by_user(request)
+    response = await db_match_trajectory_by_user(request)
+    return response
+
+@router.post("/match/users/batch")
+async def match_trajectory_by_users(request: RequestMatchBatch):
+    """
+    Match trajectories for many users at once. Streams one JSON object per line, shaped like the /match/user response
+    """
+    return StreamingResponse(db_match_trajectory_by_users(request), media_type="application/x-ndjson")
+
+@router.post("/match/corridor", response_model=RequestCorridorMatchResponse)
+async def match_trajectory_by_corridor(request: RequestCorridorMatch):
+    """
+    Match the drivers whose route passes within the radius of the user's start and end location, ranked by detour and time skew
+    """
+    response = await db_match_trajectory_by_corridor(request)
+    return response
+
+@router.get("/match/cache/stats")
+async def get_match_cache_stats():
+    """
+    Size and hit, miss, eviction and invalidation counters of the match search cache
+    """
+    response = await db_get_match_cache_stats()
+    return response
+
+@router.get("/directions/cache/stats")
+async def get_directions_cache_stats():
+    """
+    Size, hit rate and eviction counters of the memory and disk tiers of the directions cache
+    """
+    response = await db_get_directions_cache_stats()
+    return response
+
+@router.get("/directions/routing/stats")
+async def get_routing_stats():
+    """
+    Rate limit, deadline and hedging settings of the routing client, with its coalesced, throttled and hedged calls
+    """
+    response = await db_get_routing_stats()
     return response
 
 @router.post("/match/polyline", response_model=PolylineResponse)
-def get_polyline(request: PolylineRequestList):
+async def get_polyline(request: PolylineRequestList):
     """
     Get the polyline of the user based on the user idt:
     """
-    response = db_get_polyline_users(request)
+    response = await db_get_polyline_users(request)
     return response
 
 @router.post("/match/create_match")
-def match_with_user():
+async def match_with_user():
     pass
 
 
 @router.post("/match/user/detail", response_model=RequestMatchResponseDetail)
-def match_trajectory_by_user_detail(request: RequestMatch):
+async def match_trajectory_by_user_detail(request: RequestMatch):
     """
     Get the details of the matched users
     """
-    response = db_match_trajectory_by_user_detail(request)
+    response = await db_match_trajectory_by_user_detail(request)
     return response
 
 @router.post("/match/trip/info", response_model=TripRequestResponse)
-def get_trip_info(request: TripRequest):
+async def get_trip_info(request: TripRequest):
     """
     Get specific trip information based on driver, rider starting/ending location and time
     """
-    response = db_get_trip_info(request)
+    response = await db_get_trip_info(request)
     return response
 
 @router.post("/traj/create", response_model=TrajectoryCreateResponse)
-def create_trajectory_by_user_id(request: TrajectoryCreateRequest):
+async def create_trajectory_by_user_id(request: TrajectoryCreateRequest):
     """
     Create a new trajectory based on the user id. Only create if traj does not exist
     """
-    response = db_create_trajectory(request)
+    response = await db_create_trajectory(request)
     return response
 
 @router.post("/trip/info/v2", response_model=TripRequestResponseV2)
-def get_trip_info_v2(request: TripRequestV2):
+async def get_trip_info_v2(request: TripRequestV2):
     """
     Create a new trajectory based on the user id. Only create if traj does not exist
     """
-    response = db_get_trip_info_v2(request)
+    response = await db_get_trip_info_v2(request)
 
     return response
\ No newline at end of file
@@ -0,0 +1,20 @@
+from models.signal import SignalIngestRequest, SignalIngestResponse
+from process.trajectories.signal_buffer import location_signal_buffer
+from fastapi import HTTPException
+
+async def ingest_signals(request: SignalIngestRequest):
+    """
+    Queue the signals for the background writer of location_signal. Refused with a 503 while the buffer stays full.
+    """
+    rows = [(request.user_id, signal.time_stamp, signal.latitude, signal.longitude) for signal in request.signals]
+    try:
+        accepted = await location_signal_buffer.put(rows)
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not accepted:
+        raise HTTPException(status_code=503, detail="Signal buffer is full, retry later", headers={"Retry-After": "1"})
+
+    return SignalIngestResponse(user_id=request.user_id, accepted=len(rows), pending=location_signal_buffer.pending)
+
+async def get_signal_buffer_stats():
+    return location_signal_buffer.stats()
@@ -1,21 +1,34 @@
-from models.trajectory import (RequestMatchLocationResponse, RequestMatchLocation, RequestMatchResponse, RequestMatch, PolylineResponse,
+from models.trajectory import (RequestMatchLocationResponse, RequestMatchLocation, RequestMatchResponse, RequestMatch, RequestMatchBatch, PolylineResponse,
                                PolylineRequestList, PolylineItem, RequestMatchResponseDetail, UserMatchDetail, TripRequestResponse, TripRequest, TripItem,
-                               TrajectoryCreateRequest, TrajectoryCreateResponse, TripRequestV2, TripRequestResponseV2)
-from process.trajectories.matching_ver2 import search_potential_similar_trajectories, search_potential_similar_trajectories_by_user
-from process.trajectories.db_op import get_user_polyline, calculate_trajectory_by_id
-from process.trajectories.gmapfunction import get_route_info
-from crud.user import  check_user_exists, get_user_by_id, get_user_trip
+                               TrajectoryCreateRequest, TrajectoryCreateResponse, TripRequestV2, TripRequestResponseV2,
+                               RequestCorridorMatch, RequestCorridorMatchResponse, CorridorMatch)
+from process.trajectories.matching_ver2 import search_potential_similar_trajectories_async, search_potential_similar_trajectories_by_users
+from process.trajectories.db_op import get_users_polyline_async, get_users_trajectory_seconds_async, build_trajectory
+from process.trajectories.match_store import match_store
+from process.trajectories.match_cache import match_cache
+from process.trajectories.corridor import search_corridor_matches_by_user
+from process.trajectories.balltree import balltree_index
+from process.trajectories.trip_composer import compose_trip
+from process.trajectories.detour_rank import added_drive_times, rank_by_detour, DETOUR_TOP_N
+from process.trajectories.directions_cache import directions_cache
+from process.trajectories.routing_client import routing_client
+from crud.user import  check_user_exists, get_user_by_id, get_users_trip
 from fastapi import  HTTPException
+from fastapi.concurrency import run_in_threadpool
 from datetime import datetime, time, timedelta
-from database import Database
+from database_async import AsyncDatabase
 
-def match_trajectory_by_location(request: RequestMatchLocation):
+async def match_trajectory_by_location(request: RequestMatchLocation):
     # Implement your logic to match trajectories here
     # For now, let's return a dummy response
     # if not check_user_exists(request.user_id):
     #     raise HTTPException(status_code=404, detail="User not found")
-    df = search_potential_similar_trajectories(request.start_location[0], request.start_location[1], request.end_location[0], request.end_location[1], request.start_time, request.end_time, level =14, time_diff=20)
-    df = df[df["start_user_id"] != request.user_id]
+    if request.engine == "balltree":
+        df = await run_in_threadpool(balltree_index.search, request.start_location, request.end_location, request.start_time, request.end_time, request.radius, request.k, 20)
+    else:
+        df = await search_potential_similar_trajectories_async(request.start_location[0], request.start_location[1], request.end_location[0], request.end_location[1], request.start_time, request.end_time, level =14, time_diff=20)
+    if request.user_id is not None:
+        df = df[df["start_user_id"] != request.user_id]
     user_ids = df["start_user_id"].tolist()
 
     response = RequestMatchLocationResponse(
@@ -28,171 +41,231 @@ def match_trajectory_by_location(request: RequestMatchLocation):
     return response
 
 
-def match_trajectory_by_user(request: RequestMatch):
+async def get_stored_matches(user_id: int):
+    """
+    Matches of the user from the match store, computing and storing them first if the user is not in it yet.
+    :return: (list of (match_user_id, score, time_diff) best first, computed_at)
+    """
+    entry = await match_store.get_async(user_id)
+    if entry is None:
+        await run_in_threadpool(match_store.refresh_users, [user_id])
+        entry = match_store.get(user_id)
+    return entry
+
+
+async def match_trajectory_by_user(request: RequestMatch):
     # if not check_user_exists(request.user_id):
     #     raise HTTPException(status_code=404, detail="User not found")
-    df =  search_potential_similar_trajectories_by_user(request.user_id, level =14, time_diff=20)
-    print("Search potential similar trajectories by user completed")
-    df = df[df["start_user_id"] != request.user_id]
-    user_ids = df["start_user_id"].tolist()
+    matches, computed_at = await get_stored_matches(request.user_id)
 
     response = RequestMatchResponse(
         user_id=request.user_id,
-        matches=user_ids  # Dummy match IDs
+        matches=[match_user_id for match_user_id, _, _ in matches],
+        computed_at=computed_at
     )
     return response
 
-def get_polyline_users(request: PolylineRequestList):
+
+def match_trajectory_by_users(request: RequestMatchBatch):
+    """
+    Match many users in one pass. Yields one JSON line per user, shaped like the /match/user response,
+    so the response can be streamed with bounded memory. This is a plain generator: the search is blocking,
+    and StreamingResponse iterates it in the threadpool.
+    """
+    for user_id, df in search_potential_similar_trajectories_by_users(request.user_ids, level =14, time_diff=20):
+        df = df[df["start_user_id"] != user_id]
+        response = RequestMatchResponse(user_id=user_id, matches=df["start_user_id"].tolist())
+        yield response.model_dump_json() + "\n"
+
+
+async def match_trajectory_by_corridor(request: RequestCorridorMatch):
+    if not await check_user_exists(request.user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+
+    df = await run_in_threadpool(search_corridor_matches_by_user, request.user_id, request.radius, request.time_diff)
+    matches = [CorridorMatch(**row) for row in df[list(CorridorMatch.model_fields)].to_dict('records')]
+    return RequestCorridorMatchResponse(user_id=request.user_id, matches=matches)
+
+
+async def get_match_cache_stats():
+    return match_cache.stats()
+
+async def get_directions_cache_stats():
+    return directions_cache.stats()
+
+
+async def get_routing_stats():
+    return routing_client.stats()
+
+
+async def get_polyline_users(request: PolylineRequestList):
     # Initialize the response with an empty list for polyline
     response = PolylineResponse(
         user_ids=request.user_ids,
         polyline=[]  # Initialize with an empty list
     )
 
+    polylines = await get_users_polyline_async(request.user_ids)
     for user_id in request.user_ids:
+        poly = polylines[user_id]
         # if not check_user_exists(user_id):
         #     raise HTTPException(status_code=404, detail="User not found")
-        poly = get_user_polyline(user_id)
         response.polyline.append(PolylineItem(user_id=user_id, polyline=poly, start_time="00:00:00", end_time="00:00:00"))
 
     return response
 
 
-def match_trajectory_by_user_detail(request: RequestMatch):
+async def rank_matches_by_detour(user_id: int, matches):
+    """
+    Re-rank the first DETOUR_TOP_N stored matches by the drive time the user adds to each driver's commute, from
+    batched distance matrix requests and the duration of the drivers' trajectories. The matches are left in their
+    order if the routing fails.
+    :return: (matches, match_user_id -> (added seconds, pickup seconds) or None)
+    """
+    head, tail = matches[:DETOUR_TOP_N], matches[DETOUR_TOP_N:]
+    users = await get_users_trip([user_id] + [match_user_id for match_user_id, _, _ in head])
+    direct_seconds = await get_users_trajectory_seconds_async([match_user_id for match_user_id, _, _ in head])
+    rider = users.get(user_id)
+    drivers = {match_user_id: ((users[match_user_id][0], users[match_user_id][1]),
+                               (users[match_user_id][2], users[match_user_id][3]),
+                               direct_seconds.get(match_user_id))
+               for match_user_id, _, _ in head if match_user_id in users}
+    if rider is None or not drivers:
+        return matches, {}
+
+    try:
+        detours = await run_in_threadpool(added_drive_times, ((rider[0], rider[1]), (rider[2], rider[3])), drivers,
+                                          tomorrow_at(rider[4]) if rider[4] is not None else None)
+    except Exception as e:
+        print(f"The error '{e}' occurred while ranking the matches by detour.")
+        return matches, {}
+
+    by_id = {match[0]: match for match in head}
+    ranked = rank_by_detour([match_user_id for match_user_id, _, _ in head], detours)
+    return [by_id[match_user_id] for match_user_id in ranked] + tail, detours
+
+
+async def match_trajectory_by_user_detail(request: RequestMatch):
     user_match_details = []
     user_match = []
-    df =  search_potential_similar_trajectories_by_user(request.user_id, level =14, time_diff=20)
-    print("Search potential similar trajectories by user completed")
-    df = df[df["start_user_id"] != request.user_id]
+    matches, computed_at = await get_stored_matches(request.user_id)
+    matches, detours = await rank_matches_by_detour(request.user_id, matches)
+    polylines = await get_users_polyline_async([match_user_id for match_user_id, _, _ in matches])
 
-    for index, row in df.iterrows():
+    for match_user_id, score, time_diff in matches:
+        poly = polylines[match_user_id]
         name = "Something"
-        poly = get_user_polyline(row['start_user_id'])
+        detour = detours.get(match_user_id)
         user_match_detail = UserMatchDetail(
-            user_id=row['start_user_id'],
+            user_id=match_user_id,
             name=name,
             rating= 5,
-            time_diff=row['start_time_diff']+row['end_time_diff'],
-            distance_diff=row['score'],
+            time_diff=time_diff,
+            distance_diff=score,
+            detour=detour[0] if detour else None,
             polyline=poly
         )
         user_match_details.append(user_match_detail)
-        user_match.append((request.user_id, row['start_user_id'], int(row['score']), int(row['start_time_diff']+row['end_time_diff']), poly))
+        user_match.append((request.user_id, match_user_id, int(score), int(time_diff), poly))
 
-    add_custom_match(user_match)
+    await add_custom_match(user_match)
 
     response = RequestMatchResponseDetail(
         user_id=request.user_id,
-        matches=user_match_details  # Dummy match IDs
+        matches=user_match_details,  # Dummy match IDs
+        computed_at=computed_at
     )
     return response
 
 
-def get_trip_info(request: TripRequest):
-    trip_items = []
-    if isinstance(request.driver_start_time, datetime):
-        time_part = request.driver_start_time.time()
-    else:
-        time_part = request.driver_start_time
-
-    tomorrow_date = datetime.now().date() + timedelta(days=1)
-    tomorrow_datetime = datetime.combine(tomorrow_date, time_part)
-
-    pickup_distance,  pickup_time, pickup_polyline =  get_route_info(request.driver_start_location, request.rider_start_location, tomorrow_datetime)
-
-    cur_time = tomorrow_datetime + timedelta(seconds=pickup_time)
-    trip_items.append(TripItem(
-        start_location=request.driver_start_location,
-        end_location=request.rider_start_location,
-        start_time=request.driver_start_time,
-        end_time=cur_time.time(),
-        polyline=pickup_polyline,
-        distance=pickup_distance,
-        duration=pickup_time
-    ))
-
-
-    dropoff_distance, dropoff_time, dropoff_polyline = get_route_info(request.rider_start_location, request.rider_end_location, cur_time)
-
-    trip_items.append(TripItem(
-        start_location=request.rider_start_location,
-        end_location=request.rider_end_location,
-        start_time=cur_time.time(),
-        end_time=(cur_time + timedelta(seconds=dropoff_time)).time(),
-        polyline=dropoff_polyline,
-        distance=dropoff_distance,
-        duration=dropoff_time))
-
-    cur_time += timedelta(seconds=dropoff_time)
-
-    finish_distance, finish_time, finish_polyline = get_route_info(request.rider_end_location, request.driver_end_location, cur_time)
-    trip_items.append(TripItem(
-        start_location=request.rider_end_location,
-        end_location=request.driver_end_location,
-        start_time=cur_time.time(),
-        end_time=(cur_time + timedelta(seconds=finish_time)).time(),
-        polyline=finish_polyline,
-        distance=finish_distance,
-        duration=finish_time))
-    cur_time += timedelta(seconds=finish_time)
-
+def tomorrow_at(departure_time):
+    """Tomorrow at the time of day of a time or datetime."""
+    if isinstance(departure_time, datetime):
+        departure_time = departure_time.time()
+    return datetime.combine(datetime.now().date() + timedelta(days=1), departure_time)
 
 
+async def compose_trip_items(driver_start_location, rider_start_location, rider_end_location, driver_end_location,
+                             driver_start_time):
+    """
+    Pickup, drop-off and finish legs of a shared trip leaving tomorrow at the driver's start time, routed together
+    by compose_trip.
+    :return: (trip items, driver end time)
+    """
+    stops = [driver_start_location, rider_start_location, rider_end_location, driver_end_location]
+    legs, end_time = await compose_trip(stops, tomorrow_at(driver_start_time))
 
+    trip_items = []
+    for start_location, end_location, departure, distance, duration, polyline in legs:
+        trip_items.append(TripItem(
+            start_location=start_location,
+            end_location=end_location,
+            start_time=driver_start_time if not trip_items else departure.time(),
+            end_time=(departure + timedelta(seconds=duration)).time(),
+            polyline=polyline,
+            distance=distance,
+            duration=duration))
+    return trip_items, end_time
+
+
+async def get_trip_info(request: TripRequest):
+    trip_items, end_time = await compose_trip_items(request.driver_start_location, request.rider_start_location,
+                                                    request.rider_end_location, request.driver_end_location,
+                                                    request.driver_start_time)
 
     response = TripRequestResponse(
         **request.model_dump(),
-        driver_end_time=cur_time.time(),
+        driver_end_time=end_time.time(),
         trips=trip_items
     )
     return response
 
 
-def add_custom_match(custom_matches):
+async def add_custom_match(custom_matches):
     sql = """
     INSERT INTO custom_match_test (rider_id, driver_id, distance_diff, time_diff,polyline)  
     VALUES (%s, %s, %s, %s, %s)
     ON CONFLICT (rider_id, driver_id) DO NOTHING
     """
 
-    db = Database()
-    db.connect()
-    db.execute_many(sql, custom_matches)
-    db.close_connection()
+    async with AsyncDatabase() as db:
+        await db.execute_many(sql, custom_matches)
 
-def create_trajectory_by_id(request: TrajectoryCreateRequest):
-    if not check_user_exists(request.user_id):
+async def create_trajectory_by_id(request: TrajectoryCreateRequest):
+    if not await check_user_exists(request.user_id):
         raise HTTPException(status_code=404, detail="User not found")
 
-    res = get_traj_by_user(request.user_id)
-    if not res:
-        print("Populate trajectory by id {}".format(request.user_id))
-        calculate_trajectory_by_id(request.user_id)
-        print("Populate trajectory by id completed")
-        res = get_traj_by_user(request.user_id)
+    res = await get_traj_by_user(request.user_id)
+    if res:
+        return TrajectoryCreateResponse(user_id=request.user_id, traj_id=res[0][0])
 
+    print("Populate trajectory by id {}".format(request.user_id))
+    # Google Maps and the trajectory build are blocking, keep them off the event loop
+    traj_id = await run_in_threadpool(build_trajectory, request.user_id)
+    print("Populate trajectory by id completed")
+    try:
+        await run_in_threadpool(match_store.refresh_around, request.user_id, traj_id)
+    except Exception as e:
+        # The trajectory is committed, the next rebuild of the match store picks it up
+        print(f"The error '{e}' occurred while refreshing the match store.")
 
-    return TrajectoryCreateResponse(user_id=request.user_id, traj_id=res[0][0])
+    return TrajectoryCreateResponse(user_id=request.user_id, traj_id=traj_id)
 
-def get_traj_by_user(user_id: int):
-    db = Database()
-    db.connect()
+async def get_traj_by_user(user_id: int):
     sql = """
         select traj_id
         from trajectory
         where user_id = %s
         LIMIT 1
     """
-    res = db.fetch_all(sql, [user_id])
-    db.close_connection()
+    async with AsyncDatabase() as db:
+        res = await db.fetch_all(sql, [user_id])
     return res
 
 
-def get_trip_info_v2(request: TripRequestV2):
-    trip_items = []
-
-    driver_info = get_user_trip(request.driver_id)
-    rider_info = get_user_trip(request.rider_id)
+async def get_trip_info_v2(request: TripRequestV2):
+    users = await get_users_trip([request.driver_id, request.rider_id])
+    driver_info, rider_info = users.get(request.driver_id), users.get(request.rider_id)
     if not driver_info or not rider_info:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -202,53 +275,8 @@ def get_trip_info_v2(request: TripRequestV2):
     rider_end_location = (rider_info[2], rider_info[3])
     driver_start_time = driver_info[4]
 
-
-    if isinstance(driver_start_time, datetime):
-        time_part = driver_start_time.time()
-    else:
-        time_part =driver_start_time
-
-    tomorrow_date = datetime.now().date() + timedelta(days=1)
-    tomorrow_datetime = datetime.combine(tomorrow_date, time_part)
-
-    pickup_distance,  pickup_time, pickup_polyline =  get_route_info(driver_start_location, rider_start_location, tomorrow_datetime)
-
-    cur_time = tomorrow_datetime + timedelta(seconds=pickup_time)
-
-    trip_items.append(TripItem(
-        start_location=driver_start_location,
-        end_location=rider_start_location,
-        start_time=driver_start_time,
-        end_time=cur_time.time(),
-        polyline=pickup_polyline,
-        distance=pickup_distance,
-        duration=pickup_time
-    ))
-
-    dropoff_distance, dropoff_time, dropoff_polyline = get_route_info(rider_start_location, rider_end_location, cur_time)
-
-    trip_items.append(TripItem(
-        start_location=rider_start_location,
-        end_location=rider_end_location,
-        start_time=cur_time.time(),
-        end_time=(cur_time + timedelta(seconds=dropoff_time)).time(),
-        polyline=dropoff_polyline,
-        distance=dropoff_distance,
-        duration=dropoff_time))
-
-    cur_time += timedelta(seconds=dropoff_time)
-
-    finish_distance, finish_time, finish_polyline = get_route_info(rider_end_location, driver_end_location, cur_time)
-
-    trip_items.append(TripItem(
-        start_location=rider_end_location,
-        end_location=driver_end_location,
-        start_time=cur_time.time(),
-        end_time=(cur_time + timedelta(seconds=finish_time)).time(),
-        polyline=finish_polyline,
-        distance=finish_distance,
-        duration=finish_time))
-    cur_time += timedelta(seconds=finish_time)
+    trip_items, end_time = await compose_trip_items(driver_start_location, rider_start_location, rider_end_location,
+                                                    driver_end_location, driver_start_time)
 
     response = TripRequestResponseV2(
         **request.model_dump(),
@@ -257,16 +285,7 @@ def get_trip_info_v2(request: TripRequestV2):
         rider_start_location=rider_start_location,
         rider_end_location=rider_end_location,
         driver_start_time=driver_start_time,
-        driver_end_time=cur_time.time(),
+        driver_end_time=end_time.time(),
         trips=trip_items
     )
     return response
-
-
-
-
-
-
-
-
-
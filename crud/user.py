@@ -1,13 +1,13 @@
-from database import Database
+from database_async import AsyncDatabase
 from fastapi import HTTPException
-from db_manager import db  # Import db from db_manager.py
 
 # Function to get user by ID using a parameterized query
-def get_user_by_id(user_id: int):
+async def get_user_by_id(user_id: int):
     select_query = "SELECT * FROM public.users WHERE user_id = %s"
     
     # Use parameterized query to avoid SQL injection
-    user = db.fetch_all(select_query, (user_id,))
+    async with AsyncDatabase() as db:
+        user = await db.fetch_all(select_query, (user_id,))
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -15,11 +15,12 @@ def get_user_by_id(user_id: int):
     return user
 
 # Function to get user by email (if email exists in the table)
-def get_user_by_email(email: str):
+async def get_user_by_email(email: str):
     select_query = "SELECT * FROM public.users WHERE email = %s"
     
     # Use parameterized query to avoid SQL injection
-    user = db.fetch_all(select_query, (email,))
+    async with AsyncDatabase() as db:
+        user = await db.fetch_all(select_query, (email,))
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -27,22 +28,31 @@ def get_user_by_email(email: str):
     return user
 
 
-def check_user_exists(user_id: int) -> bool:
-    db.connect()
+async def check_user_exists(user_id: int) -> bool:
     select_query = "SELECT EXISTS(SELECT 1 FROM public.users WHERE user_id = %s)"
 
     # Use parameterized query to avoid SQL injection
-    result = db.fetch_all(select_query, (user_id,))
-    db.close_connection()
+    async with AsyncDatabase() as db:
+        result = await db.fetch_all(select_query, (user_id,))
     return result[0][0] if result else False
 
-def get_user_trip(user_id: int):
-    db.connect()
+async def get_user_trip(user_id: int):
     select_query = """
     SELECT home_latitude, home_longitude, work_latitude, work_longitude, departure_time
     FROM public.users
     WHERE user_id = %s
     """
-    result = db.fetch_one(select_query, (user_id,))
-    db.close_connection()
+    async with AsyncDatabase() as db:
+        result = await db.fetch_one(select_query, (user_id,))
     return result
+
+async def get_users_trip(user_ids):
+    """get_user_trip for several users in one query, as a dict keyed by user_id."""
+    select_query = """
+    SELECT user_id, home_latitude, home_longitude, work_latitude, work_longitude, departure_time
+    FROM public.users
+    WHERE user_id = ANY(%s)
+    """
+    async with AsyncDatabase() as db:
+        result = await db.fetch_all(select_query, (list(user_ids),))
+    return {row[0]: tuple(row[1:]) for row in result or []}
@@ -0,0 +1,159 @@
+from psycopg import OperationalError
+from psycopg.pq import TransactionStatus
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+import os
+import pandas as pd
+from database import read_config
+
+
+class AsyncDatabase:
+    """
+    Async counterpart of ``database.Database`` backed by a psycopg 3 ``AsyncConnectionPool``.
+
+    The queries use the same ``%s`` placeholders as the sync class, so SQL can be shared between both. Use it as an
+    async context manager so the connection always goes back to the pool::
+
+        async with AsyncDatabase() as db:
+            rows = await db.fetch_all("SELECT 1")
+    """
+    _pools = {}
+
+    def __init__(self, config_file='config.json'):
+        """Initialize the database connection parameters from config file."""
+        self.config_file = config_file
+        self.config = read_config(os.path.abspath(config_file))['database']
+        self.connection = None
+        # Pool the connection was checked out from, it goes back there even if the pools were closed meanwhile
+        self.pool = None
+
+    @classmethod
+    async def get_pool(cls, config_file='config.json'):
+        """Return the open pool for the given config file, creating it on first use."""
+        config_path = os.path.abspath(config_file)
+        pool = cls._pools.get(config_path)
+        if pool is None:
+            config = read_config(config_path)
+            pool_config = config.get('pool', {})
+            pool = AsyncConnectionPool(
+                kwargs=config['database'],
+                min_size=pool_config.get('minconn', 1),
+                max_size=pool_config.get('maxconn', 10),
+                max_lifetime=pool_config.get('max_lifetime', 1800),
+                timeout=pool_config.get('timeout', 30),
+                check=AsyncConnectionPool.check_connection,
+                open=False,
+            )
+            cls._pools[config_path] = pool
+        # Opening an already open pool is a no-op
+        await pool.open()
+        return pool
+
+    @classmethod
+    async def close_pools(cls):
+        """Close every pool. Called on application shutdown."""
+        pools, cls._pools = list(cls._pools.values()), {}
+        for pool in pools:
+            await pool.close()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.connection is not None:
+            await self.close_connection()
+        return False
+
+    async def connect(self):
+        """Check out a connection from the shared pool."""
+        if self.connection is not None:
+            return
+        try:
+            pool = await self.get_pool(self.config_file)
+            self.connection = await pool.getconn()
+            self.pool = pool
+        except (OperationalError, PoolTimeout) as e:
+            print(f"The error '{e}' occurred while connecting to the database.")
+            self.connection = None
+
+    async def execute_query(self, query, data=None):
+        """Execute a query on the database."""
+        if self.connection is None:
+            print("No database connection.")
+            return None
+
+        try:
+            async with self.connection.cursor() as cursor:
+                await cursor.execute(query, data)
+                await self.connection.commit()
+        except OperationalError as e:
+            print(f"The error '{e}' occurred while executing the query.")
+
+    async def fetch_all(self, query, data=None):
+        """Fetch all records from a SELECT query."""
+        if self.connection is None:
+            print("No database connection.")
+            return None
+
+        try:
+            async with self.connection.cursor() as cursor:
+                await cursor.execute(query, data)
+                return await cursor.fetchall()
+        except OperationalError as e:
+            print(f"The error '{e}' occurred while fetching data.")
+            return None
+
+    async def fetch_one(self, query, data=None):
+        """Fetch a single record from a SELECT query."""
+        if self.connection is None:
+            print("No database connection.")
+            return None
+
+        try:
+            async with self.connection.cursor() as cursor:
+                await cursor.execute(query, data)
+                return await cursor.fetchone()
+        except OperationalError as e:
+            print(f"The error '{e}' occurred while fetching data.")
+            return None
+
+    async def execute_many(self, query, data):
+        """Execute a bulk insert query on the database."""
+        if self.connection is None:
+            print("No database connection.")
+            return None
+
+        try:
+            async with self.connection.cursor() as cursor:
+                await cursor.executemany(query, data)
+                await self.connection.commit()
+        except OperationalError as e:
+            print(f"The error '{e}' occurred while executing the bulk insert.")
+
+    async def query_df(self, query, data=None):
+        """Execute a query and return the result as a Pandas DataFrame."""
+        if self.connection is None:
+            print("No database connection.")
+            return None
+
+        try:
+            async with self.connection.cursor() as cursor:
+                await cursor.execute(query, data)
+                rows = await cursor.fetchall()
+                columns = [column.name for column in cursor.description]
+            return pd.DataFrame(rows, columns=columns)
+        except OperationalError as e:
+            print(f"The error '{e}' occurred while fetching data.")
+            return None
+
+    async def close_connection(self):
+        """Return the connection to the pool."""
+        if self.connection:
+            # End the transaction opened by reads so the pool does not have to warn about it
+            if self.connection.info.transaction_status == TransactionStatus.INTRANS:
+                await self.connection.rollback()
+            await self.pool.putconn(self.connection)
+            self.connection = None
+            self.pool = None
+        else:
+            print("No connection to close.")
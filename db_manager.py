@@ -1,12 +1,20 @@
 from database import Database
+from database_async import AsyncDatabase
 
-# Create the database instance
-db = Database(config_file='./config.json')
+CONFIG_FILE = './config.json'
 
-# Function to connect to the database
+# Function to open the shared connection pool
 def connect_db():
-    db.connect()
+    Database.get_pool(CONFIG_FILE).open()
 
-# Function to close the database connection
+# Function to close the connection pool
 def close_db():
-    db.close_connection()
+    Database.close_pools()
+
+# Function to open the async connection pool used by the API routes
+async def connect_async_db():
+    await AsyncDatabase.get_pool(CONFIG_FILE)
+
+# Function to close the async connection pool
+async def close_async_db():
+    await AsyncDatabase.close_pools()
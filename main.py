@@ -1,28 +1,103 @@
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Request, status
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from database import Database
+from database_async import AsyncDatabase
+from fastapi.concurrency import run_in_threadpool
 from contextlib import asynccontextmanager
+import asyncio
 from api.main import api_router
 from crud.user import get_user_by_id, get_user_by_email 
-from db_manager import connect_db, close_db  # Import database functions from db_manager
+from db_manager import connect_db, close_db, connect_async_db, close_async_db  # Import database functions from db_manager
 from process.address_validation import validate_address  # Import the validate_address function
+from process.trajectories.link_index import link_index
+from process.trajectories.shard_pool import shard_pool
+from process.trajectories.match_store import match_store
+from process.trajectories.match_cache import match_cache
+from process.trajectories.minhash import minhash_lsh
+from process.trajectories.balltree import balltree_index
+from process.trajectories.routing_client import RoutingTimeout
+from process.trajectories.pyramid import check_link_pyramid
+from process.trajectories.signal_buffer import location_signal_buffer
 
-# Create an instance of the Database class
-db = Database(config_file='./config.json')
+# Seconds between two pulls of the links created by other workers into the in-memory link index
+LINK_INDEX_REFRESH_INTERVAL = 60
+# Seconds between two full rebuilds of the precomputed matches
+MATCH_STORE_REBUILD_INTERVAL = 3600
+# Seconds between two reloads of the BallTree index, once a balltree search loaded it
+BALLTREE_RELOAD_INTERVAL = 300
+
+async def refresh_link_index():
+    while True:
+        await asyncio.sleep(LINK_INDEX_REFRESH_INTERVAL)
+        try:
+            new_links = await run_in_threadpool(shard_pool.refresh if shard_pool.started else link_index.refresh)
+            # Links written by other workers make the cached searches around them stale
+            if new_links is not None and not new_links.empty:
+                match_cache.invalidate_links(new_links['quadkey'].tolist())
+        except Exception as e:
+            print(f"The error '{e}' occurred while refreshing the link index.")
+
+async def reload_balltree_index():
+    while True:
+        await asyncio.sleep(BALLTREE_RELOAD_INTERVAL)
+        try:
+            await run_in_threadpool(balltree_index.reload)
+        except Exception as e:
+            print(f"The error '{e}' occurred while reloading the BallTree index.")
+
+async def rebuild_match_store():
+    # The stored matches are served from the start, only an empty store is rebuilt right away
+    if len(match_store):
+        await asyncio.sleep(MATCH_STORE_REBUILD_INTERVAL)
+    while True:
+        try:
+            # Skipped when another worker rebuilt the store within the interval
+            await run_in_threadpool(match_store.rebuild, MATCH_STORE_REBUILD_INTERVAL)
+        except Exception as e:
+            print(f"The error '{e}' occurred while rebuilding the match store.")
+        await asyncio.sleep(MATCH_STORE_REBUILD_INTERVAL)
 
 # Lifespan context manager
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Start up task: Connect to the database
+    # Start up task: Open the database connection pools
     connect_db()
+    await connect_async_db()
+    # The coarse quadkey columns of the links are added by python -m process.trajectories.pyramid
+    await run_in_threadpool(check_link_pyramid)
+    # Create the MinHash signature tables the trajectory builds write to
+    await run_in_threadpool(minhash_lsh.ensure_tables)
+    # Load the links used by matching into memory, split across worker processes when matching.shards is set
+    await run_in_threadpool(shard_pool.start)
+    if not shard_pool.started:
+        await run_in_threadpool(link_index.load)
+    refresh_task = asyncio.create_task(refresh_link_index())
+    balltree_task = asyncio.create_task(reload_balltree_index())
+    # Serve the stored matches right away, then rebuild them in the background
+    await run_in_threadpool(match_store.load)
+    rebuild_task = asyncio.create_task(rebuild_match_store())
+    # Write the ingested location signals in the background
+    location_signal_buffer.start()
     yield
-    # Shutdown task: Close the database connection
+    # Write the signals still buffered before the pools are closed
+    await location_signal_buffer.stop()
+    # Shutdown task: Close the database connection pools
+    refresh_task.cancel()
+    balltree_task.cancel()
+    rebuild_task.cancel()
+    shard_pool.stop()
+    await close_async_db()
     close_db()
 
 # FastAPI app with lifespan context manager
 app = FastAPI(lifespan=lifespan)
 app.include_router(api_router)
 
+# A routing call that timed out or found no rate limiter slot is worth retrying shortly, on any route
+@app.exception_handler(RoutingTimeout)
+async def routing_timeout_handler(request: Request, exc: RoutingTimeout):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
 # Pydantic model to define the structure of incoming POST request for user by email
 class GetUserByEmail(BaseModel):
     email: str
@@ -37,19 +112,20 @@ def root():
 
 # Test database connection endpoint
 @app.get("/test-db-connection")
-def test_db_connection():
+async def test_db_connection():
     try:
         # Test the connection by running a simple query
-        db.execute_query("SELECT 1")
+        async with AsyncDatabase() as db:
+            await db.execute_query("SELECT 1")
         return {"message": "Database connection successful"}
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
 # Endpoint to get user by ID
 @app.get("/user/{user_id}")
-def get_user(user_id: int):
+async def get_user(user_id: int):
     try:
-        user = get_user_by_id(user_id)
+        user = await get_user_by_id(user_id)
         print  # Call the imported function
         return {"user": user}
     except Exception as e:
@@ -57,9 +133,9 @@ def get_user(user_id: int):
 
 # Endpoint to get user by email (calls the function from crud/user.py)
 @app.post("/user/email")
-def get_user_by_email_endpoint(request: GetUserByEmail):
+async def get_user_by_email_endpoint(request: GetUserByEmail):
     try:
-        user = get_user_by_email(request.email)  # Call the imported function
+        user = await get_user_by_email(request.email)  # Call the imported function
         return {"user": user}
     except Exception as e:
         raise HTTPException(status_code=404, detail="User not found")
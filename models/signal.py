@@ -0,0 +1,17 @@
+from pydantic import BaseModel, Field
+from typing import List
+from datetime import datetime
+
+class LocationSignal(BaseModel):
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
+    time_stamp: datetime
+
+class SignalIngestRequest(BaseModel):
+    user_id: int
+    signals: List[LocationSignal] = Field(default_factory=list)
+
+class SignalIngestResponse(BaseModel):
+    user_id: int
+    accepted: int
+    pending: int
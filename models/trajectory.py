@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field
-from typing import Tuple, List, Optional, Any, Union
+from pydantic import BaseModel, Field, model_validator
+from typing import Tuple, List, Optional, Any, Union, Literal
 from datetime import datetime, time
 
 class RequestMatchLocationBase(BaseModel):
@@ -10,7 +10,18 @@ class RequestMatchLocationBase(BaseModel):
 
 
 class RequestMatchLocation(RequestMatchLocationBase):
-    pass
+    user_id: Optional[int] = None
+    # quadkey scans the links around both locations, balltree searches the trajectories' start and end points
+    engine: Literal["quadkey", "balltree"] = "quadkey"
+    # Only used by the balltree engine: metres around each location and the nearest trajectories kept per location
+    radius: Optional[float] = 1000
+    k: Optional[int] = None
+
+    @model_validator(mode="after")
+    def check_radius_or_k(self):
+        if self.engine == "balltree" and self.radius is None and self.k is None:
+            raise ValueError("The balltree engine needs a radius or k")
+        return self
 
 class RequestMatchLocationResponse(BaseModel):
     start_location: Tuple[float, float]
@@ -28,6 +39,26 @@ class RequestMatch(RequestMatchBase):
 
 class RequestMatchResponse(RequestMatchBase):
     matches: List[int]
+    computed_at: Optional[datetime] = None
+
+class RequestMatchBatch(BaseModel):
+    user_ids: List[int]
+
+class RequestCorridorMatch(RequestMatchBase):
+    radius: float = 500
+    time_diff: int = 20
+
+class CorridorMatch(BaseModel):
+    user_id: int
+    traj_id: int
+    pickup_distance: float
+    dropoff_distance: float
+    detour: float
+    time_skew: float
+    score: float
+
+class RequestCorridorMatchResponse(RequestMatchBase):
+    matches: List[CorridorMatch] = Field(default_factory=list)
 
 
 class PolylineRequestListBase(BaseModel):
@@ -51,10 +82,13 @@ class UserMatchDetail(BaseModel):
     rating: int
     time_diff: float
     distance_diff: float
+    # Seconds of drive time the user adds to the driver's commute, when it could be routed
+    detour: Optional[float] = None
     polyline: str | None
 
 class RequestMatchResponseDetail(RequestMatchBase):
     matches: List[UserMatchDetail] = Field(default_factory=list)
+    computed_at: Optional[datetime] = None
 
 class TripItem(BaseModel):
     start_location: Union[str, Tuple[float, float]]
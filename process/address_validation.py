@@ -2,7 +2,7 @@ import numpy as np
 import pandas as pd
 from sklearn.cluster import DBSCAN
 from geopy.distance import great_circle
-from db_manager import db  # Use db instance to interact with the database
+from database import Database
 from fastapi import HTTPException, status
 
 
@@ -66,7 +66,8 @@ def validate_address(user_id):
 
     # Query the database for coordinates data
     select_query = "SELECT latitude, longitude, time_stamp FROM public.location_signal WHERE user_id = %s"
-    coordinates_df = pd.DataFrame(db.fetch_all(select_query, (user_id,)), columns=['latitude', 'longitude', 'timestamp'])
+    with Database() as db:
+        coordinates_df = pd.DataFrame(db.fetch_all(select_query, (user_id,)), columns=['latitude', 'longitude', 'timestamp'])
 
     # If there's no data for this user, return HTTP 404
     if coordinates_df.empty:
@@ -74,7 +75,8 @@ def validate_address(user_id):
 
     # Query actual home and work coordinates from the database
     actual_coords_query = "SELECT home_latitude, home_longitude, work_latitude, work_longitude FROM public.users WHERE user_id = %s"
-    actual_home_work_coords = db.fetch_all(actual_coords_query, (user_id,))
+    with Database() as db:
+        actual_home_work_coords = db.fetch_all(actual_coords_query, (user_id,))
 
     if not actual_home_work_coords:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No actual home or work locations found for user {user_id}")
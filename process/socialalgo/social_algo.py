@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
 from process.socialalgo.supabase_client import get_matched_user_ids, get_ratings_for_users, get_ratings_for_logged_in_user  # Import the required functions
+from process.socialalgo.supabase_client import get_matched_user_ids_async, get_ratings_for_users_async, get_ratings_for_logged_in_user_async
 
 # Function to calculate cosine similarity
 def cosine_similarity(vec1, vec2):
@@ -22,7 +23,23 @@ def calculate_social_similarity(user_id):
     
     # Step 3: Get the ratings for the logged-in user
     user_rating_data = get_ratings_for_logged_in_user(user_id)
-    
+
+    return rank_by_social_similarity(user_id, ratings_data, user_rating_data)
+
+# Async version of calculate_social_similarity used by the API routes
+async def calculate_social_similarity_async(user_id):
+    matched_user_ids = await get_matched_user_ids_async(user_id)
+
+    if not matched_user_ids:
+        raise Exception("No matched users found.")
+
+    ratings_data = await get_ratings_for_users_async(matched_user_ids)
+    user_rating_data = await get_ratings_for_logged_in_user_async(user_id)
+
+    return rank_by_social_similarity(user_id, ratings_data, user_rating_data)
+
+# Rank the matched users by the cosine similarity of their ratings with the logged-in user's ratings
+def rank_by_social_similarity(user_id, ratings_data, user_rating_data):
     # Convert the ratings data into DataFrames for easier manipulation
     df_matched_users = pd.DataFrame(ratings_data)
     
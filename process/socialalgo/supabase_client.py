@@ -1,15 +1,37 @@
 from database import Database
+from database_async import AsyncDatabase
 
-# Query Supabase to get user data based on user_id
-def get_user_data(user_id):
-    db = Database()
-    db.connect()
-    select_query = """SELECT home_latitude, home_longitude, work_latitude, work_longitude, departure_time 
-    FROM public.users 
+USER_DATA_SQL = """SELECT home_latitude, home_longitude, work_latitude, work_longitude, departure_time
+    FROM public.users
     WHERE user_id = %s"""
 
-    res = db.fetch_one(select_query, (user_id,))
-    db.close_connection()
+MATCHED_USER_IDS_SQL = """
+    SELECT rider_id
+    FROM public.custom_match_test
+    WHERE driver_id = %s
+
+    UNION
+
+    SELECT driver_id
+    FROM public.custom_match_test
+    WHERE rider_id = %s
+    """
+
+# Matched against an array: psycopg 3 does not expand tuples for IN
+USERS_RATINGS_SQL = """
+    SELECT chattiness, safety, punctuality, friendliness, comfortability, user_id
+    FROM public.ratings
+    WHERE user_id = ANY(%s)"""
+
+USER_RATINGS_SQL = """
+    SELECT chattiness, safety, punctuality, friendliness, comfortability, user_id
+    FROM public.ratings
+    WHERE user_id = %s"""
+
+# Query Supabase to get user data based on user_id
+def get_user_data(user_id):
+    with Database() as db:
+        res = db.fetch_one(USER_DATA_SQL, (user_id,))
     print("get_user_data()")
     if not res:
         raise Exception(f"User with id {user_id} not found.")
@@ -17,21 +39,8 @@ def get_user_data(user_id):
 
 # Query Supabase to get matched user IDs for the logged-in user
 def get_matched_user_ids(user_id):
-    db = Database()
-    db.connect()
-    select_query_driver = """
-    SELECT rider_id 
-    FROM public.custom_match_test 
-    WHERE driver_id = %s
-    
-    UNION 
-    
-    SELECT driver_id 
-    FROM public.custom_match_test 
-    WHERE rider_id = %s
-    """
-    res = db.fetch_all(select_query_driver, (user_id, user_id))
-    db.close_connection()
+    with Database() as db:
+        res = db.fetch_all(MATCHED_USER_IDS_SQL, (user_id, user_id))
     print("get_matched_user_ids()")
     if not res:
         raise Exception(f"Match for user_id {user_id} not found.")
@@ -40,15 +49,8 @@ def get_matched_user_ids(user_id):
 
 # Query Supabase to get ratings data for matched user IDs
 def get_ratings_for_users(user_ids):
-    db = Database()
-    db.connect()
-    select_query = """
-    SELECT chattiness, safety, punctuality, friendliness, comfortability, user_id 
-    FROM public.ratings 
-    WHERE user_id IN %s"""
-    user_ids = tuple(user_ids)
-    res = db.fetch_all(select_query, (user_ids,))
-    db.close_connection()
+    with Database() as db:
+        res = db.fetch_all(USERS_RATINGS_SQL, (list(user_ids),))
     print("get_ratings_for_users")
     if not res:
         raise Exception("No ratings found for the matched users.")
@@ -57,15 +59,35 @@ def get_ratings_for_users(user_ids):
 
 # New Function: Query Supabase to get ratings for the logged-in user
 def get_ratings_for_logged_in_user(user_id):
-    db = Database()
-    db.connect()
-    select_query = """
-    SELECT chattiness, safety, punctuality, friendliness, comfortability, user_id 
-    FROM public.ratings 
-    WHERE user_id = %s"""
-    res = db.fetch_one(select_query, (user_id,))
-    db.close_connection()
+    with Database() as db:
+        res = db.fetch_one(USER_RATINGS_SQL, (user_id,))
     print("get_ratings_for_logged_in_user()")
     if not res:
         raise Exception(f"No ratings found for user with id {user_id}.")
     return res
+
+
+# Async versions used by the API routes
+async def get_matched_user_ids_async(user_id):
+    async with AsyncDatabase() as db:
+        res = await db.fetch_all(MATCHED_USER_IDS_SQL, (user_id, user_id))
+    if not res:
+        raise Exception(f"Match for user_id {user_id} not found.")
+
+    return [row[0] for row in res]
+
+
+async def get_ratings_for_users_async(user_ids):
+    async with AsyncDatabase() as db:
+        res = await db.fetch_all(USERS_RATINGS_SQL, (list(user_ids),))
+    if not res:
+        raise Exception("No ratings found for the matched users.")
+    return res
+
+
+async def get_ratings_for_logged_in_user_async(user_id):
+    async with AsyncDatabase() as db:
+        res = await db.fetch_one(USER_RATINGS_SQL, (user_id,))
+    if not res:
+        raise Exception(f"No ratings found for user with id {user_id}.")
+    return res
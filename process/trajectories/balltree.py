@@ -0,0 +1,293 @@
+"""
+Origin/destination matching on BallTree indexes of the trajectories' start and end points, an alternative to the
+quadkey cell scans of matching_ver2.
+
+Benchmark it against the quadkey engine on the current database with
+
+    python -m process.trajectories.balltree --queries 200 --radius 1000 --time-diff 20
+"""
+from database import Database
+from process.trajectories.link_index import link_index, to_time
+from process.trajectories.matching_ver2 import time_window, search_adjacent_quadkeys, merge_start_end_links
+from process.trajectories.support_func import time_to_microseconds, time_diff_seconds_np, haversine_distance_np
+from sklearn.neighbors import BallTree
+import argparse
+import threading
+import time as timer
+import numpy as np
+import pandas as pd
+
+
+# Minutes of the departure time buckets the trees are partitioned in
+BUCKET_MINUTES = 30
+# Metres, the default search radius around each endpoint
+RADIUS = 1000
+# Same earth radius as haversine_distance, the trees work in radians
+EARTH_RADIUS = 6378137.0
+
+MATCH_COLUMNS = ['start_user_id', 'start_traj_id', 'start_distance', 'start_time_diff', 'start_ts_ini',
+                 'end_user_id', 'end_traj_id', 'end_distance', 'end_time_diff', 'end_ts_ini']
+
+TRAJECTORY_ENDPOINTS_SQL = """
+    SELECT DISTINCT ON (t.traj_id) t.traj_id
+         , t.user_id
+         , ini.latitude AS start_lat
+         , ini.longitude AS start_lon
+         , "end".latitude AS end_lat
+         , "end".longitude AS end_lon
+         , CAST(ini.time_stamp AS time) AS start_time
+         , CAST("end".time_stamp AS time) AS end_time
+         , (extract(epoch from CAST(ini.time_stamp AS time)) * 1000000)::bigint AS start_us
+         , (extract(epoch from CAST("end".time_stamp AS time)) * 1000000)::bigint AS end_us
+        FROM trajectory t
+        INNER JOIN custom_signal ini
+            ON t.ts_ini = CAST(ini.time_stamp AS time)
+            AND t.user_id = ini.user_id
+        INNER JOIN custom_signal "end"
+            ON t.ts_end = CAST("end".time_stamp AS time)
+            AND t.user_id = "end".user_id
+        ORDER BY t.traj_id
+    """
+
+
+class BallTreeIndex:
+    """
+    Haversine BallTrees over the start and the end point of every trajectory, partitioned in departure time buckets of
+    BUCKET_MINUTES. A query only visits the buckets overlapping its departure window, runs a radius or k nearest query
+    on both trees of each and intersects the two sides by traj_id.
+
+    The index is loaded on first use and then reloaded in the background by the app, see reload, so new trajectories
+    are picked up. Readers use the buckets they started with; a reload builds new ones and swaps them in.
+    """
+
+    def __init__(self, bucket_minutes=BUCKET_MINUTES):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.bucket_us = bucket_minutes * 60 * 1_000_000
+        self.loaded_at = None
+
+    def __len__(self):
+        return sum(len(rows) for rows, _, _ in self._buckets.values())
+
+    def load(self):
+        """Load the endpoints of every trajectory and rebuild the trees."""
+        with Database() as db:
+            df = db.query_df(TRAJECTORY_ENDPOINTS_SQL)
+        if df is None:
+            return
+        buckets = self.build(df)
+        self._buckets = buckets
+        self.loaded_at = timer.monotonic()
+        print("BallTree index loaded with {} trajectories in {} buckets".format(len(df), len(buckets)))
+
+    def ensure_loaded(self):
+        if self.loaded_at is not None:
+            return
+        with self._lock:
+            if self.loaded_at is None:
+                self.load()
+
+    def reload(self):
+        """Reload the index if a query loaded it, queries keep using the previous trees meanwhile."""
+        if self.loaded_at is None:
+            return
+        with self._lock:
+            self.load()
+
+    def build(self, df):
+        """bucket -> (rows, start tree, end tree), the trees holding the rows in the same order."""
+        df = df.copy()
+        df['start_time'] = df['start_time'].map(to_time)
+        df['end_time'] = df['end_time'].map(to_time)
+        df['start_us'] = df['start_us'].astype(np.int64)
+        df['end_us'] = df['end_us'].astype(np.int64)
+
+        buckets = {}
+        for bucket, rows in df.groupby(df['start_us'] // self.bucket_us):
+            rows = rows.reset_index(drop=True)
+            start_tree = BallTree(np.radians(rows[['start_lat', 'start_lon']].to_numpy(dtype=np.float64)),
+                                  metric='haversine')
+            end_tree = BallTree(np.radians(rows[['end_lat', 'end_lon']].to_numpy(dtype=np.float64)),
+                                metric='haversine')
+            buckets[int(bucket)] = (rows, start_tree, end_tree)
+        return buckets
+
+    def trajectories(self):
+        """Every indexed trajectory with its endpoints, start_us and end_us."""
+        frames = [rows for rows, _, _ in self._buckets.values()]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    @staticmethod
+    def neighbours(tree, location, eligible, radius=None, k=None):
+        """
+        Positions and distances in metres of the eligible points of a tree within radius of the location, or of its
+        k nearest eligible points when k is given, still limited to radius unless it is None.
+        """
+        point = np.radians([location])
+        if k is None:
+            positions, distances = tree.query_radius(point, r=radius / EARTH_RADIUS, return_distance=True)
+        else:
+            # Ask for enough neighbours that k of them are left once the points out of the time windows are dropped
+            count = min(len(eligible), k + int((~eligible).sum()))
+            distances, positions = tree.query(point, k=count)
+        positions, distances = positions[0], distances[0] * EARTH_RADIUS
+        keep = eligible[positions]
+        if k is not None and radius is not None:
+            keep &= distances <= radius
+        return positions[keep], distances[keep]
+
+    def search(self, start_location, end_location, start_time, end_time, radius=RADIUS, k=None, time_diff: int = 10):
+        """
+        Trajectories starting near start_location within time_diff minutes of start_time and ending near end_location
+        within time_diff minutes of end_time.
+        :param start_location: (latitude, longitude)
+        :param end_location: (latitude, longitude)
+        :param start_time:
+        :param end_time:
+        :param radius: metres around each endpoint, None for no limit with k
+        :param k: when given, keep the k nearest trajectories of each endpoint before intersecting them
+        :param time_diff: minutes
+        :return: DataFrame with MATCH_COLUMNS, the same columns as merge_start_end_links without the link ids,
+                 closest first. The distances are those between the endpoints.
+        """
+        if radius is None and k is None:
+            raise ValueError("A radius or k is required")
+        self.ensure_loaded()
+        start_time, end_time = to_time(start_time), to_time(end_time)
+        min_start, max_start = (time_to_microseconds(t) for t in time_window(start_time, time_diff))
+        min_end, max_end = (time_to_microseconds(t) for t in time_window(end_time, time_diff))
+        # A window wrapping around midnight never matches, like in the quadkey search
+        if min_start > max_start or min_end > max_end:
+            return pd.DataFrame(columns=MATCH_COLUMNS)
+
+        buckets = self._buckets
+        starts, ends = [], []
+        for bucket in range(min_start // self.bucket_us, max_start // self.bucket_us + 1):
+            if bucket not in buckets:
+                continue
+            rows, start_tree, end_tree = buckets[bucket]
+            start_us, end_us = rows['start_us'].to_numpy(), rows['end_us'].to_numpy()
+            eligible = ((start_us >= min_start) & (start_us <= max_start) & (end_us >= min_end) & (end_us <= max_end)
+                        & (start_us < end_us))
+            if not eligible.any():
+                continue
+            for tree, location, found in ((start_tree, start_location, starts), (end_tree, end_location, ends)):
+                positions, distances = self.neighbours(tree, location, eligible, radius, k)
+                found.append(rows.iloc[positions][['traj_id', 'user_id', 'start_time', 'end_time', 'start_us',
+                                                   'end_us']].assign(distance=distances))
+        if not starts:
+            return pd.DataFrame(columns=MATCH_COLUMNS)
+
+        df_start, df_end = pd.concat(starts, ignore_index=True), pd.concat(ends, ignore_index=True)
+        if k is not None:
+            df_start = df_start.nsmallest(k, 'distance')
+            df_end = df_end.nsmallest(k, 'distance')
+        df = df_start.merge(df_end[['traj_id', 'distance']], on='traj_id', suffixes=('_start', '_end'))
+        if df.empty:
+            return pd.DataFrame(columns=MATCH_COLUMNS)
+
+        result = pd.DataFrame({
+            'start_user_id': df['user_id'].to_numpy(),
+            'start_traj_id': df['traj_id'].to_numpy(),
+            'start_distance': df['distance_start'].to_numpy(),
+            'start_time_diff': time_diff_seconds_np(df['start_us'].to_numpy(), start_time),
+            'start_ts_ini': df['start_time'].to_numpy(),
+            'end_user_id': df['user_id'].to_numpy(),
+            'end_traj_id': df['traj_id'].to_numpy(),
+            'end_distance': df['distance_end'].to_numpy(),
+            'end_time_diff': time_diff_seconds_np(df['end_us'].to_numpy(), end_time),
+            'end_ts_ini': df['end_time'].to_numpy(),
+        })
+        order = np.lexsort((result['start_traj_id'].to_numpy(),
+                            result['start_distance'].to_numpy() + result['end_distance'].to_numpy()))
+        return result.iloc[order].reset_index(drop=True)
+
+
+balltree_index = BallTreeIndex()
+
+
+def exact_matches(trajectories, start_location, end_location, start_time, end_time, radius, time_diff):
+    """Brute force version of BallTreeIndex.search with a radius, the reference of the benchmark."""
+    min_start, max_start = (time_to_microseconds(t) for t in time_window(start_time, time_diff))
+    min_end, max_end = (time_to_microseconds(t) for t in time_window(end_time, time_diff))
+    start_us, end_us = trajectories['start_us'].to_numpy(), trajectories['end_us'].to_numpy()
+    mask = ((start_us >= min_start) & (start_us <= max_start) & (end_us >= min_end) & (end_us <= max_end)
+            & (start_us < end_us))
+    mask &= haversine_distance_np(start_location, trajectories['start_lat'], trajectories['start_lon']) <= radius
+    mask &= haversine_distance_np(end_location, trajectories['end_lat'], trajectories['end_lon']) <= radius
+    return set(trajectories.loc[mask, 'traj_id'].tolist())
+
+
+def quadkey_matches(start_location, end_location, start_time, end_time, level, time_diff):
+    """Uncached quadkey engine search, as in search_potential_similar_trajectories."""
+    df_start = search_adjacent_quadkeys(start_location, start_time, level, time_diff)
+    df_end = search_adjacent_quadkeys(end_location, end_time, level, time_diff)
+    return merge_start_end_links(df_start, df_end, start_location, end_location, start_time, end_time)
+
+
+def benchmark(queries=200, radius=RADIUS, k=10, time_diff: int = 20, seed=0):
+    """
+    Compare the latency and recall of the quadkey and BallTree engines on trajectories of the database used as
+    queries. The reference is the exact set of trajectories whose endpoints are within radius and whose times are
+    within the windows; the quadkey engine also returns trajectories passing by both points, counted as extra matches.
+    The quadkey level is the deepest whose adjacent cells cover the radius, and it reads the in-memory link index.
+    :return: DataFrame with one row per engine
+    """
+    from process.trajectories.corridor import corridor_level
+
+    link_index.load()
+    balltree_index.load()
+    trajectories = balltree_index.trajectories()
+    if trajectories.empty:
+        raise ValueError("No trajectory to benchmark on")
+    sample = trajectories.sample(n=min(queries, len(trajectories)), random_state=seed)
+    print("Dataset: {} trajectories, {} links; {} queries, radius {} m, time_diff {} min".format(
+        len(trajectories), len(link_index), len(sample), radius, time_diff))
+
+    engines = {
+        'quadkey': lambda s, e, st, et: set(quadkey_matches(s, e, st, et, corridor_level(s, radius),
+                                                            time_diff)['start_traj_id'].tolist()),
+        'balltree': lambda s, e, st, et: set(balltree_index.search(s, e, st, et, radius, None,
+                                                                   time_diff)['start_traj_id'].tolist()),
+        'balltree_knn': lambda s, e, st, et: set(balltree_index.search(s, e, st, et, radius, k,
+                                                                       time_diff)['start_traj_id'].tolist()),
+    }
+    stats = {name: {'latency': [], 'found': 0, 'expected': 0, 'returned': 0} for name in engines}
+    for row in sample.itertuples(index=False):
+        start_location, end_location = (row.start_lat, row.start_lon), (row.end_lat, row.end_lon)
+        expected = exact_matches(trajectories, start_location, end_location, row.start_time, row.end_time, radius,
+                                 time_diff) - {row.traj_id}
+        for name, engine in engines.items():
+            started = timer.perf_counter()
+            matches = engine(start_location, end_location, row.start_time, row.end_time) - {row.traj_id}
+            stats[name]['latency'].append(timer.perf_counter() - started)
+            stats[name]['found'] += len(matches & expected)
+            # The k nearest search returns at most k of the expected matches
+            stats[name]['expected'] += min(len(expected), k) if name == 'balltree_knn' else len(expected)
+            stats[name]['returned'] += len(matches)
+
+    report = pd.DataFrame([{
+        'engine': name,
+        'mean_ms': np.mean(values['latency']) * 1000,
+        'p50_ms': np.percentile(values['latency'], 50) * 1000,
+        'p95_ms': np.percentile(values['latency'], 95) * 1000,
+        'recall': values['found'] / values['expected'] if values['expected'] else np.nan,
+        'matches_per_query': values['returned'] / len(sample),
+    } for name, values in stats.items()])
+    print(report.to_string(index=False, float_format='{:.3f}'.format))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the BallTree matching engine against the quadkey one")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--radius", type=float, default=RADIUS, help="metres around each endpoint")
+    parser.add_argument("--k", type=int, default=10, help="neighbours of the k nearest search")
+    parser.add_argument("--time-diff", type=int, default=20, help="time tolerance in minutes")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    benchmark(args.queries, args.radius, args.k, args.time_diff, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+from database import Database
+from pyquadkey2 import quadkey
+from process.trajectories.matching_ver2 import read_quad_cells, time_window
+from process.trajectories.support_func import point_segment_distance_np, time_to_microseconds, haversine_distance
+from process.trajectories.db_op import get_user_info
+from datetime import datetime, time, timedelta
+import math
+import numpy as np
+import pandas as pd
+
+
+# Length of the equator in metres, the width of the level 0 tile
+EARTH_CIRCUMFERENCE = 40075016
+
+# Average speed used to turn the detour distance into seconds, so it can be added to the time skew (30 km/h)
+DETOUR_SPEED = 30 / 3.6
+# Ratio of the road distance to the great-circle distance, used with DETOUR_SPEED to estimate the ride time
+ROAD_FACTOR = 1.3
+
+CORRIDOR_COLUMNS = ['traj_id', 'user_id', 'pickup_distance', 'dropoff_distance', 'detour', 'pickup_time',
+                    'dropoff_time', 'time_skew', 'score', 'rank']
+
+# The links of the candidate trajectories as segments between the positions of their first and last signal
+CORRIDOR_SEGMENTS_SQL = """
+    select l.traj_id
+    , t.user_id
+    , l.link_id
+    , ini.latitude as ini_lat
+    , ini.longitude as ini_lon
+    , "end".latitude as end_lat
+    , "end".longitude as end_lon
+    , l.ts_ini
+    , l.ts_end
+    , (extract(epoch from l.ts_ini) * 1000000)::bigint as ts_ini_us
+    , (extract(epoch from l.ts_end) * 1000000)::bigint as ts_end_us
+
+    from link l
+        inner join trajectory t
+            on t.traj_id = l.traj_id
+        inner join custom_signal ini
+            on l.signal_ini = ini.signal_id
+        inner join custom_signal "end"
+            on l.signal_end = "end".signal_id
+    where l.traj_id = ANY(%s)
+    order by l.traj_id, l.link_id
+    """
+
+
+def corridor_level(location, radius):
+    """
+    Deepest quadkey level whose cells are at least radius metres wide on the ground at the location, so the cell of
+    the location and its adjacent cells cover the whole radius. A level L cell is EARTH_CIRCUMFERENCE * cos(lat) / 2^L
+    metres wide, the level is clamped to [1, 20].
+    """
+    width = EARTH_CIRCUMFERENCE * math.cos(math.radians(location[0]))
+    return max(1, min(20, math.floor(math.log2(width / radius))))
+
+
+def expected_ride_seconds(start_location, end_location):
+    """Seconds a driver takes from the start to the end location, at DETOUR_SPEED on a road ROAD_FACTOR longer."""
+    return haversine_distance(start_location, end_location) * ROAD_FACTOR / DETOUR_SPEED
+
+
+def end_window(start_time: time, start_location, end_location, time_diff: int = 20):
+    """
+    Time of day window of the links around the end location: time_diff minutes around the time a driver picking the
+    rider up at start_time reaches it, one expected ride later.
+    """
+    arrival = datetime.combine(datetime.today(), start_time) + \
+        timedelta(seconds=expected_ride_seconds(start_location, end_location))
+    return time_window(arrival.time(), time_diff)
+
+
+def load_segments(traj_ids):
+    """The CORRIDOR_SEGMENTS_SQL segments of the trajectories."""
+    with Database() as db:
+        return db.query_df(CORRIDOR_SEGMENTS_SQL, [sorted(int(traj_id) for traj_id in traj_ids)])
+
+
+def links_near(location, radius, min_ts_time=time.min, max_ts_time=time.max):
+    """Links starting in the cells around the location within the time of day window, from the link index or the database."""
+    cell = quadkey.from_geo(location, corridor_level(location, radius))
+    return read_quad_cells(cell.nearby(1), min_ts_time, max_ts_time)
+
+
+def nearest_segments(segments, location):
+    """For each trajectory, the segment closest to the location, with its distance and the time the driver is there."""
+    distance, t = point_segment_distance_np(location, segments['ini_lat'].to_numpy(), segments['ini_lon'].to_numpy(),
+                                            segments['end_lat'].to_numpy(), segments['end_lon'].to_numpy())
+    ts_ini = segments['ts_ini_us'].to_numpy(dtype=np.int64) / 1e6
+    ts_end = segments['ts_end_us'].to_numpy(dtype=np.int64) / 1e6
+    nearest = pd.DataFrame({'traj_id': segments['traj_id'].to_numpy(), 'user_id': segments['user_id'].to_numpy(),
+                            'position': np.arange(len(segments)) + t, 'distance': distance,
+                            'time': ts_ini + t * (ts_end - ts_ini)})
+    return nearest.loc[nearest.groupby('traj_id')['distance'].idxmin()].set_index('traj_id')
+
+
+def search_corridor_matches(start_location, end_location, start_time, radius=500, time_diff: int = 20,
+                            exclude_user_id=None):
+    """
+    Match the driver trajectories passing within radius metres of both the rider's start and end location, the start
+    first, with the driver near the start within time_diff minutes of start_time.
+
+    Candidates are the trajectories with links in the quadkey cells around both locations, read from the link index,
+    around the start within time_diff minutes of start_time and around the end within time_diff minutes of the
+    expected arrival, see end_window.
+    Their segments are then measured against both locations with point_segment_distance_np; the pickup and drop-off
+    detour is estimated as the way there and back to the closest point of each. Matches are ranked by the detour, in
+    seconds at DETOUR_SPEED, plus the time skew between the pickup and start_time.
+    :param start_location: (latitude, longitude)
+    :param end_location: (latitude, longitude)
+    :param start_time: time the rider wants to leave
+    :param radius: metres
+    :param time_diff: minutes
+    :param exclude_user_id: user left out of the matches, usually the rider
+    :return: DataFrame with CORRIDOR_COLUMNS, best first
+    """
+    if isinstance(start_time, datetime):
+        start_time = start_time.time()
+    start_links = links_near(start_location, radius, *time_window(start_time, time_diff))
+    end_links = links_near(end_location, radius, *end_window(start_time, start_location, end_location, time_diff))
+    candidates = set(start_links['traj_id'].tolist()) & set(end_links['traj_id'].tolist())
+    if not candidates:
+        return pd.DataFrame(columns=CORRIDOR_COLUMNS)
+
+    segments = load_segments(candidates)
+    if exclude_user_id is not None:
+        segments = segments[segments['user_id'] != exclude_user_id].reset_index(drop=True)
+    if segments.empty:
+        return pd.DataFrame(columns=CORRIDOR_COLUMNS)
+
+    pickup = nearest_segments(segments, start_location)
+    dropoff = nearest_segments(segments, end_location)
+    df = pickup.join(dropoff, lsuffix='_pickup', rsuffix='_dropoff')
+
+    rider_start = time_to_microseconds(start_time) / 1e6
+    df = pd.DataFrame({
+        'traj_id': df.index.to_numpy(),
+        'user_id': df['user_id_pickup'].to_numpy(),
+        'pickup_distance': df['distance_pickup'].to_numpy(),
+        'dropoff_distance': df['distance_dropoff'].to_numpy(),
+        'detour': 2 * (df['distance_pickup'] + df['distance_dropoff']).to_numpy(),
+        'pickup_time': df['time_pickup'].to_numpy(),
+        'dropoff_time': df['time_dropoff'].to_numpy(),
+        'time_skew': np.abs(df['time_pickup'].to_numpy() - rider_start),
+        'ordered': (df['position_pickup'] < df['position_dropoff']).to_numpy(),
+    })
+    df = df[df['ordered'] & (df['pickup_distance'] <= radius) & (df['dropoff_distance'] <= radius)
+            & (df['time_skew'] <= time_diff * 60)].drop(columns='ordered')
+
+    df['score'] = df['detour'] / DETOUR_SPEED + df['time_skew']
+    df = df.sort_values(['score', 'traj_id'], kind='stable').reset_index(drop=True)
+    df['rank'] = np.arange(1, len(df) + 1)
+    return df[CORRIDOR_COLUMNS]
+
+
+def search_corridor_matches_by_user(user_id: int, radius=500, time_diff: int = 20):
+    """
+    Corridor matches of a rider from the home, work and departure time of the user.
+    """
+    user_id, start, end, departure_time = get_user_info(user_id)
+    return search_corridor_matches(start, end, departure_time, radius, time_diff, exclude_user_id=user_id)
@@ -1,14 +1,20 @@
 from database import Database
-from process.trajectories.gmapfunction import get_directions_detail, convert_to_next_weekday_time, encode_polyline
+from database_async import AsyncDatabase
+from process.trajectories.gmapfunction import get_directions_detail, convert_to_next_weekday_time
+from process.trajectories.polyline import encode_polyline, encode_polylines
 from itertools import pairwise
-from tqdm import tqdm
-from process.trajectories.support_func import get_qk_line
+from process.trajectories.support_func import get_qk_segments_np
+from process.trajectories.link_index import link_index, LINK_COLUMNS as LINK_INDEX_COLUMNS
+from process.trajectories.shard_pool import shard_pool
+from process.trajectories.match_cache import match_cache
+from process.trajectories.minhash import minhash_lsh
+from process.trajectories.pyramid import pyramid_columns, with_pyramid
 from pyquadkey2 import quadkey
+import numpy as np
+import pandas as pd
 
 
 def insert_single_signal(signal):
-    db = Database()
-    db.connect()
     sql  = """
     INSERT INTO custom_signal (
     user_id,
@@ -20,75 +26,53 @@ VALUES (
     %s, %s, %s, %s
 );
     """
-    db.execute_query(sql, signal)
+    with Database() as db:
+        db.execute_query(sql, signal)
 
-    db.close_connection()
+SIGNAL_COLUMNS = ["user_id", "time_stamp", "latitude", "longitude"]
+LINK_COLUMNS = ["traj_id", "signal_ini", "signal_end", "ts_ini", "ts_end", "quadkey"]
+LINK_QK_COLUMNS = ["link_id", "quadkey", "density"]
 
-def insert_custom_signal(signals: list):
-    db = Database()
-    db.connect()
-    sql  = """
-    INSERT INTO custom_signal (
-    user_id,
-    time_stamp,
-    latitude,
-    longitude
-    )
-    VALUES (%s, %s, %s, %s);
+DELETE_ORPHAN_SIGNALS_SQL = """
+    delete from custom_signal
+    where user_id = %s
+      and not exists (select 1 from trajectory where user_id = %s);
     """
-    db.execute_many(sql, signals)
 
+INSERT_TRAJECTORY_SQL = """
+    insert into trajectory (user_id, ts_ini, ts_end)
+    values (%s, %s, %s)
+    returning traj_id;
+    """
 
 
-def insert_signal_data_point(user_id, start_location, end_location, start_time):
-    # Get the directions detail for the given start and end location
-    start_time = convert_to_next_weekday_time(start_time.hour, start_time.minute)
-    directions_detail, overall_polyline, estimated_end_time = get_directions_detail(start_location, end_location, start_time)
+def insert_custom_signal(signals: list, return_ids=False):
+    """
+    Bulk load (user_id, time_stamp, latitude, longitude) rows into custom_signal with COPY.
+    When return_ids is set the signal ids are reserved up front and returned in the order of the rows.
+    """
+    with Database() as db:
+        if not return_ids:
+            db.copy_rows("custom_signal", SIGNAL_COLUMNS, signals)
+            return None
+
+        signal_ids = db.reserve_ids("custom_signal", "signal_id", len(signals))
+        db.copy_rows("custom_signal", ["signal_id"] + SIGNAL_COLUMNS,
+                     [(signal_id, *signal) for signal_id, signal in zip(signal_ids, signals)])
+    return signal_ids
 
-    # Insert the directions detail into the database
-    insert_custom_signal([(user_id, point[1], point[0][0], point[0][1]) for point in directions_detail])
 
-    return user_id, start_location, end_location, start_time, estimated_end_time, "".join(overall_polyline)
 
 def get_signal_input_data(user_id):
-    db = Database()
-    db.connect()
     sql = """
         select user_id, latitude, longitude, time_stamp
         from custom_signal
         where user_id = %s
     """
-    res = db.fetch_all(sql, [user_id])
-    db.close_connection()
+    with Database() as db:
+        res = db.fetch_all(sql, [user_id])
     return res
 
-def add_trajectory_by_id(user_id: int):
-    print("Populate trajectory by id {}".format(user_id))
-
-    # sql = """
-    # insert into trajectory (vehicle_id, trip_id)
-    #     select distinct vehicle_id, trip_id from custom_signal;
-    # """
-
-    sql = """
-    insert into trajectory (user_id, ts_ini, ts_end)
-    select    tt.user_id
-    ,         ( select min(s1.time_stamp)
-                from custom_signal s1
-                where s1.user_id = tt.user_id
-                ) as ts_ini
-    ,         ( select max(s2.time_stamp)
-                from custom_signal s2
-                where s2.user_id = tt.user_id
-                ) as ts_end
-    from (select distinct user_id from custom_signal) tt
-    where tt.user_id = %s;"""
-
-    db = Database()
-    db.connect()
-    db.execute_query(sql, [user_id])
-    db.close_connection()
-
 def load_trajectories_by_id(user_id:int):
     print("Load trajectories")
 
@@ -98,10 +82,8 @@ def load_trajectories_by_id(user_id:int):
     from   trajectory
     where user_id = %s;
     """
-    db = Database()
-    db.connect()
-    res = db.fetch_all(sql, [user_id])
-    db.close_connection()
+    with Database() as db:
+        res = db.fetch_all(sql, [user_id])
     return res
 
 
@@ -119,131 +101,295 @@ def load_trajectory_points(traj_id:int):
     order by max_signal_id;
 
     """
-    db = Database()
-    db.connect()
-    res = db.fetch_all(sql, [traj_id])
-    db.close_connection()
+    with Database() as db:
+        res = db.fetch_all(sql, [traj_id])
     return res
 
-def insert_link(traj_id, signal_ini, signal_end, ts_ini, ts_end, quadkey = None):
-    sql = """
-    INSERT INTO link (traj_id, signal_ini, signal_end, ts_ini, ts_end, quadkey)
-    VALUES (%s, %s, %s, %s, %s, %s)
-    RETURNING link_id;
-    """
-    db = Database()
-    db.connect()
-    # db.execute_query(sql, [traj_id, signal_ini, signal_end, ts_ini, ts_end])
-
-    res = db.fetch_one(sql, [traj_id, signal_ini, signal_end, ts_ini, ts_end, quadkey])
-    db.connection.commit()
-    db.close_connection()
+def insert_link_quadkeys(link_quadkey_density_list):
+    with Database() as db:
+        db.copy_rows("link_qk", LINK_QK_COLUMNS, link_quadkey_density_list)
 
-    return res[0]
+LINKED_TRAJECTORIES_SQL = """
+    select distinct traj_id
+    from link
+    where traj_id = ANY(%s)
+    """
 
-def insert_link_bulk(link_list):
-    sql = """
-        INSERT INTO link (traj_id, signal_ini, signal_end, ts_ini, ts_end, quadkey)
-    VALUES (%s, %s, %s, %s, %s, %s);
+# Segments of the links of the trajectories that have no link_qk cells yet
+LINK_SEGMENTS_WITHOUT_QK_SQL = """
+    select l.link_id
+    , ini.latitude as ini_lat
+    , ini.longitude as ini_lon
+    , "end".latitude as end_lat
+    , "end".longitude as end_lon
+    from link l
+        inner join custom_signal ini
+            on l.signal_ini = ini.signal_id
+        inner join custom_signal "end"
+            on l.signal_end = "end".signal_id
+    where l.traj_id = ANY(%s)
+      and not exists (select 1 from link_qk q where q.link_id = l.link_id)
+    order by l.link_id
     """
-    db = Database()
-    db.connect()
 
-    db.execute_many(sql, link_list)
+# One page of the trajectories with links missing their cells, after the last trajectory of the previous page
+TRAJECTORIES_WITHOUT_QK_SQL = """
+    select distinct l.traj_id
+    from link l
+    where l.traj_id > %s
+        and not exists (select 1 from link_qk q where q.link_id = l.link_id)
+    order by l.traj_id
+    limit %s
+    """
 
 
-def insert_link_quadkeys(link_quadkey_density_list):
-    sql = """
-    insert into link_qk 
-        (link_id, quadkey, density) 
-    values 
-        (%s, %s, %s)
+def rasterize_links(link_ids, starts, ends, level=20):
     """
-    db = Database()
-    db.connect()
-    db.execute_many(sql, link_quadkey_density_list)
+    The link_qk rows of a set of links in one compiled pass: the anti-aliased get_qk_line cells of every link, with
+    the density of a cell reached twice by the same link added up.
+    :param link_ids: id of each link
+    :param starts: (latitude, longitude) of the first point of each link
+    :param ends: (latitude, longitude) of the last point of each link
+    :param level:
+    :return: (link_id, quadkey, density) rows
+    """
+    pairs, quadints, densities = get_qk_segments_np(starts, ends, level)
+    link_ids = np.asarray(link_ids, dtype=np.int64)[pairs]
+    order = np.lexsort((quadints, link_ids))
+    link_ids, quadints, densities = link_ids[order], quadints[order], densities[order]
+    first = np.flatnonzero(np.r_[True, (np.diff(link_ids) != 0) | (np.diff(quadints) != 0)])
+    return list(zip(link_ids[first].tolist(), quadints[first].tolist(), np.add.reduceat(densities, first).tolist()))
 
-    db.close_connection()
 
-def populate_link_by_id(user_id:int):
-    print("Populate links")
+def link_point_rows(link_ids, links, points):
+    """link_qk rows of links built by trajectory_links from consecutive points."""
+    locations = np.asarray([(point[1], point[2]) for point in points], dtype=np.float64).reshape(-1, 2)
+    return rasterize_links(link_ids, locations[:-1], locations[1:]) if links else []
 
-    shift = 64 - 2 * 20
 
-    trajectories = load_trajectories_by_id(user_id)
+def populate_link_by_id(user_id:int):
+    """
+    Build the links and link_qk cells of the trajectories of the user. Trajectories without links get them, with
+    ids reserved in one call and both tables written in one transaction; trajectories that already have links only
+    get the missing link_qk cells.
+    """
+    print("Populate links")
 
-    for traj_id, vehicle_id in tqdm(trajectories):
-        points = load_trajectory_points(user_id)
+    traj_ids = [traj_id for traj_id, _ in load_trajectories_by_id(user_id)]
+    with Database() as db:
+        linked = {row[0] for row in db.fetch_all(LINKED_TRAJECTORIES_SQL, [traj_ids]) or []}
 
+    links = []
+    link_qk_points = []
+    for traj_id in traj_ids:
+        if traj_id in linked:
+            continue
+        points = load_trajectory_points(traj_id)
         if len(points) > 1:
-            for p0, p1 in pairwise(points):
-                signal_ini = p0[0]
-                signal_end = p1[0]
-                ts_ini = p0[3]
-                ts_end = p1[3]
-                link_id = insert_link(traj_id, signal_ini, signal_end, ts_ini, ts_end)
-
-                loc0 = (p0[1], p0[2])
-                loc1 = (p1[1], p1[2])
-                line = get_qk_line(loc0, loc1, 20)
-
-                params = [(link_id, pt[0].to_quadint() >> shift, pt[1]) for pt in line]
-                insert_link_quadkeys(params)
-
-
-def populate_link_by_id_test(user_id: int):
+            traj_links = trajectory_links(traj_id, points)
+            links.extend(traj_links)
+            link_qk_points.append((traj_links, points))
+
+    if links:
+        with Database() as db, db.transaction():
+            link_ids = db.reserve_ids("link", "link_id", len(links))
+            db.copy_rows("link", ["link_id"] + LINK_COLUMNS + pyramid_columns(),
+                         [(link_id, *with_pyramid(link)) for link_id, link in zip(link_ids, links)])
+            link_qk = []
+            position = 0
+            for traj_links, points in link_qk_points:
+                link_qk.extend(link_point_rows(link_ids[position:position + len(traj_links)], traj_links, points))
+                position += len(traj_links)
+            db.copy_rows("link_qk", LINK_QK_COLUMNS, link_qk)
+
+    backfill_link_qk(sorted(linked))
+    # Keep the MinHash signatures in step with the quadkey sets
+    minhash_lsh.index_trajectories(traj_ids)
+
+
+def backfill_link_qk(traj_ids=None, batch_size=500):
+    """
+    Write the link_qk cells of existing links that have none, one batch of trajectories per transaction.
+    Without traj_ids every trajectory missing cells is backfilled, paging through them by traj_id. Links whose signals
+    are missing cannot be rasterized and are skipped.
+    :return: number of link_qk rows written
+    """
+    written = 0
+    last_traj_id = 0
+    while True:
+        with Database() as db:
+            if traj_ids is None:
+                batch = [row[0] for row in
+                         db.fetch_all(TRAJECTORIES_WITHOUT_QK_SQL, [last_traj_id, batch_size]) or []]
+                last_traj_id = batch[-1] if batch else last_traj_id
+            else:
+                batch, traj_ids = list(traj_ids[:batch_size]), traj_ids[batch_size:]
+            if not batch:
+                return written
+            segments = db.fetch_all(LINK_SEGMENTS_WITHOUT_QK_SQL, [batch]) or []
+
+        if segments:
+            segments = np.asarray(segments, dtype=np.float64)
+            rows = rasterize_links(segments[:, 0].astype(np.int64), segments[:, 1:3], segments[:, 3:5])
+            with Database() as db, db.transaction():
+                db.copy_rows("link_qk", LINK_QK_COLUMNS, rows)
+            written += len(rows)
+            print("Backfilled {} link_qk rows for {} trajectories".format(len(rows), len(batch)))
+
+
+def trajectory_links(traj_id, points):
+    """
+    Build the link rows between consecutive trajectory points, each tagged with the level 20 quadint of its first point.
+    :param traj_id:
+    :param points: (signal_id, latitude, longitude, time_stamp) rows as returned by load_trajectory_points
+    :return: (traj_id, signal_ini, signal_end, ts_ini, ts_end, quadkey) rows
+    """
     shift = 64 - 2 * 20
 
-    trajectories = load_trajectories_by_id(user_id)
-    for traj_id, vehicle_id in trajectories:
-        points = load_trajectory_points(traj_id)
+    link_list = []
+    for p0, p1 in pairwise(points):
+        signal_ini = p0[0]
+        signal_end = p1[0]
+        ts_ini = p0[3]
+        ts_end = p1[3]
+        quad = quadkey.from_geo((p0[1], p0[2]), 20).to_quadint() >> shift
+        link_list.append((traj_id, signal_ini, signal_end, ts_ini, ts_end, quad))
+    return link_list
 
-        link_list = []
-        if len(points) > 1:
-            for p0, p1 in pairwise(points):
-                signal_ini = p0[0]
-                signal_end = p1[0]
-                ts_ini = p0[3]
-                ts_end = p1[3]
-                quad = quadkey.from_geo((p0[1], p0[2]), 20).to_quadint() >> shift
-                link_list.append((traj_id, signal_ini, signal_end, ts_ini, ts_end, quad))
 
-            insert_link_bulk(link_list)
+def trajectory_points(signal_ids, signals):
+    """
+    In-memory equivalent of load_trajectory_points: one point per distinct location, carrying the last signal id and
+    the first timestamp seen there, ordered by signal id.
+    :param signal_ids: ids of the signals, in the same order as signals
+    :param signals: (user_id, time_stamp, latitude, longitude) rows
+    :return: (signal_id, latitude, longitude, time_stamp) rows
+    """
+    points = {}
+    for signal_id, (_, time_stamp, latitude, longitude) in zip(signal_ids, signals):
+        point = points.get((latitude, longitude))
+        if point is None:
+            points[(latitude, longitude)] = [signal_id, latitude, longitude, time_stamp]
+        else:
+            point[0] = max(point[0], signal_id)
+            point[3] = min(point[3], time_stamp)
 
+    return sorted(points.values(), key=lambda point: point[0])
 
-def calculate_trajectory_by_id(user_id: int):
 
+def build_trajectory(user_id: int):
+    """
+    Compute the signals, the trajectory row, its links and their link_qk cells in memory from the directions result
+    and persist them in a single transaction on one connection. A failure rolls everything back, so no orphaned signals are left behind.
+    Signals left by builds that failed before this existed are removed in the same transaction.
+    Once committed, the new links are added to the in-memory link index, the cached searches around them are
+    dropped and the trajectory is added to the MinHash index.
+    :param user_id:
+    :return: traj_id of the new trajectory
+    """
     user_id, start, end, start_time = get_user_info(user_id)
-    insert_signal_data_point(user_id, start, end, start_time)
-    add_trajectory_by_id(user_id)
-    populate_link_by_id_test(user_id)
-    # modify_link_table_timestamp_by_id(vehicle_id, trip_id)
+
+    # Call Google Maps before checking out a connection so it is not held during the request
+    start_time = convert_to_next_weekday_time(start_time.hour, start_time.minute)
+    directions_detail, _, _ = get_directions_detail(start, end, start_time)
+    signals = [(user_id, point[1], point[0][0], point[0][1]) for point in directions_detail]
+    if not signals:
+        raise ValueError("No route found for user {}".format(user_id))
+
+    ts_ini = min(signal[1] for signal in signals)
+    ts_end = max(signal[1] for signal in signals)
+
+    with Database() as db, db.transaction():
+        db.execute_query(DELETE_ORPHAN_SIGNALS_SQL, [user_id, user_id])
+
+        signal_ids = db.reserve_ids("custom_signal", "signal_id", len(signals))
+        db.copy_rows("custom_signal", ["signal_id"] + SIGNAL_COLUMNS,
+                     [(signal_id, *signal) for signal_id, signal in zip(signal_ids, signals)])
+
+        traj_id = db.fetch_one(INSERT_TRAJECTORY_SQL, [user_id, ts_ini, ts_end])[0]
+
+        points = trajectory_points(signal_ids, signals)
+        links = trajectory_links(traj_id, points)
+        link_ids = db.reserve_ids("link", "link_id", len(links))
+        db.copy_rows("link", ["link_id"] + LINK_COLUMNS + pyramid_columns(),
+                     [(link_id, *with_pyramid(link)) for link_id, link in zip(link_ids, links)])
+        db.copy_rows("link_qk", LINK_QK_COLUMNS, link_point_rows(link_ids, links, points))
+
+    if shard_pool.started or link_index.loaded:
+        new_links = pd.DataFrame(
+            [(user_id, traj_id, link_id, quad, link_ts_ini, link_ts_end, p0[1], p0[2])
+             for link_id, (_, _, _, link_ts_ini, link_ts_end, quad), p0 in zip(link_ids, links, points)],
+            columns=LINK_INDEX_COLUMNS)
+        if shard_pool.started:
+            shard_pool.add_links(new_links)
+        else:
+            link_index.add_links(new_links)
+    match_cache.invalidate_links([link[5] for link in links])
+    if links:
+        try:
+            minhash_lsh.index_trajectories([traj_id])
+        except Exception as e:
+            # The trajectory is committed, index_trajectories() without ids picks it up later
+            print(f"The error '{e}' occurred while indexing trajectory {traj_id}.")
+
+    return traj_id
 
 
 def get_user_info(user_id):
-    db = Database()
-    db.connect()
     sql = """
     select user_id, home_latitude, home_longitude, work_latitude, work_longitude, departure_time
     from users
     where user_id = %s
     """
-    user_id, home_lat, home_lon, work_lat, work_lon, departure_time = db.fetch_one(sql, [user_id])
-
-    db.close_connection()
+    with Database() as db:
+        user_id, home_lat, home_lon, work_lat, work_lon, departure_time = db.fetch_one(sql, [user_id])
     return user_id, (home_lat, home_lon), (work_lat, work_lon), departure_time
 
-def get_user_polyline(user_id: int) -> str:
-    db = Database()
-    db.connect()
-    sql = """
+USER_POLYLINE_SQL = """
     select  latitude, longitude
     from custom_signal
     where user_id = %s
     order by signal_id
     """
-    res = db.fetch_all(sql, [user_id])
-    db.close_connection()
+
+def get_user_polyline(user_id: int) -> str:
+    with Database() as db:
+        res = db.fetch_all(USER_POLYLINE_SQL, [user_id])
 
     poly = encode_polyline(res)
-    return poly
\ No newline at end of file
+    return poly
+
+# Seconds of the latest trajectory of each user, its time of day columns wrapping around midnight
+USERS_TRAJECTORY_SECONDS_SQL = """
+    select distinct on (user_id) user_id
+    , mod(extract(epoch from ts_end - ts_ini)::numeric + 86400, 86400)::float8 as seconds
+    from trajectory
+    where user_id = ANY(%s)
+    order by user_id, traj_id desc
+    """
+
+async def get_users_trajectory_seconds_async(user_ids) -> dict:
+    """Duration in seconds of the latest trajectory of each user, as a dict keyed by user_id."""
+    async with AsyncDatabase() as db:
+        res = await db.fetch_all(USERS_TRAJECTORY_SECONDS_SQL, [list(user_ids)])
+    return {user_id: seconds for user_id, seconds in res or []}
+
+USERS_POLYLINE_SQL = """
+    select user_id, latitude, longitude
+    from custom_signal
+    where user_id = ANY(%s)
+    order by user_id, signal_id
+    """
+
+async def get_users_polyline_async(user_ids) -> dict:
+    """get_user_polyline for several users in one query and one batch encode, as a dict keyed by user_id."""
+    user_ids = list(user_ids)
+    async with AsyncDatabase() as db:
+        res = await db.fetch_all(USERS_POLYLINE_SQL, [user_ids])
+
+    rows = np.array(res or [], dtype=np.float64).reshape(-1, 3)
+    found, starts = np.unique(rows[:, 0].astype(np.int64), return_index=True)
+    polylines = encode_polylines(np.split(rows[:, 1:], starts[1:]) if len(rows) else [])
+    by_user = dict(zip(found.tolist(), polylines))
+    # Users without signals get the empty polyline, as with get_user_polyline
+    return {user_id: by_user.get(user_id, "") for user_id in user_ids}
\ No newline at end of file
@@ -0,0 +1,53 @@
+from process.trajectories.gmapfunction import get_distance_matrix, MATRIX_MAX_ELEMENTS, MATRIX_MAX_SIDE
+
+
+# Candidates re-ranked by their detour; the ones after them keep their order
+DETOUR_TOP_N = 20
+# Drivers per distance matrix request: their starts to the rider's start is an n x 1 request, the rider's end to their
+# ends a 1 x n one
+DETOUR_CHUNK = min(MATRIX_MAX_ELEMENTS, MATRIX_MAX_SIDE)
+
+
+def added_drive_times(rider, drivers, departure_time=None):
+    """
+    Drive time the rider adds to each driver's commute: driver start -> rider start -> rider end -> driver end, minus
+    driver start -> driver end, all leaving at departure_time. Only the legs through the rider are requested, 2n + 1
+    elements for n drivers: the pickups of a chunk of drivers in one n x 1 request, their finishes in one 1 x n
+    request and the rider's ride in a 1 x 1 request, all through the directions cache. The direct trip is the
+    duration of the driver's stored trajectory, so it costs no request.
+    :param rider: (start location, end location)
+    :param drivers: driver id -> (start location, end location, seconds of the direct trip or None)
+    :param departure_time:
+    :return: driver id -> (added seconds, pickup seconds), None for the drivers with a leg that has no route or no
+             direct trip
+    """
+    rider_start, rider_end = rider
+    driver_ids = list(drivers)
+    detours = {}
+    if not driver_ids:
+        return detours
+    ride = get_distance_matrix([rider_start], [rider_end], departure_time=departure_time)[0][0]
+    for chunk_start in range(0, len(driver_ids), DETOUR_CHUNK):
+        chunk = driver_ids[chunk_start:chunk_start + DETOUR_CHUNK]
+        pickups = get_distance_matrix([drivers[driver_id][0] for driver_id in chunk], [rider_start],
+                                      departure_time=departure_time)
+        finishes = get_distance_matrix([rider_end], [drivers[driver_id][1] for driver_id in chunk],
+                                       departure_time=departure_time)[0]
+
+        for position, driver_id in enumerate(chunk):
+            pickup = pickups[position][0]
+            finish = finishes[position]
+            direct = drivers[driver_id][2]
+            if None in (pickup, ride, finish, direct):
+                detours[driver_id] = None
+                continue
+            detours[driver_id] = (pickup[1] + ride[1] + finish[1] - direct, pickup[1])
+    return detours
+
+
+def rank_by_detour(candidate_ids, detours):
+    """Candidates sorted by added drive time, those without one last, ties in their previous order."""
+    order = {candidate_id: position for position, candidate_id in enumerate(candidate_ids)}
+    return sorted(candidate_ids, key=lambda candidate_id: (detours.get(candidate_id) is None,
+                                                          (detours.get(candidate_id) or (0,))[0],
+                                                          order[candidate_id]))
@@ -0,0 +1,201 @@
+from database import read_config
+from collections import OrderedDict
+from datetime import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# Defaults of the directions_cache section of the config
+DEFAULT_SETTINGS = {
+    # Degrees the origin and destination are rounded to, about 110 m of latitude
+    "grid": 0.001,
+    # Minutes of the departure time slots, within each weekday
+    "slot_minutes": 15,
+    "memory_size": 1024,
+    # Seconds an entry is served before the route is asked again, traffic estimates included
+    "ttl": 7 * 24 * 3600,
+    "path": "directions_cache.sqlite3",
+    "max_rows": 100_000,
+}
+
+CREATE_DIRECTIONS_SQL = """
+    create table if not exists directions (
+        key text primary key,
+        response text not null,
+        created_at real not null,
+        last_used real not null
+    )
+    """
+
+
+def directions_settings(config_file='config.json'):
+    config = read_config(os.path.abspath(config_file))
+    return {**DEFAULT_SETTINGS, **config.get('directions_cache', {})}
+
+
+class DirectionsCache:
+    """
+    Two tier cache of directions results: an LRU in memory in front of a SQLite file shared by the workers of the
+    host and kept across restarts.
+
+    Entries are keyed by the origin and destination rounded to the grid, the mode and the departure time bucket, the
+    weekday and slot of the day, so the commuters asking for the same trip at the same time share one request.
+    Both tiers expire entries after ttl seconds; the memory tier keeps memory_size entries and the file max_rows,
+    dropping the least recently used ones first.
+    """
+
+    def __init__(self, grid=None, slot_minutes=None, memory_size=None, ttl=None, path=None, max_rows=None):
+        settings = directions_settings()
+        self.grid = grid if grid is not None else settings["grid"]
+        self.slot_minutes = slot_minutes if slot_minutes is not None else settings["slot_minutes"]
+        self.memory_size = memory_size if memory_size is not None else settings["memory_size"]
+        self.ttl = ttl if ttl is not None else settings["ttl"]
+        self.path = path if path is not None else settings["path"]
+        self.max_rows = max_rows if max_rows is not None else settings["max_rows"]
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (response, expires_at)
+        self._connection = None
+        self._rows = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def location_key(self, location):
+        """A (lat, lng) pair snapped to the grid, or an address normalised."""
+        if isinstance(location, str):
+            return " ".join(location.lower().split())
+        lat, lng = location
+        return "{:.6f},{:.6f}".format(round(lat / self.grid) * self.grid, round(lng / self.grid) * self.grid)
+
+    def time_bucket(self, departure_time):
+        """weekday:slot of the departure time, now when None."""
+        departure_time = departure_time or datetime.now()
+        slot = (departure_time.hour * 60 + departure_time.minute) // self.slot_minutes
+        return "{}:{}".format(departure_time.weekday(), slot)
+
+    def key(self, origin, destination, mode="driving", departure_time=None):
+        return "|".join([self.location_key(origin), self.location_key(destination), mode,
+                         self.time_bucket(departure_time)])
+
+    def connection(self):
+        """SQLite connection of the cache, opened on first use. Callers hold the lock."""
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._connection.execute("pragma journal_mode=wal")
+            self._connection.execute(CREATE_DIRECTIONS_SQL)
+            self._connection.commit()
+            self._rows = self._connection.execute("select count(*) from directions").fetchone()[0]
+        return self._connection
+
+    def remember(self, key, response, ttl):
+        """Put an entry in the memory tier for ttl seconds. Callers hold the lock."""
+        self._entries[key] = (response, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.memory_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key):
+        """The cached directions result, or None on a miss or when the entry expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] >= time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[0]
+                del self._entries[key]
+                self.expirations += 1
+
+            try:
+                connection = self.connection()
+                row = connection.execute("select response, created_at from directions where key = ?",
+                                         [key]).fetchone()
+                now = time.time()
+                if row is not None and row[1] + self.ttl < now:
+                    connection.execute("delete from directions where key = ?", [key])
+                    connection.commit()
+                    self._rows -= 1
+                    self.expirations += 1
+                    row = None
+                if row is not None:
+                    connection.execute("update directions set last_used = ? where key = ?", [now, key])
+                    connection.commit()
+            except sqlite3.Error as e:
+                print(f"The error '{e}' occurred while reading the directions cache.")
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+            response = json.loads(row[0])
+            # The entry lives as long in memory as what is left of it on disk
+            self.remember(key, response, row[1] + self.ttl - now)
+            self.disk_hits += 1
+            return response
+
+    def put(self, key, response):
+        with self._lock:
+            self.remember(key, response, self.ttl)
+            try:
+                connection = self.connection()
+                now = time.time()
+                connection.execute(
+                    "insert into directions (key, response, created_at, last_used) values (?, ?, ?, ?) "
+                    "on conflict (key) do update set response = excluded.response, created_at = excluded.created_at, "
+                    "last_used = excluded.last_used", [key, json.dumps(response), now, now])
+                # Approximate between two trims: updates are counted as new rows and rows of other workers are
+                # only counted on open
+                self._rows += 1
+                if self._rows > self.max_rows:
+                    self.trim(connection, now)
+                connection.commit()
+            except sqlite3.Error as e:
+                print(f"The error '{e}' occurred while writing the directions cache.")
+
+    def trim(self, connection, now):
+        """Drop the expired rows, then the least recently used ones down to 90% of max_rows."""
+        self.expirations += connection.execute("delete from directions where created_at < ?",
+                                               [now - self.ttl]).rowcount
+        rows = connection.execute("select count(*) from directions").fetchone()[0]
+        excess = rows - int(self.max_rows * 0.9)
+        if excess > 0:
+            connection.execute("delete from directions where key in "
+                               "(select key from directions order by last_used limit ?)", [excess])
+            self.evictions += excess
+            rows -= excess
+        self._rows = rows
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            connection = self.connection()
+            connection.execute("delete from directions")
+            connection.commit()
+            self._rows = 0
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_size": len(self._entries),
+                "memory_maxsize": self.memory_size,
+                "disk_rows": self._rows,
+                "disk_max_rows": self.max_rows,
+                "ttl": self.ttl,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+directions_cache = DirectionsCache()
@@ -1,63 +1,67 @@
 from datetime import datetime, timedelta
-from typing import List, Tuple
-import googlemaps
-import os
-from dotenv import load_dotenv
+from process.trajectories.directions_cache import directions_cache
+from process.trajectories.polyline import decode_polyline, encode_polyline
+from process.trajectories.routing_client import routing_client
 
-load_dotenv()
-api_key = os.getenv("GOOGLE_MAP_API_KEY")
+# Largest distance matrix request: 25 origins, 25 destinations and 100 elements
+MATRIX_MAX_SIDE = 25
+MATRIX_MAX_ELEMENTS = 100
 
-gmaps = googlemaps.Client(key=api_key)
-
-def decode_polyline(polyline) -> list:
-    """Decodes a Polyline string into a list of lat/lng dicts.
-
-    See the developer docs for a detailed description of this encoding:
-    https://developers.google.com/maps/documentation/utilities/polylinealgorithm
-
-    :param polyline: An encoded polyline
-    :type polyline: string
-
-    :rtype: list of dicts with lat/lng keys
+def get_directions(start_location, end_location, mode="driving", departure_time: datetime = None):
+    """
+    Directions from the routing provider through the directions cache. Routes are shared by the requests with nearby
+    endpoints and a departure time in the same weekday slot, see DirectionsCache, and the misses on the same entry
+    share one request, see RoutingClient. Empty results are not cached.
     """
-    points = []
-    index = lat = lng = 0
-
-    while index < len(polyline):
-        result = 1
-        shift = 0
-        while True:
-            b = ord(polyline[index]) - 63 - 1
-            index += 1
-            result += b << shift
-            shift += 5
-            if b < 0x1f:
-                break
-        lat += (~result >> 1) if (result & 1) != 0 else (result >> 1)
-
-        result = 1
-        shift = 0
-        while True:
-            b = ord(polyline[index]) - 63 - 1
-            index += 1
-            result += b << shift
-            shift += 5
-            if b < 0x1f:
-                break
-        lng += ~(result >> 1) if (result & 1) != 0 else (result >> 1)
-
-        points.append([lat * 1e-5, lng * 1e-5])
-
-    return points
+    key = directions_cache.key(start_location, end_location, routing_client.name + ":" + mode, departure_time)
+    directions_result = directions_cache.get(key)
+    if directions_result is None:
+        directions_result = routing_client.directions(start_location, end_location, mode=mode,
+                                                      departure_time=departure_time, key=key)
+        if directions_result:
+            directions_cache.put(key, directions_result)
+    return directions_result
+
+def get_distance_matrix(origins, destinations, mode="driving", departure_time: datetime = None):
+    """
+    (distance, duration) in metres and seconds from every origin to every destination, None where there is no route.
+    With a departure_time the duration is duration_in_traffic when the provider returns it, as Google does for
+    driving. Elements are cached one by one in the directions cache, and the request is only sent when one of them is
+    missing.
+    :param origins: at most MATRIX_MAX_SIDE locations
+    :param destinations: at most MATRIX_MAX_SIDE locations, with len(origins) * len(destinations) at most
+                         MATRIX_MAX_ELEMENTS
+    :return: list of rows, one per origin
+    """
+    if len(origins) > MATRIX_MAX_SIDE or len(destinations) > MATRIX_MAX_SIDE \
+            or len(origins) * len(destinations) > MATRIX_MAX_ELEMENTS:
+        raise ValueError("Distance matrix request over the element limits")
+
+    cache_mode = routing_client.name + ":matrix:" + mode
+    keys = [[directions_cache.key(origin, destination, cache_mode, departure_time) for destination in destinations]
+            for origin in origins]
+    elements = [[directions_cache.get(key) for key in row] for row in keys]
+
+    if any(element is None for row in elements for element in row):
+        response = routing_client.distance_matrix(origins, destinations, mode=mode, departure_time=departure_time,
+                                                  key=tuple(map(tuple, keys)))
+        elements = []
+        for key_row, row in zip(keys, response['rows']):
+            elements.append([])
+            for key, element in zip(key_row, row['elements']):
+                # No route is cached too, as an empty element
+                duration = element.get('duration_in_traffic', element.get('duration')) \
+                    if departure_time is not None else element.get('duration')
+                value = {'distance': element['distance']['value'], 'duration': duration['value']} \
+                    if element.get('status') == 'OK' else {}
+                directions_cache.put(key, value)
+                elements[-1].append(value)
+
+    return [[(element['distance'], element['duration']) if element else None for element in row] for row in elements]
 
 def get_directions_detail(start_location, end_location, start_time: datetime = datetime.now(), mode="driving"):
-    # Request directions via the Google Maps API with a specified start time
-    directions_result = gmaps.directions(
-        start_location,
-        end_location,
-        mode=mode,
-        departure_time=start_time
-    )
+    # Request directions from the routing provider with a specified start time
+    directions_result = get_directions(start_location, end_location, mode=mode, departure_time=start_time)
 
     cur_time = start_time
     result_location = []
@@ -99,41 +103,6 @@ def convert_to_next_weekday_time(hour, minute):
 
 
 
-def encode_polyline(points: List[Tuple[float, float]]) -> str:
-    """Encodes a list of lat/lng points into a polyline string.
-
-    :param points: A list of tuples or lists containing latitude and longitude
-    :type points: list of tuples/lists
-
-    :rtype: string
-    """
-    result = []
-
-    prev_lat = 0
-    prev_lng = 0
-
-    for lat, lng in points:
-        lat = int(round(lat * 1e5))
-        lng = int(round(lng * 1e5))
-
-        d_lat = lat - prev_lat
-        d_lng = lng - prev_lng
-
-        prev_lat = lat
-        prev_lng = lng
-
-        for coord in [d_lat, d_lng]:
-            coord = ~(coord << 1) if coord < 0 else (coord << 1)
-
-            while coord >= 0x20:
-                result.append(chr((0x20 | (coord & 0x1f)) + 63))
-                coord >>= 5
-
-            result.append(chr(coord + 63))
-
-    return ''.join(result)
-
-
 def combine_route_info(route_data):
     total_distance = 0
     total_duration = 0
@@ -150,8 +119,8 @@ def combine_route_info(route_data):
     return  total_distance,  total_duration,  overview_polyline
 
 def get_route_info(start_location, end_location, start_time: datetime = datetime.now(), mode="driving"):
-    # Request directions via the Google Maps API
-    directions_result = gmaps.directions(start_location, end_location, mode=mode, departure_time=start_time)
+    # Request directions from the routing provider
+    directions_result = get_directions(start_location, end_location, mode=mode, departure_time=start_time)
 
     # Extract the route information
     total_distance, total_duration, overview_polyline = combine_route_info(directions_result)
@@ -0,0 +1,203 @@
+"""
+Offline all-pairs Jaccard similarity between the quadkey sets of trajectories.
+
+Trajectories are rows of a sparse trajectory x quadkey incidence matrix A, so A @ A.T holds the size of every pairwise
+intersection and |a| + |b| - |a & b| their union, the same value as support_func.jaccard_similarity on the sets.
+Rows are sorted by departure time and processed in blocks; each block is multiplied only with the trajectories
+departing within time_diff minutes of it, and the top k of each row is kept.
+
+    python -m process.trajectories.jaccard_batch --top-k 10 --time-diff 10 --block-size 2000
+"""
+from database import Database
+import argparse
+import resource
+import time as timer
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+TOPK_COLUMNS = ["traj_id", "match_traj_id", "rank", "similarity", "intersection", "union_size"]
+
+CREATE_TOPK_SQL = """
+    create table if not exists traj_jaccard_topk (
+        traj_id integer not null,
+        match_traj_id integer not null,
+        rank smallint not null,
+        similarity double precision not null,
+        intersection integer not null,
+        union_size integer not null,
+        primary key (traj_id, rank)
+    );
+    """
+
+# Both queries are read with a binary COPY, see Database.copy_columns: fixed width columns, no nulls
+LINK_QK_PAIRS_SQL = """
+    select distinct l.traj_id::bigint
+    , q.quadkey
+    from link_qk q
+        inner join link l
+            on l.link_id = q.link_id
+    where l.traj_id is not null and q.quadkey is not null
+    """
+
+# Seconds of the day of the departure, NaN when unknown
+DEPARTURES_SQL = """
+    select traj_id::bigint
+    , coalesce(extract(epoch from ts_ini::time)::float8, 'NaN')
+    from trajectory
+    """
+
+
+def build_incidence(traj_ids, quadkeys):
+    """
+    Binary trajectory x quadkey matrix from (traj_id, quadkey) pairs, e.g. the rows of link_qk or get_qk_line output
+    tagged with their trajectory. Duplicate pairs count once, as in a set.
+    :return: (csr matrix, array of the traj_id of each row)
+    """
+    row_ids, rows = np.unique(np.asarray(traj_ids, dtype=np.int64), return_inverse=True)
+    _, cols = np.unique(np.asarray(quadkeys, dtype=np.int64), return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                               shape=(len(row_ids), int(cols.max()) + 1 if len(cols) else 0))
+    # Duplicates were summed by the constructor, clip them back to a set
+    matrix.data[:] = 1
+    return matrix, row_ids
+
+
+def load_incidence():
+    """
+    Incidence matrix of the link_qk quadkey sets and the departure time of each row, in seconds of the day.
+    The pairs and the departures are streamed into NumPy arrays, see Database.copy_columns.
+    """
+    with Database() as db:
+        traj_ids, quadkeys = db.copy_columns(LINK_QK_PAIRS_SQL, ["i8", "i8"])
+        departure_ids, departure_seconds = db.copy_columns(DEPARTURES_SQL, ["i8", "f8"])
+    matrix, row_ids = build_incidence(traj_ids, quadkeys)
+    departure = np.full(len(row_ids), np.nan)
+    # row_ids is sorted, every trajectory id appears at most once
+    positions = np.searchsorted(row_ids, departure_ids)
+    found = positions < len(row_ids)
+    found[found] = row_ids[positions[found]] == departure_ids[found]
+    departure[positions[found]] = departure_seconds[found]
+    return matrix, row_ids, departure
+
+
+def matrix_bytes(matrix):
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def top_k_per_row(rows, ids, values, k):
+    """Positions of the k largest values of each row, for COO style arrays. Ties keep the smaller id first."""
+    order = np.lexsort((ids, -values, rows))
+    rows = rows[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(rows)) + 1]
+    group_start = np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+    rank = np.arange(len(rows)) - group_start
+    keep = rank < k
+    return order[keep], rank[keep]
+
+
+def all_pairs_topk(matrix, row_ids, departure, k=10, time_diff=10, block_size=2000, report=True):
+    """
+    Exact top k most similar trajectories of every row, among those departing within time_diff minutes.
+    Rows without a departure time are compared with every row.
+    :param matrix: binary csr incidence matrix, see build_incidence
+    :param row_ids: traj_id of each row
+    :param departure: departure time of each row in seconds of the day
+    :param k:
+    :param time_diff: minutes
+    :param block_size: rows multiplied at once, bounds the memory of the product
+    :param report: print the time and memory used by each block
+    :return: DataFrame with TOPK_COLUMNS
+    """
+    window = time_diff * 60
+    # Rows without a departure go first and are compared with everything
+    order = np.lexsort((row_ids, departure, ~np.isnan(departure)))
+    matrix = matrix[order].tocsr()
+    row_ids = np.asarray(row_ids)[order]
+    departure = np.asarray(departure)[order]
+    sizes = np.asarray(matrix.sum(axis=1)).ravel()
+    undated = int(np.isnan(departure).sum())
+    dated = departure[undated:]
+
+    frames = []
+    for start in range(0, matrix.shape[0], block_size):
+        started = timer.perf_counter()
+        stop = min(start + block_size, matrix.shape[0])
+        if start < undated:
+            columns = np.arange(matrix.shape[0])
+            others = matrix
+        else:
+            # The undated columns in front, and the dated ones departing within the window of the block
+            col_start = undated + int(np.searchsorted(dated, departure[start] - window, side='left'))
+            col_stop = undated + int(np.searchsorted(dated, departure[stop - 1] + window, side='right'))
+            columns = np.r_[np.arange(undated), np.arange(col_start, col_stop)]
+            others = sparse.vstack([matrix[:undated], matrix[col_start:col_stop]], format='csr') if undated else \
+                matrix[col_start:col_stop]
+
+        product = (matrix[start:stop] @ others.T).tocoo()
+        rows = product.row.astype(np.int64) + start
+        cols = columns[product.col]
+        intersection = product.data.astype(np.int64)
+        product_bytes = product.data.nbytes + product.row.nbytes + product.col.nbytes
+
+        keep = rows != cols
+        both_dated = ~np.isnan(departure[rows]) & ~np.isnan(departure[cols])
+        keep &= ~both_dated | (np.abs(departure[rows] - departure[cols]) <= window)
+        rows, cols, intersection = rows[keep], cols[keep], intersection[keep]
+
+        union = sizes[rows] + sizes[cols] - intersection
+        similarity = intersection / union
+        positions, rank = top_k_per_row(rows, row_ids[cols], similarity, k)
+        frames.append(pd.DataFrame({
+            "traj_id": row_ids[rows[positions]],
+            "match_traj_id": row_ids[cols[positions]],
+            "rank": rank + 1,
+            "similarity": similarity[positions],
+            "intersection": intersection[positions],
+            "union_size": union[positions],
+        }))
+
+        if report:
+            # ru_maxrss is in kilobytes on Linux
+            print("Block {}-{} of {}: {} columns, {} pairs, product {:.1f} MB, peak RSS {:.1f} MB, {:.2f}s".format(
+                start, stop, matrix.shape[0], len(columns), product.nnz, product_bytes / 2 ** 20,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, timer.perf_counter() - started))
+        del product
+
+    if not frames:
+        return pd.DataFrame(columns=TOPK_COLUMNS)
+    return pd.concat(frames, ignore_index=True)[TOPK_COLUMNS]
+
+
+def save_topk(df):
+    """Replace the content of traj_jaccard_topk with the result."""
+    with Database() as db, db.transaction():
+        db.execute_query(CREATE_TOPK_SQL)
+        db.execute_query("truncate traj_jaccard_topk")
+        db.copy_rows("traj_jaccard_topk", TOPK_COLUMNS, df.itertuples(index=False, name=None))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exact all-pairs Jaccard similarity of trajectory quadkey sets")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--time-diff", type=int, default=10, help="departure time tolerance in minutes")
+    parser.add_argument("--block-size", type=int, default=2000)
+    parser.add_argument("--output", help="also write the result to this CSV file")
+    parser.add_argument("--no-save", action="store_true", help="do not write the traj_jaccard_topk table")
+    args = parser.parse_args()
+
+    matrix, row_ids, departure = load_incidence()
+    print("Loaded {} trajectories, {} quadkeys, {} incidences ({:.1f} MB)".format(
+        matrix.shape[0], matrix.shape[1], matrix.nnz, matrix_bytes(matrix) / 2 ** 20))
+
+    df = all_pairs_topk(matrix, row_ids, departure, args.top_k, args.time_diff, args.block_size)
+    if args.output:
+        df.to_csv(args.output, index=False)
+    if not args.no_save:
+        save_topk(df)
+    print("Wrote {} pairs".format(len(df)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+from database import Database
+from process.trajectories.support_func import time_to_microseconds, haversine_distance_np, time_diff_seconds_np
+from datetime import datetime
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+
+# Link ids are reserved before the rows are committed, so a link can become visible after one with a larger id.
+# The ids below the largest one seen that are not in the table yet are read again on every refresh until they show
+# up, or for GAP_TIMEOUT seconds: the ids of a rolled back build never do.
+GAP_TIMEOUT = 900
+# Links are spread over the shards of a sharded index by their cell at this level
+SHARD_LEVEL = 14
+
+LINK_COLUMNS = ['user_id', 'traj_id', 'link_id', 'quadkey', 'ts_ini', 'ts_end', 'ini_lat', 'ini_lon']
+
+LOAD_LINKS_SQL = """
+    select
+    ini.user_id
+    ,l.traj_id
+    , l.link_id
+    , l.quadkey
+    , l.ts_ini
+    , l.ts_end
+    , ini.latitude as ini_lat
+    , ini.longitude as ini_lon
+    , (extract(epoch from l.ts_ini) * 1000000)::bigint as ts_us
+
+    from link  l
+        inner join custom_signal ini
+            on l.signal_ini = ini.signal_id
+    where (l.link_id > %s or l.link_id = any(%s::bigint[])) and l.quadkey is not null
+      and mod(l.quadkey >> %s, %s) = %s
+    """
+
+# Every committed id a refresh can see, whatever the shard, to tell the gaps from the links of other shards
+LINK_IDS_SQL = """
+    select link_id
+    from link
+    where link_id > %s or link_id = any(%s::bigint[])
+    """
+
+# Columns of the lookups: the links and the time of day of ts_ini in microseconds
+LOOKUP_COLUMNS = LINK_COLUMNS + ['ts_us']
+
+# Columns of the nearest link of each trajectory
+NEAREST_COLUMNS = ['user_id', 'traj_id', 'link_id', 'distance', 'time_diff', 'ts_ini']
+
+KEY_DTYPE = np.dtype([('quadkey', np.int64), ('link_id', np.int64)])
+
+
+def to_time(value):
+    return value.time() if isinstance(value, datetime) else value
+
+
+def nearest_links(df_traj, location, time_start, columns=NEAREST_COLUMNS):
+    """
+    Nearest link of each trajectory to the location, with its distance and its time difference to time_start.
+    Ties keep the first row of the trajectory.
+    """
+    if df_traj.empty:
+        return pd.DataFrame(columns=columns)
+
+    df_traj["distance"] = haversine_distance_np(location, df_traj["ini_lat"].to_numpy(), df_traj["ini_lon"].to_numpy())
+    df_traj["time_diff"] = time_diff_seconds_np(df_traj["ts_us"].to_numpy(), time_start)
+
+    # Find the minimum distance for each traj_id
+    min_distance_indices = df_traj.groupby('traj_id')['distance'].idxmin()
+    return df_traj.loc[min_distance_indices, columns]
+
+
+class LinkIndex:
+    """
+    In-process copy of the link table joined with the position of each link's first signal, the same rows
+    trajectories_cross_quad reads from the database.
+
+    Rows are kept sorted by level 20 quadint and link_id, so a quadkey range is found with two binary searches and then
+    filtered on the time of day of ts_ini, stored as integer microseconds so the comparison matches the SQL one exactly.
+    Readers take a snapshot of the current frame; writers build a new frame and swap it in under a lock.
+
+    With shards > 1 the index only holds the links whose SHARD_LEVEL cell id modulo shards is shard, see shard_pool.
+    """
+
+    def __init__(self, shard=0, shards=1):
+        self._lock = threading.Lock()
+        self.shard = shard
+        self.shards = shards
+        self._frame = self._sorted(pd.DataFrame(columns=LINK_COLUMNS))
+        self.max_link_id = 0
+        self._gaps = {}  # link id not committed yet -> monotonic time it was first missed
+        self.loaded = False
+
+    @staticmethod
+    def _sorted(df):
+        """The LINK_COLUMNS of df with ts_us, sorted by quadkey and link_id."""
+        ts_us = df['ts_us'].to_numpy() if 'ts_us' in df else None
+        df = df[LINK_COLUMNS].copy()
+        df['ts_ini'] = df['ts_ini'].map(to_time)
+        df['ts_end'] = df['ts_end'].map(to_time)
+        df['quadkey'] = df['quadkey'].astype(np.int64)
+        df['link_id'] = df['link_id'].astype(np.int64)
+        # Read along with the links, only the ones built in this process come without it
+        df['ts_us'] = ts_us.astype(np.int64) if ts_us is not None else \
+            np.fromiter((time_to_microseconds(t) for t in df['ts_ini']), dtype=np.int64, count=len(df))
+        return df.sort_values(['quadkey', 'link_id'], kind='stable').reset_index(drop=True)
+
+    @staticmethod
+    def _keys(df):
+        keys = np.empty(len(df), dtype=KEY_DTYPE)
+        keys['quadkey'] = df['quadkey'].to_numpy()
+        keys['link_id'] = df['link_id'].to_numpy()
+        return keys
+
+    def __len__(self):
+        return len(self._frame)
+
+    def load_params(self, min_link_id, gaps=()):
+        return [min_link_id, list(gaps), 2 * (20 - SHARD_LEVEL), self.shards, self.shard]
+
+    def update_gaps(self, link_ids, min_link_id, now=None):
+        """
+        Track the ids still expected after a read of the committed ids above min_link_id and in the gaps. Callers
+        read the ids before the links, so a link committed in between is read twice rather than missed.
+        """
+        link_ids = np.asarray(link_ids, dtype=np.int64)
+        now = time.monotonic() if now is None else now
+        top = max(min_link_id, int(link_ids.max()) if len(link_ids) else 0)
+        above = np.unique(link_ids[link_ids > min_link_id])
+        bounds = np.concatenate(([min_link_id], above))
+        # Ids missing between two consecutive committed ones
+        missing = [np.arange(lo + 1, hi, dtype=np.int64) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi - lo > 1]
+        missing = np.concatenate(missing) if missing else np.empty(0, dtype=np.int64)
+        committed = set(link_ids.tolist())
+        gaps = {link_id: first_missed for link_id, first_missed in self._gaps.items()
+                if link_id not in committed and now - first_missed < GAP_TIMEOUT}
+        gaps.update((link_id, now) for link_id in missing.tolist())
+        self._gaps = gaps
+        self.max_link_id = top
+
+    def read(self, min_link_id, gaps):
+        """The committed ids and the links of the shard above min_link_id or in gaps, None on a database error."""
+        with Database() as db:
+            link_ids = db.fetch_all(LINK_IDS_SQL, [min_link_id, gaps])
+            df = db.query_df(LOAD_LINKS_SQL, self.load_params(min_link_id, gaps))
+        if link_ids is None or df is None:
+            return None
+        return [row[0] for row in link_ids], df
+
+    def load(self):
+        """Load every link from the database, replacing the current content."""
+        result = self.read(0, [])
+        if result is None:
+            return
+        link_ids, df = result
+        with self._lock:
+            self._frame = self._sorted(df)
+            # Only the ids missed by the refreshes from here on are gaps, the holes of the table are not
+            self._gaps = {}
+            self.max_link_id = max(link_ids, default=0)
+            self.loaded = True
+        print("Link index loaded with {} links".format(len(df)))
+
+    def refresh(self):
+        """
+        Pull the links added by other processes since the last load or refresh: the ones above the largest id read so
+        far and the ones in the gaps below it.
+        :return: the links that were not in the index yet, None after a full load
+        """
+        if not self.loaded:
+            return self.load()
+        min_link_id, gaps = self.max_link_id, list(self._gaps)
+        result = self.read(min_link_id, gaps)
+        if result is None:
+            return None
+        link_ids, df = result
+        new_links = self.add_links(df)
+        with self._lock:
+            self.update_gaps(link_ids, min_link_id)
+        return new_links
+
+    def add_links(self, df):
+        """
+        Merge new links into the index. The frame must have the LINK_COLUMNS columns; links already in the index are
+        ignored so a refresh overlapping an incremental update is harmless.
+
+        Only the new rows are converted and sorted; they are then inserted at their binary searched positions, which
+        copies the columns once instead of sorting the whole frame again.
+        :return: the links that were added
+        """
+        if df.empty:
+            return df
+        new_rows = self._sorted(df.drop_duplicates('link_id'))
+        new_keys = self._keys(new_rows)
+        with self._lock:
+            frame = self._frame
+            keys = self._keys(frame)
+            positions = np.searchsorted(keys, new_keys)
+            # A link keeps its quadkey, so a link already in the index is found at its insertion position
+            known = np.zeros(len(new_rows), dtype=bool)
+            inside = positions < len(frame)
+            known[inside] = keys[positions[inside]] == new_keys[inside]
+            new_rows, positions = new_rows[~known], positions[~known]
+            if new_rows.empty:
+                return new_rows[LINK_COLUMNS]
+            self._frame = pd.DataFrame({column: np.insert(frame[column].to_numpy(), positions,
+                                                          new_rows[column].to_numpy())
+                                        for column in frame.columns})
+        return new_rows[LINK_COLUMNS].reset_index(drop=True)
+
+    def lookup(self, min_quadint, max_quadint, min_ts, max_ts):
+        """
+        Same result as CROSS_QUAD_SQL: links with min_quadint <= quadkey < max_quadint and min_ts <= ts_ini <= max_ts.
+        """
+        frame = self._frame
+        quadkeys = frame['quadkey'].to_numpy()
+        start = np.searchsorted(quadkeys, min_quadint, side='left')
+        stop = np.searchsorted(quadkeys, max_quadint, side='left')
+        candidates = frame.iloc[start:stop]
+
+        ts_us = candidates['ts_us'].to_numpy()
+        mask = (ts_us >= time_to_microseconds(min_ts)) & (ts_us <= time_to_microseconds(max_ts))
+        return candidates.loc[mask, LOOKUP_COLUMNS].reset_index(drop=True)
+
+    def nearest(self, quad_ranges, min_ts, max_ts, location, time_start):
+        """
+        Nearest link of each trajectory among the lookups of the quadint ranges, with its quadkey to break the ties
+        between the nearest links of several shards.
+        """
+        df = pd.concat([self.lookup(lo, hi, min_ts, max_ts) for lo, hi in quad_ranges or [(0, 0)]],
+                       ignore_index=True)
+        return nearest_links(df, location, time_start, NEAREST_COLUMNS + ['quadkey']).reset_index(drop=True)
+
+
+link_index = LinkIndex()
@@ -0,0 +1,121 @@
+from pyquadkey2 import quadkey
+from collections import OrderedDict
+import threading
+import time
+
+
+# Number of cached searches and seconds they stay valid. Invalidation by region keeps them exact; the TTL bounds how
+# long a search can miss links written by another worker before the link index refresh brings them in.
+MATCH_CACHE_SIZE = 1024
+MATCH_CACHE_TTL = 300
+
+
+def cell_region(cell: str):
+    """Region tag of a quadkey cell: its level and its key bits."""
+    level = len(cell)
+    return level, quadkey.from_str(cell).to_quadint() >> (64 - 2 * level)
+
+
+def link_regions(quadints, levels, base_level=20):
+    """Region tags at each of the levels of the cells containing the given base level link quadints."""
+    return {(level, int(quadint) >> (2 * (base_level - level))) for level in levels for quadint in quadints}
+
+
+class MatchCache:
+    """
+    LRU cache of search results with a time to live.
+
+    Each entry is tagged with the regions it depends on: the quadkey cells its scan covered. invalidate_links drops
+    every entry whose scanned cells contain one of the new links, so a cached result never misses a new commuter.
+    A search started before an invalidation is not stored, as it may have read the old links.
+    """
+
+    def __init__(self, maxsize=MATCH_CACHE_SIZE, ttl=MATCH_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, expires_at, regions)
+        self._keys_by_region = {}
+        self._levels = {}  # cell level -> number of entries tagged with it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, key):
+        _, _, regions = self._entries.pop(key)
+        for region in regions:
+            keys = self._keys_by_region.get(region)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_region[region]
+            self._levels[region[0]] -= 1
+            if not self._levels[region[0]]:
+                del self._levels[region[0]]
+
+    def get(self, key):
+        """The cached value, or None on a miss or when the entry expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                self._drop(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, regions, generation):
+        """
+        Store a value computed after reading the generation. It is discarded if an invalidation happened since.
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._drop(key)
+            regions = frozenset(regions)
+            self._entries[key] = (value, time.monotonic() + self.ttl, regions)
+            for region in regions:
+                self._keys_by_region.setdefault(region, set()).add(key)
+                self._levels[region[0]] = self._levels.get(region[0], 0) + 1
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _invalidate(self, regions):
+        """Must be called with the lock held."""
+        self.generation += 1
+        keys = set()
+        for region in regions:
+            keys |= self._keys_by_region.get(region, set())
+        for key in keys:
+            self._drop(key)
+        self.invalidations += len(keys)
+
+    def invalidate_links(self, quadints, base_level=20):
+        """Drop the entries whose scan covered one of the links, given as base level quadints."""
+        with self._lock:
+            self._invalidate(link_regions(quadints, list(self._levels), base_level))
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._keys_by_region.clear()
+            self._levels.clear()
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "invalidations": self.invalidations}
+
+
+match_cache = MatchCache()
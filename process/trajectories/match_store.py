@@ -0,0 +1,272 @@
+from database import Database, to_pg_array
+from database_async import AsyncDatabase
+from process.trajectories.matching_ver2 import (search_potential_similar_trajectories_by_users, quad_base_range,
+                                                USERS_ENDPOINTS_SQL)
+from pyquadkey2 import quadkey
+from collections import defaultdict
+from datetime import datetime, timezone
+import threading
+
+
+# Search parameters of the /match/user endpoints, the stored matches are computed with the same ones
+MATCH_LEVEL = 14
+MATCH_TIME_DIFF = 20
+# Number of matches kept per user, best score first
+MATCH_LIMIT = 50
+
+USER_MATCH_COLUMNS = ["user_id", "match_user_ids", "scores", "time_diffs", "computed_at"]
+
+CREATE_USER_MATCH_SQL = """
+    create table if not exists user_match (
+        user_id integer primary key,
+        match_user_ids integer[] not null,
+        scores double precision[] not null,
+        time_diffs double precision[] not null,
+        computed_at timestamptz not null
+    );
+    """
+
+LOAD_USER_MATCH_SQL = """
+    select user_id, match_user_ids, scores, time_diffs, computed_at
+    from user_match
+    """
+
+# The row of a user when it was stored after the given time, by another worker
+NEWER_USER_MATCH_SQL = """
+    select match_user_ids, scores, time_diffs, computed_at
+    from user_match
+    where user_id = %s and computed_at > %s
+    """
+
+OLDEST_USER_MATCH_SQL = """
+    select min(computed_at)
+    from user_match
+    """
+
+# Advisory lock held by the worker rebuilding the store, the others skip their rebuild
+REBUILD_LOCK = 7_265_031
+
+TRAJECTORY_USERS_SQL = """
+    select distinct user_id
+    from trajectory
+    """
+
+TRAJECTORY_LINK_QUADKEYS_SQL = """
+    select distinct quadkey
+    from link
+    where traj_id = %s and quadkey is not null
+    """
+
+
+def cell_prefix(cell: str, level=MATCH_LEVEL, base_level=20):
+    """The base level quadint of a cell shifted down to the cell's level, for comparing cells by integer."""
+    return quad_base_range(cell, base_level)[0] >> (2 * (base_level - level))
+
+
+def neighbour_prefixes(cell: str):
+    """Prefixes of the cell and its adjacent cells, the area the search scans around an endpoint."""
+    return {cell_prefix(str(neighbour)) for neighbour in quadkey.from_str(cell).nearby(1)}
+
+
+class MatchStore:
+    """
+    Precomputed top MATCH_LIMIT matches of every user with a trajectory, kept in the user_match table and in memory.
+
+    The whole store is recomputed by rebuild, run periodically in the background by one worker at a time. When a
+    trajectory is created, refresh_around recomputes only its owner and the users that may now match it, found through
+    the users indexed by the cell prefixes around their endpoints. Each entry carries the time it was computed;
+    get_async prefers the row of user_match when another worker stored a newer one. Readers take the entry from the
+    dict; writers swap entries in under a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # user_id -> (list of (match_user_id, score, time_diff), computed_at)
+        self._entries = {}
+        # user_id -> (start cell, end cell) at MATCH_LEVEL, used to find the users affected by a new trajectory
+        self._cells = {}
+        # cell prefix -> users with the prefix around their start, and around their end cell
+        self._start_users = defaultdict(set)
+        self._end_users = defaultdict(set)
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id: int):
+        """The (matches, computed_at) entry of the user, or None if it has not been computed."""
+        return self._entries.get(user_id)
+
+    async def get_async(self, user_id: int):
+        """
+        Like get, but reads the row of the user when it was stored after the entry in memory, by the refresh or the
+        rebuild of another worker, and keeps it.
+        """
+        entry = self._entries.get(user_id)
+        since = entry[1] if entry is not None else datetime.min.replace(tzinfo=timezone.utc)
+        async with AsyncDatabase() as db:
+            row = await db.fetch_one(NEWER_USER_MATCH_SQL, [user_id, since])
+        if row is None:
+            return entry
+        match_user_ids, scores, time_diffs, computed_at = row
+        entry = (list(zip(match_user_ids, scores, time_diffs)), computed_at)
+        with self._lock:
+            current = self._entries.get(user_id)
+            if current is None or current[1] < computed_at:
+                self._entries[user_id] = entry
+        return entry
+
+    def load(self):
+        """Create the user_match table if needed and load it, replacing the in-memory content."""
+        with Database() as db:
+            db.execute_query(CREATE_USER_MATCH_SQL)
+            rows = db.fetch_all(LOAD_USER_MATCH_SQL)
+            endpoints = db.fetch_all(USERS_ENDPOINTS_SQL, [[row[0] for row in rows or []]])
+        if rows is None:
+            return
+        entries = {user_id: (list(zip(match_user_ids, scores, time_diffs)), computed_at)
+                   for user_id, match_user_ids, scores, time_diffs, computed_at in rows}
+        with self._lock:
+            self._entries = entries
+            self._cells = {}
+            self._start_users, self._end_users = defaultdict(set), defaultdict(set)
+            self.set_cells(self.endpoint_cells(endpoints or []))
+            self.loaded = True
+        print("Match store loaded with {} users".format(len(entries)))
+
+    @staticmethod
+    def endpoint_cells(endpoints):
+        return {user_id: (str(quadkey.from_geo((start_lat, start_long), MATCH_LEVEL)),
+                          str(quadkey.from_geo((end_lat, end_long), MATCH_LEVEL)))
+                for user_id, start_lat, start_long, end_lat, end_long, _, _ in endpoints}
+
+    def set_cells(self, cells):
+        """Record the endpoint cells of users and index them by the prefixes around them. Callers hold the lock."""
+        for user_id, (start_cell, end_cell) in cells.items():
+            previous = self._cells.get(user_id)
+            if previous == (start_cell, end_cell):
+                continue
+            if previous is not None:
+                for prefix in neighbour_prefixes(previous[0]):
+                    self._start_users[prefix].discard(user_id)
+                for prefix in neighbour_prefixes(previous[1]):
+                    self._end_users[prefix].discard(user_id)
+            for prefix in neighbour_prefixes(start_cell):
+                self._start_users[prefix].add(user_id)
+            for prefix in neighbour_prefixes(end_cell):
+                self._end_users[prefix].add(user_id)
+            self._cells[user_id] = (start_cell, end_cell)
+
+    def compute(self, user_ids):
+        """Run the batch search for the users and keep their best MATCH_LIMIT matches."""
+        computed_at = datetime.now(timezone.utc)
+        entries = {}
+        for user_id, df in search_potential_similar_trajectories_by_users(user_ids, level=MATCH_LEVEL,
+                                                                          time_diff=MATCH_TIME_DIFF):
+            df = df[df["start_user_id"] != user_id].sort_values("score", kind="stable").head(MATCH_LIMIT)
+            time_diffs = df["start_time_diff"] + df["end_time_diff"]
+            entries[user_id] = (list(zip(df["start_user_id"].astype(int).tolist(), df["score"].astype(float).tolist(),
+                                         time_diffs.astype(float).tolist())), computed_at)
+        return entries
+
+    def save(self, db, entries):
+        db.copy_rows("user_match", USER_MATCH_COLUMNS,
+                     [(user_id,
+                       to_pg_array([match[0] for match in matches]),
+                       to_pg_array([match[1] for match in matches]),
+                       to_pg_array([match[2] for match in matches]),
+                       computed_at.isoformat())
+                      for user_id, (matches, computed_at) in entries.items()])
+
+    def rebuild(self, max_age=None):
+        """
+        Recompute the matches of every user with a trajectory and replace the table and the in-memory entries.
+        Entries refreshed by refresh_around while the rebuild was running are newer and are kept.
+
+        Only one worker rebuilds at a time. With max_age, the rebuild is skipped when every row of user_match is less
+        than max_age seconds old, i.e. another worker rebuilt the store meanwhile; get_async serves its rows.
+        :return: whether the store was rebuilt
+        """
+        with Database() as lock_db:
+            locked = lock_db.fetch_one("select pg_try_advisory_lock(%s)", [REBUILD_LOCK])
+            if not locked or not locked[0]:
+                return False
+            try:
+                oldest = lock_db.fetch_one(OLDEST_USER_MATCH_SQL) if max_age is not None else None
+                if oldest and oldest[0] is not None:
+                    if (datetime.now(timezone.utc) - oldest[0]).total_seconds() < max_age:
+                        return False
+                # The lock is held by the session, do not keep a transaction open during the rebuild
+                lock_db.commit()
+                self.rebuild_all()
+            finally:
+                lock_db.fetch_one("select pg_advisory_unlock(%s)", [REBUILD_LOCK])
+                lock_db.commit()
+        return True
+
+    def rebuild_all(self):
+        """Recompute every user, see rebuild."""
+        started = datetime.now(timezone.utc)
+        with Database() as db:
+            rows = db.fetch_all(TRAJECTORY_USERS_SQL) or []
+            user_ids = [row[0] for row in rows]
+            endpoints = db.fetch_all(USERS_ENDPOINTS_SQL, [user_ids]) or []
+
+        entries = self.compute(user_ids)
+
+        with Database() as db, db.transaction():
+            db.execute_query(CREATE_USER_MATCH_SQL)
+            db.execute_query("delete from user_match where computed_at < %s", [started])
+            newer = {row[0] for row in db.fetch_all("select user_id from user_match")}
+            self.save(db, {user_id: entry for user_id, entry in entries.items() if user_id not in newer})
+
+        with self._lock:
+            for user_id, entry in self._entries.items():
+                if entry[1] >= started:
+                    entries[user_id] = entry
+            self._entries = entries
+            self.set_cells(self.endpoint_cells(endpoints))
+            self.loaded = True
+        print("Match store rebuilt for {} users".format(len(entries)))
+
+    def refresh_users(self, user_ids):
+        """Recompute and store the matches of the given users."""
+        user_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+        if not user_ids:
+            return
+        with Database() as db:
+            endpoints = db.fetch_all(USERS_ENDPOINTS_SQL, [user_ids]) or []
+
+        entries = self.compute(user_ids)
+
+        with Database() as db, db.transaction():
+            db.execute_query("delete from user_match where user_id = ANY(%s)", [user_ids])
+            self.save(db, entries)
+
+        with self._lock:
+            self._entries = {**self._entries, **entries}
+            self.set_cells(self.endpoint_cells(endpoints))
+
+    def affected_users(self, traj_id: int):
+        """
+        Users whose stored matches may change because of the trajectory: the search only returns a trajectory when it
+        has links around both the start and the end cell of the user, so those are the users whose start and end
+        cells both border one of the trajectory's links. They are looked up by the prefixes of the links.
+        """
+        with Database() as db:
+            rows = db.fetch_all(TRAJECTORY_LINK_QUADKEYS_SQL, [traj_id]) or []
+        link_prefixes = {row[0] >> (2 * (20 - MATCH_LEVEL)) for row in rows}
+        if not link_prefixes:
+            return []
+
+        with self._lock:
+            starts = set().union(*(self._start_users.get(prefix, ()) for prefix in link_prefixes))
+            ends = set().union(*(self._end_users.get(prefix, ()) for prefix in link_prefixes))
+        return sorted(starts & ends)
+
+    def refresh_around(self, user_id: int, traj_id: int):
+        """Incremental update after a trajectory is created: recompute its owner and the users it may match."""
+        self.refresh_users([user_id] + self.affected_users(traj_id))
+
+
+match_store = MatchStore()
@@ -4,6 +4,8 @@ from itertools import pairwise
 from tqdm import tqdm
 
 from process.trajectories.support_func import haversine_distance,  tile_to_str, get_quad_int_range, jaccard_similarity
+from process.trajectories.minhash import minhash_lsh
+from datetime import timedelta
 import pandas as pd
 
 
@@ -17,9 +19,8 @@ def load_matching_links(traj_id: int, time_diff: int = 10):
     Returns:
 
     """
-    time_diff_seconds = time_diff * 60
+    window = timedelta(minutes=time_diff)
 
-    db = Database()
     sql = """
     select     q.link_id
     ,          q.quadkey
@@ -31,12 +32,13 @@ def load_matching_links(traj_id: int, time_diff: int = 10):
         ,          lk.ts_ini
         from       link_qk qk
         inner join link lk on lk.link_id = qk.link_id
-        where      lk.traj_id = ?
+        where      lk.traj_id = %s
     ) x on x.quadkey = q.quadkey
-    where l.ts_ini - x.ts_ini < ? and l.ts_ini - x.ts_ini > -? ;
+    where l.ts_ini - x.ts_ini < %s and l.ts_ini - x.ts_ini > -%s ;
     """
 
-    traj_df = db.query_df(sql, [traj_id, time_diff_seconds, time_diff_seconds])
+    with Database() as db:
+        traj_df = db.query_df(sql, [traj_id, window, window])
     return traj_df
 
 
@@ -51,18 +53,27 @@ def load_match_trajectories(traj_id: int, top: int = 0.05, time_diff: int = 10):
     :return:
     """
     df = load_matching_links(traj_id, time_diff)
-    trajectories = df["traj_id"].unique()
-    original_set = set(df["quadkey"].unique())
-    df = df[df["traj_id"] != traj_id]
+    trajectories = df.loc[df["traj_id"] != traj_id, "traj_id"].unique().tolist()
+    # The whole quadkey set of each trajectory is needed for the union, not only the quadkeys shared with this one
+    sets = minhash_lsh.quadkey_sets([traj_id] + trajectories)
+    original_set = sets.get(traj_id, set())
     traj_df = pd.DataFrame(trajectories, columns=["traj_id"])
-    traj_df["similarity"] = traj_df["traj_id"].apply(
-        lambda x: jaccard_similarity(original_set, set(df[df["traj_id"] == x]["quadkey"].values)))
+    traj_df["similarity"] = [jaccard_similarity(original_set, sets.get(x, set())) for x in trajectories]
 
     traj_df["percent_rank"] = traj_df["similarity"].rank(pct=True)
     filtered_df = traj_df[traj_df["percent_rank"] > (1.0 - top)]
     return filtered_df["traj_id"].values
 
 
+def search_similar_trajectories_lsh(traj_id: int, k: int = 10, time_diff: int = 10, exact: bool = False):
+    """
+    Top k trajectories with the most similar quadkey sets, found through the MinHash LSH index instead of comparing
+    with every trajectory sharing a quadkey like load_match_trajectories.
+    :return: DataFrame of traj_id and estimated_similarity, plus the exact similarity when exact is set
+    """
+    return minhash_lsh.query(traj_id, k, time_diff, exact)
+
+
 def adjacent_quadkeys(loc, quad_level=19, adjacent_level=1):
     """
     Get the adjacent quadkeys of the given location base on the quad_level.
@@ -1,10 +1,119 @@
 from database import Database
+from database_async import AsyncDatabase
 from pyquadkey2 import quadkey
+from process.trajectories.link_index import link_index, nearest_links
+from process.trajectories.shard_pool import shard_pool
+from process.trajectories.match_cache import match_cache, cell_region
+from process.trajectories.pyramid import pyramid_levels, pyramid_column, cell_id
 from process.trajectories.support_func import haversine_distance,  tile_to_str, get_quad_int_range, jaccard_similarity
+from process.trajectories.support_func import time_to_microseconds
 import pandas as pd
+import numpy as np
+import asyncio
 from datetime import datetime, timedelta, time
 
 
+CROSS_QUAD_SQL = """
+    select 
+    ini.user_id
+    ,l.traj_id
+    , l.link_id
+    , l.quadkey
+    , l.ts_ini
+    , l.ts_end
+    , ini.latitude as ini_lat
+    , ini.longitude as ini_lon
+    , (extract(epoch from l.ts_ini) * 1000000)::bigint as ts_us
+
+    from link  l
+        inner join custom_signal ini
+            on l.signal_ini = ini.signal_id
+    where quadkey >= %s and quadkey < %s and ts_ini >= %s and ts_ini <= %s
+    """
+
+# Same rows as CROSS_QUAD_SQL for a set of disjoint [min_quadint, max_quadint) ranges in one query
+CROSS_QUAD_RANGES_SQL = """
+    select 
+    ini.user_id
+    ,l.traj_id
+    , l.link_id
+    , l.quadkey
+    , l.ts_ini
+    , l.ts_end
+    , ini.latitude as ini_lat
+    , ini.longitude as ini_lon
+    , (extract(epoch from l.ts_ini) * 1000000)::bigint as ts_us
+
+    from unnest(%s::bigint[], %s::bigint[]) as r(min_quadint, max_quadint)
+        inner join link  l
+            on l.quadkey >= r.min_quadint and l.quadkey < r.max_quadint
+        inner join custom_signal ini
+            on l.signal_ini = ini.signal_id
+    where ts_ini >= %s and ts_ini <= %s
+    """
+
+# Same rows as CROSS_QUAD_RANGES_SQL for a set of cells of one pyramid level, as an equality lookup on its
+# qk_<level> column. Formatted with the column name, which comes from the configured levels only.
+CROSS_QUAD_CELLS_SQL = """
+    select 
+    ini.user_id
+    ,l.traj_id
+    , l.link_id
+    , l.quadkey
+    , l.ts_ini
+    , l.ts_end
+    , ini.latitude as ini_lat
+    , ini.longitude as ini_lon
+    , (extract(epoch from l.ts_ini) * 1000000)::bigint as ts_us
+
+    from link  l
+        inner join custom_signal ini
+            on l.signal_ini = ini.signal_id
+    where l.{column} = ANY(%s) and ts_ini >= %s and ts_ini <= %s
+    """
+
+USERS_ENDPOINTS_SQL = """
+            SELECT DISTINCT ON (t.user_id) t.user_id
+         , ini.latitude AS ini_lat
+         , ini.longitude AS ini_lon
+         , "end".latitude AS end_lat
+         , "end".longitude AS end_lon
+         , CAST(ini.time_stamp AS time) AS start_time
+         , CAST("end".time_stamp AS time) AS end_time
+        FROM trajectory t
+        INNER JOIN custom_signal ini
+            ON t.ts_ini = CAST(ini.time_stamp AS time)
+            AND t.user_id = ini.user_id
+        INNER JOIN custom_signal "end"
+            ON t.ts_end = CAST("end".time_stamp AS time)
+            AND t.user_id = "end".user_id
+        WHERE t.user_id = ANY(%s)
+        ORDER BY t.user_id
+
+    """
+
+# Minutes of the time of day buckets the cached cell scans are keyed by
+TIME_BUCKET = 5
+
+USER_ENDPOINTS_SQL = """
+            SELECT ini.latitude AS ini_lat
+         , ini.longitude AS ini_lon
+         , "end".latitude AS end_lat
+         , "end".longitude AS end_lon
+         , CAST(ini.time_stamp AS time) AS start_time
+         , CAST("end".time_stamp AS time) AS end_time
+        FROM trajectory t
+        INNER JOIN custom_signal ini
+            ON t.ts_ini = CAST(ini.time_stamp AS time)
+            AND t.user_id = ini.user_id
+        INNER JOIN custom_signal "end"
+            ON t.ts_end = CAST("end".time_stamp AS time)
+            AND t.user_id = "end".user_id
+        WHERE t.user_id = %s
+
+    """
+
+
 def adjacent_quadkeys(loc, quad_level=19, adjacent_level=1):
     """
     Get the adjacent quadkeys of the given location base on the quad_level.
@@ -34,8 +143,6 @@ taking
     min_quadint, max_quadint = min_quadint >> shift, max_quadint >> shift
     min_ts, max_ts = timestamp - timedelta(minutes=time_diff), timestamp + timedelta(minutes=time_diff)
     min_ts_time, max_ts_time = min_ts.time(), max_ts.time()
-    db = Database()
-    db.connect()
     sql = """
         select l.traj_id
         , l.quadkey
@@ -44,8 +151,8 @@ taking
         where quadkey >= %s and quadkey < %s and ts_ini >= %s and ts_ini <= %s
     """
 
-    df = db.query_df(sql, [min_quadint, max_quadint, min_ts_time, max_ts_time])
-    db.close_connection()
+    with Database() as db:
+        df = db.query_df(sql, [min_quadint, max_quadint, min_ts_time, max_ts_time])
     return df
 
 
@@ -58,61 +165,222 @@ def trajectories_cross_df(df_traj, location, time_start):
     :param time_start:
     :return:
     """
-    if df_traj.empty:
-        return pd.DataFrame(columns=['user_id', 'traj_id', 'link_id', 'distance', 'time_diff', 'ts_ini'])
+    return nearest_links(df_traj, location, time_start)
+
+
+def time_window(timestamp, time_diff: int = 10):
+    """
+    Time of day window of time_diff minutes around the timestamp.
+    """
+    timestamp_datetime = datetime.combine(datetime.today(), timestamp)
+    min_ts, max_ts = timestamp_datetime - timedelta(minutes=time_diff), timestamp_datetime + timedelta(minutes=time_diff)
+    return min_ts.time(), max_ts.time()
+
+
+def quad_base_range(quad: str, base_level=20):
+    """
+    The [min_quadint, max_quadint) range of base level quadints covered by the quadkey.
+    """
+    shift = 64 - 2 * base_level
+    min_quadint, max_quadint = get_quad_int_range(quad)
+    return min_quadint >> shift, max_quadint >> shift
+
+
+def cross_quad_params(quad: str, timestamp, time_diff: int = 10, base_level=20):
+    """
+    Build the query parameters of CROSS_QUAD_SQL: the base level quadint range covered by the quadkey and the
+    time of day window around the timestamp.
+    """
+    min_quadint, max_quadint = quad_base_range(quad, base_level)
+    min_ts_time, max_ts_time = time_window(timestamp, time_diff)
+    return [min_quadint, max_quadint, min_ts_time, max_ts_time]
+
+
+def plan_quad_ranges(quads, base_level=20):
+    """
+    Turn a set of quadkeys into the smallest list of disjoint base level [min_quadint, max_quadint) ranges.
+    Neighbouring quadkeys are often consecutive in quadint order, so their ranges are merged when they overlap or touch.
+    :param quads: quadkey strings, e.g. the output of adjacent_quadkeys
+    :param base_level:
+    :return: sorted list of (min_quadint, max_quadint)
+    """
+    ranges = sorted(quad_base_range(quad, base_level) for quad in set(quads))
+
+    merged = []
+    for min_quadint, max_quadint in ranges:
+        if max_quadint <= min_quadint:
+            # The last quadkey of a level has no successor, its range wraps around
+            continue
+        if merged and min_quadint <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], max_quadint)
+        else:
+            merged.append([min_quadint, max_quadint])
+    return [tuple(quad_range) for quad_range in merged]
+
+
+def cross_quad_ranges_params(quad_ranges, min_ts_time, max_ts_time):
+    """
+    Build the query parameters of CROSS_QUAD_RANGES_SQL.
+    """
+    return [[int(lo) for lo, _ in quad_ranges], [int(hi) for _, hi in quad_ranges], min_ts_time, max_ts_time]
+
+
+def lookup_quad_ranges(quad_ranges, min_ts_time, max_ts_time):
+    """
+    Read the links crossing the ranges from the in-memory link index, as one frame.
+    """
+    frames = [link_index.lookup(lo, hi, min_ts_time, max_ts_time) for lo, hi in quad_ranges]
+    return pd.concat(frames, ignore_index=True) if frames else link_index.lookup(0, 0, min_ts_time, max_ts_time)
 
-    if isinstance(time_start, time):
-        time_start = datetime.combine(datetime.today(), time_start)
-    df_traj["distance"] = df_traj.apply(lambda x: haversine_distance(location, (x["ini_lat"], x["ini_lon"])), axis=1)
-    df_traj["time_diff"] = df_traj.apply(lambda x: abs((datetime.combine(datetime.today(), x["ts_ini"]) - time_start).total_seconds()), axis=1)
 
-    # Find the minimum distance for each traj_id
-    min_distance_indices = df_traj.groupby('traj_id')['distance'].idxmin()
-    nearest_links = df_traj.loc[min_distance_indices, ['user_id', 'traj_id', 'link_id', 'distance', 'time_diff', 'ts_ini']]
+def bucket_window(timestamp, time_diff: int = 10, bucket: int = TIME_BUCKET):
+    """
+    The start of the time bucket holding the timestamp and the time of day window covering the windows of every
+    timestamp in the bucket. None when that window wraps around midnight.
+    """
+    minutes = (timestamp.hour * 60 + timestamp.minute) // bucket * bucket
+    bucket_start = time(minutes // 60, minutes % 60)
+    bucket_end = (datetime.combine(datetime.today(), bucket_start) + timedelta(minutes=bucket)).time()
+    min_ts_time, first_max = time_window(bucket_start, time_diff)
+    last_min, max_ts_time = time_window(bucket_end, time_diff)
+    if min_ts_time > first_max or last_min > max_ts_time or bucket_end < bucket_start:
+        return None
+    return bucket_start, (min_ts_time, max_ts_time)
 
-    return nearest_links
+
+def cell_scan_key(cell: str, timestamp, time_diff: int = 10, base_level=20):
+    """
+    Cache key, time window and region tags of the scan of a cell and its adjacent cells, or None if it is not cached.
+    """
+    window = bucket_window(timestamp, time_diff)
+    if window is None:
+        return None
+    bucket_start, (min_ts_time, max_ts_time) = window
+    neighbours = [str(quad) for quad in quadkey.from_str(cell).nearby(1)]
+    key = ("cell", cell, bucket_start, time_diff, base_level)
+    return key, neighbours, min_ts_time, max_ts_time
+
+
+def search_adjacent_quadkeys_cached(location, timestamp, level=18, time_diff: int = 10, base_level=20):
+    """
+    Same result as search_adjacent_quadkeys. The scan of the cell is cached for the whole time bucket of the
+    timestamp, keyed by cell, bucket and time_diff, and narrowed to the window of the timestamp.
+    """
+    cell = str(quadkey.from_geo(location, level))
+    scan = cell_scan_key(cell, timestamp, time_diff, base_level)
+    if scan is None:
+        return search_adjacent_quadkeys(location, timestamp, level, time_diff, base_level)
+
+    key, neighbours, min_ts_time, max_ts_time = scan
+    df = match_cache.get(key)
+    if df is None:
+        generation = match_cache.generation
+        df = read_quad_cells(neighbours, min_ts_time, max_ts_time, base_level)
+        match_cache.put(key, df, [cell_region(neighbour) for neighbour in neighbours], generation)
+    return links_in_window(df, timestamp, time_diff)
+
+
+async def search_adjacent_quadkeys_cached_async(location, timestamp, level=18, time_diff: int = 10, base_level=20):
+    """
+    Async version of search_adjacent_quadkeys_cached.
+    """
+    cell = str(quadkey.from_geo(location, level))
+    scan = cell_scan_key(cell, timestamp, time_diff, base_level)
+    if scan is None:
+        return await search_adjacent_quadkeys_async(location, timestamp, level, time_diff, base_level)
+
+    key, neighbours, min_ts_time, max_ts_time = scan
+    df = match_cache.get(key)
+    if df is None:
+        generation = match_cache.generation
+        df = await read_quad_cells_async(neighbours, min_ts_time, max_ts_time, base_level)
+        match_cache.put(key, df, [cell_region(neighbour) for neighbour in neighbours], generation)
+    return links_in_window(df, timestamp, time_diff)
+
+
+def cross_quad_cells_query(cells, min_ts_time, max_ts_time, base_level=20):
+    """
+    Query and parameters reading the links in the cells within the time of day window: an equality lookup on the
+    qk_<level> column when the cells are all of one pyramid level, otherwise a scan of their merged quadint ranges.
+    """
+    cells = [str(cell) for cell in cells]
+    levels = {len(cell) for cell in cells}
+    if len(levels) == 1 and base_level == 20 and levels <= set(pyramid_levels()):
+        query = CROSS_QUAD_CELLS_SQL.format(column=pyramid_column(levels.pop()))
+        return query, [sorted({cell_id(cell) for cell in cells}), min_ts_time, max_ts_time]
+    return CROSS_QUAD_RANGES_SQL, cross_quad_ranges_params(plan_quad_ranges(cells, base_level), min_ts_time, max_ts_time)
+
+
+def read_quad_cells(cells, min_ts_time, max_ts_time, base_level=20):
+    """
+    Read the links in the cells within the time of day window, from the link index shards when they are started or
+    the link index once it is loaded, otherwise with one query using the coarse cell columns when possible.
+    """
+    if shard_pool.started:
+        return shard_pool.lookup([(plan_quad_ranges([str(cell) for cell in cells], base_level), min_ts_time,
+                                   max_ts_time)])[0]
+    if link_index.loaded:
+        return lookup_quad_ranges(plan_quad_ranges([str(cell) for cell in cells], base_level), min_ts_time, max_ts_time)
+
+    with Database() as db:
+        df = db.query_df(*cross_quad_cells_query(cells, min_ts_time, max_ts_time, base_level))
+    return df.reset_index(drop=True)
+
+
+async def read_quad_cells_async(cells, min_ts_time, max_ts_time, base_level=20):
+    """
+    Async version of read_quad_cells.
+    """
+    if shard_pool.started:
+        frames = await shard_pool.lookup_async([(plan_quad_ranges([str(cell) for cell in cells], base_level),
+                                                 min_ts_time, max_ts_time)])
+        return frames[0]
+    if link_index.loaded:
+        return lookup_quad_ranges(plan_quad_ranges([str(cell) for cell in cells], base_level), min_ts_time, max_ts_time)
+
+    async with AsyncDatabase() as db:
+        df = await db.query_df(*cross_quad_cells_query(cells, min_ts_time, max_ts_time, base_level))
+    return df.reset_index(drop=True)
+
+
+def read_quad_cells_many(lookups, base_level=20):
+    """
+    read_quad_cells for a list of (cells, min_ts_time, max_ts_time) lookups. With the link index shards started, the
+    lookups of every shard are sent at once and run in parallel.
+    :return: list of frames, one per lookup
+    """
+    if shard_pool.started:
+        return shard_pool.lookup([(plan_quad_ranges([str(cell) for cell in cells], base_level), min_ts_time,
+                                   max_ts_time) for cells, min_ts_time, max_ts_time in lookups])
+    return [read_quad_cells(cells, min_ts_time, max_ts_time, base_level) for cells, min_ts_time, max_ts_time in lookups]
 
 
 def trajectories_cross_quad(quad: str, timestamp, time_diff: int = 10, base_level=20):
     """
     Search all the trajectories that cross the quadkey.
-
+    Served from the in-memory link index once it is loaded, otherwise from the database.
     """
-    time_diff_seconds = time_diff * 60
-    shift = 64 - 2 * base_level
-    min_quadint, max_quadint = get_quad_int_range(quad)
-    min_quadint, max_quadint = min_quadint >> shift, max_quadint >> shift
-    timestamp_datetime = datetime.combine(datetime.today(), timestamp)
-    min_ts, max_ts = timestamp_datetime - timedelta(minutes=time_diff), timestamp_datetime + timedelta(minutes=time_diff)
-    min_ts_time, max_ts_time = min_ts.time(), max_ts.time()
-    db = Database()
-    db.connect()
-    sql = """
-    select 
-    ini.user_id
-    ,l.traj_id
-    , l.link_id
-    , l.quadkey
-    , l.ts_ini
-    , l.ts_end
-    , ini.latitude as ini_lat
-    , ini.longitude as ini_lon
+    if link_index.loaded:
+        return link_index.lookup(*cross_quad_params(quad, timestamp, time_diff, base_level))
 
-    from link  l
-        inner join custom_signal ini
-            on l.signal_ini = ini.signal_id
-    where quadkey >= %s and quadkey < %s and ts_ini >= %s and ts_ini <= %s
+    return read_quad_cells([quad], *time_window(timestamp, time_diff), base_level)
+
+
+async def trajectories_cross_quad_async(quad: str, timestamp, time_diff: int = 10, base_level=20):
     """
+    Async version of trajectories_cross_quad.
+    """
+    if link_index.loaded:
+        return link_index.lookup(*cross_quad_params(quad, timestamp, time_diff, base_level))
 
-    df = db.query_df(sql, [min_quadint, max_quadint, min_ts_time, max_ts_time])
-    db.close_connection()
-    return df
+    return await read_quad_cells_async([quad], *time_window(timestamp, time_diff), base_level)
 
 
 def search_adjacent_quadkeys(location, timestamp, level=18, time_diff: int = 10, base_level=20):
     """
     Convert the location to quadkey and find all the trajectories that cross the quadkey and the adjacent quadkeys.
     This function have the same functionality as quad_cross_trajectories but with different input and output.
+    The quadkeys are read in a single query or lookup, see read_quad_cells.
     :param location:
     :param timestamp:
     :param level:
@@ -120,13 +388,24 @@ def search_adjacent_quadkeys(location, timestamp, level=18, time_diff: int = 10,
     :param base_level:
     :return:
     """
-    search_quads = adjacent_quadkeys(location, level)
-    df = pd.DataFrame()
-    for quad in search_quads:
-        df1 = trajectories_cross_quad(quad, timestamp, time_diff, base_level)
-        df = pd.concat([df, df1])
+    return read_quad_cells(adjacent_quadkeys(location, level), *time_window(timestamp, time_diff), base_level)
 
-    return df.reset_index(drop=True)
+
+async def search_adjacent_quadkeys_async(location, timestamp, level=18, time_diff: int = 10, base_level=20):
+    """
+    Async version of search_adjacent_quadkeys.
+    """
+    return await read_quad_cells_async(adjacent_quadkeys(location, level), *time_window(timestamp, time_diff),
+                                       base_level)
+
+
+def nearest_search(location, timestamp, level=18, time_diff: int = 10, base_level=20):
+    """
+    The (quad_ranges, min_ts_time, max_ts_time, location, time_start) search of shard_pool.nearest around the
+    location, on the cells of search_adjacent_quadkeys.
+    """
+    return (plan_quad_ranges(adjacent_quadkeys(location, level), base_level), *time_window(timestamp, time_diff),
+            location, timestamp)
 
 
 def score_algorithm(df):
@@ -152,12 +431,54 @@ def search_potential_similar_trajectories(start_lat, start_long, end_lat, end_lo
     :param time_diff:
     :return:
     """
-    df_start = search_adjacent_quadkeys((start_lat, start_long), start_time, level, time_diff)
-    df_traj_start = trajectories_cross_df(df_start, (start_lat, start_long), start_time)
-    df_traj_start = df_traj_start.add_prefix("start_")
+    if shard_pool.started:
+        near_start, near_end = shard_pool.nearest([
+            nearest_search((start_lat, start_long), start_time, level, time_diff),
+            nearest_search((end_lat, end_long), end_time, level, time_diff),
+        ])
+        return merge_nearest_links(near_start, near_end)
+
+    df_start = search_adjacent_quadkeys_cached((start_lat, start_long), start_time, level, time_diff)
+    df_end = search_adjacent_quadkeys_cached((end_lat, end_long), end_time, level, time_diff)
+
+    return merge_start_end_links(df_start, df_end, (start_lat, start_long), (end_lat, end_long), start_time, end_time)
+
+
+async def search_potential_similar_trajectories_async(start_lat, start_long, end_lat, end_long, start_time, end_time,
+                                                      level=18, time_diff=10):
+    """
+    Async version of search_potential_similar_trajectories. The start and end searches run concurrently.
+    """
+    if shard_pool.started:
+        near_start, near_end = await shard_pool.nearest_async([
+            nearest_search((start_lat, start_long), start_time, level, time_diff),
+            nearest_search((end_lat, end_long), end_time, level, time_diff),
+        ])
+        return merge_nearest_links(near_start, near_end)
 
-    df_end = search_adjacent_quadkeys((end_lat, end_long), end_time, level, time_diff)
-    df_traj_end = trajectories_cross_df(df_end, (end_lat, end_long), end_time)
+    df_start, df_end = await asyncio.gather(
+        search_adjacent_quadkeys_cached_async((start_lat, start_long), start_time, level, time_diff),
+        search_adjacent_quadkeys_cached_async((end_lat, end_long), end_time, level, time_diff),
+    )
+
+    return merge_start_end_links(df_start, df_end, (start_lat, start_long), (end_lat, end_long), start_time, end_time)
+
+
+def merge_start_end_links(df_start, df_end, start_location, end_location, start_time, end_time):
+    """
+    Keep the nearest link of each trajectory around the start and the end location and join both sides on traj_id.
+    Only the trajectories that pass the start before the end are returned.
+    """
+    return merge_nearest_links(trajectories_cross_df(df_start, start_location, start_time),
+                               trajectories_cross_df(df_end, end_location, end_time))
+
+
+def merge_nearest_links(df_traj_start, df_traj_end):
+    """
+    Join the nearest links of each trajectory around the start and the end location on traj_id.
+    Only the trajectories that pass the start before the end are returned.
+    """
+    df_traj_start = df_traj_start.add_prefix("start_")
     df_traj_end = df_traj_end.add_prefix("end_")
 
     df_final = pd.merge(df_traj_start, df_traj_end, left_on="start_traj_id", right_on="end_traj_id", how="inner")
@@ -181,32 +502,120 @@ def search_potential_similar_trajectories_by_user(user_id: int, level=16, time_d
     :param score:
     :return:
     """
-    db = Database()
-    db.connect()
-    sql = """
-            SELECT ini.latitude AS ini_lat
-         , ini.longitude AS ini_lon
-         , "end".latitude AS end_lat
-         , "end".longitude AS end_lon
-         , CAST(ini.time_stamp AS time) AS start_time
-         , CAST("end".time_stamp AS time) AS end_time
-        FROM trajectory t
-        INNER JOIN custom_signal ini
-            ON t.ts_ini = CAST(ini.time_stamp AS time)
-            AND t.user_id = ini.user_id
-        INNER JOIN custom_signal "end"
-            ON t.ts_end = CAST("end".time_stamp AS time)
-            AND t.user_id = "end".user_id
-        WHERE t.user_id = %s
-
-    """
-
-    start_lat, start_long, end_lat, end_long, start_time, end_time = db.fetch_one(sql, [user_id])
+    with Database() as db:
+        start_lat, start_long, end_lat, end_long, start_time, end_time = db.fetch_one(USER_ENDPOINTS_SQL, [user_id])
 
     df_final = search_potential_similar_trajectories(start_lat, start_long, end_lat, end_long, start_time, end_time,
                                                      level, time_diff)
-    df_final = df_final[df_final["start_traj_id"] != user_id]
-    df_final["score"] = df_final.apply(score, axis=1)
+    return rank_matches(df_final, user_id, score)
+
+
+def rank_matches(df_final, user_id: int, score=score_algorithm):
+    """
+    Drop the requester and rank the remaining trajectories by the score function, lowest score first.
+    The score function is applied to whole columns, like score_algorithm.
+    """
+    df_final = df_final[df_final["start_traj_id"] != user_id].copy()
+    df_final["score"] = score(df_final)
     df_final["rank"] = df_final["score"].rank(ascending=True)
     return df_final
 
+
+def search_potential_similar_trajectories_by_users(user_ids, level=16, time_diff: int = 10, score=score_algorithm,
+                                                   chunk_size: int = 500, base_level=20):
+    """
+    Batch version of search_potential_similar_trajectories_by_user for many users at once.
+    The endpoints of all users are fetched in one query. Users are then sorted by start cell and time and processed in
+    chunks: within a chunk every distinct cell and time bucket is scanned once, with the window covering the bucket as
+    in the cached single user search (see cell_scan_key), and each user's rows are filtered from that scan. A scan
+    never covers more than one bucket of windows, and only one chunk of scans is held in memory at a time.
+
+    :param user_ids:
+    :param level:
+    :param time_diff:
+    :param score:
+    :param chunk_size: number of users processed per chunk
+    :param base_level:
+    :return: generator of (user_id, df) in cell order, with the same frame as the single user search.
+             Users without a trajectory get an empty frame.
+    """
+    user_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+    with Database() as db:
+        rows = db.fetch_all(USERS_ENDPOINTS_SQL, [user_ids]) or []
+
+    empty = rank_matches(merge_start_end_links(pd.DataFrame(), pd.DataFrame(), None, None, None, None), -1, score)
+    found = set()
+    searches = []
+    for user_id, start_lat, start_long, end_lat, end_long, start_time, end_time in rows:
+        found.add(user_id)
+        start_cell = str(quadkey.from_geo((start_lat, start_long), level))
+        end_cell = str(quadkey.from_geo((end_lat, end_long), level))
+        searches.append((start_cell, end_cell, user_id, (start_lat, start_long), (end_lat, end_long),
+                         start_time, end_time))
+
+    for user_id in user_ids:
+        if user_id not in found:
+            yield user_id, empty.copy()
+
+    searches.sort(key=lambda search: (search[0], search[5], search[1]))
+    for chunk_start in range(0, len(searches), chunk_size):
+        chunk = searches[chunk_start:chunk_start + chunk_size]
+
+        if shard_pool.started:
+            # The shards return the nearest links of each endpoint, with the user's own window
+            nearest = shard_pool.nearest([
+                nearest_search(location, timestamp, level, time_diff, base_level)
+                for _, _, _, start_location, end_location, start_time, end_time in chunk
+                for location, timestamp in ((start_location, start_time), (end_location, end_time))])
+            for position, (_, _, user_id, _, _, _, _) in enumerate(chunk):
+                df_final = merge_nearest_links(nearest[2 * position], nearest[2 * position + 1])
+                yield user_id, rank_matches(df_final, user_id, score)
+            continue
+
+        # One scan per cell and time bucket needed by the chunk
+        scans = {}
+        user_scans = []
+        for start_cell, end_cell, _, _, _, start_time, end_time in chunk:
+            keys = []
+            for cell, timestamp in ((start_cell, start_time), (end_cell, end_time)):
+                scan = batch_scan_key(cell, timestamp, time_diff, base_level)
+                if scan is not None:
+                    scans.setdefault(scan[0], scan[1:])
+                keys.append(scan[0] if scan is not None else None)
+            user_scans.append(keys)
+
+        frames = read_quad_cells_many(list(scans.values()), base_level)
+        scan_links = dict(zip(scans, frames))
+
+        for (start_key, end_key), (_, _, user_id, start_location, end_location, start_time, end_time) in \
+                zip(user_scans, chunk):
+            df_start = links_in_window(scan_links.get(start_key), start_time, time_diff)
+            df_end = links_in_window(scan_links.get(end_key), end_time, time_diff)
+            df_final = merge_start_end_links(df_start, df_end, start_location, end_location, start_time, end_time)
+            yield user_id, rank_matches(df_final, user_id, score)
+
+
+def batch_scan_key(cell: str, timestamp, time_diff: int = 10, base_level=20):
+    """
+    Key, cells and time window of the batch scan serving a user's cell and timestamp: the scan of its cell_scan_key
+    time bucket, or of the user's own window when the bucket's window wraps around midnight. None when the user's own
+    window wraps, it never matches, like in the single user search.
+    """
+    scan = cell_scan_key(cell, timestamp, time_diff, base_level)
+    if scan is not None:
+        return scan
+    min_ts_time, max_ts_time = time_window(timestamp, time_diff)
+    if min_ts_time > max_ts_time:
+        return None
+    neighbours = [str(quad) for quad in quadkey.from_str(cell).nearby(1)]
+    return ("window", cell, min_ts_time, max_ts_time, base_level), neighbours, min_ts_time, max_ts_time
+
+
+def links_in_window(df, timestamp, time_diff):
+    """Rows of a cell scan within the time of day window of one user."""
+    min_ts_time, max_ts_time = time_window(timestamp, time_diff)
+    if df is None or min_ts_time > max_ts_time:
+        return pd.DataFrame()
+    ts_us = df["ts_us"].to_numpy()
+    mask = (ts_us >= time_to_microseconds(min_ts_time)) & (ts_us <= time_to_microseconds(max_ts_time))
+    return df.loc[mask].reset_index(drop=True)
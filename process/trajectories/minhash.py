@@ -0,0 +1,212 @@
+from database import Database, to_pg_array
+from process.trajectories.support_func import jaccard_similarity
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+
+# 128 hash functions split in 32 bands of 4 rows: two trajectories share a bucket with probability 1 - (1 - J^4)^32,
+# about 5% at Jaccard 0.2, 40% at 0.35 and 99% at 0.55
+NUM_PERM = 128
+BANDS = 32
+# Number of candidates per requested result that are re-scored with the exact Jaccard similarity
+RERANK_FACTOR = 4
+SEED = 1
+
+CREATE_MINHASH_TABLES_SQL = """
+    create table if not exists traj_minhash (
+        traj_id integer primary key,
+        ts_ini time,
+        ts_end time,
+        signature bigint[] not null
+    );
+    create table if not exists traj_lsh_band (
+        band smallint not null,
+        bucket bigint not null,
+        traj_id integer not null,
+        primary key (band, bucket, traj_id)
+    );
+    create index if not exists traj_lsh_band_traj_id_idx on traj_lsh_band (traj_id);
+    """
+
+TRAJECTORY_QUADKEY_SETS_SQL = """
+    select l.traj_id
+    , array_agg(distinct q.quadkey) as quadkeys
+    from link_qk q
+        inner join link l
+            on l.link_id = q.link_id
+    where l.traj_id = ANY(%s)
+    group by l.traj_id
+    """
+
+UNINDEXED_TRAJECTORIES_SQL = """
+    select t.traj_id
+    from trajectory t
+    where not exists (select 1 from traj_minhash m where m.traj_id = t.traj_id)
+      and exists (select 1 from link l inner join link_qk q on q.link_id = l.link_id where l.traj_id = t.traj_id)
+    """
+
+TRAJECTORY_TIMES_SQL = """
+    select traj_id, ts_ini, ts_end
+    from trajectory
+    where traj_id = ANY(%s)
+    """
+
+SIGNATURE_SQL = """
+    select signature, ts_ini
+    from traj_minhash
+    where traj_id = %s
+    """
+
+# Candidates sharing at least one band bucket with the query, starting within the time window of the query
+LSH_CANDIDATES_SQL = """
+    select m.traj_id
+    , m.signature
+    from traj_minhash m
+    where m.traj_id in (
+        select b.traj_id
+        from unnest(%s::smallint[], %s::bigint[]) as q(band, bucket)
+            inner join traj_lsh_band b
+                on b.band = q.band and b.bucket = q.bucket
+    )
+      and m.traj_id <> %s
+      and m.ts_ini between %s::time - %s::interval and %s::time + %s::interval
+    """
+
+
+def mix64(x):
+    """splitmix64 finalizer, applied element-wise to a uint64 array. Wraps around on overflow by design."""
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return x ^ (x >> np.uint64(31))
+
+
+class MinHashLSH:
+    """
+    MinHash signatures of the link_qk quadkey set of each trajectory, indexed in LSH bands in Postgres.
+
+    The i-th hash of a quadkey is mix64(mix64(quadkey) ^ seed_i) and the signature keeps the minimum of each hash over
+    the set, so the fraction of equal positions between two signatures estimates the Jaccard similarity of the sets.
+    Each band of rows is hashed to one bucket; trajectories sharing a bucket in any band are the candidates of a query,
+    found with an index lookup per band instead of a scan of every trajectory.
+    """
+
+    def __init__(self, num_perm=NUM_PERM, bands=BANDS, seed=SEED):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.seeds = np.random.default_rng(seed).integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+
+    def signature(self, quadkeys):
+        """MinHash signature of a set of quadints, as an int64 array of num_perm values."""
+        hashed = mix64(np.unique(np.asarray(quadkeys, dtype=np.int64)).view(np.uint64))
+        if hashed.size == 0:
+            raise ValueError("Cannot compute the signature of an empty set")
+        return mix64(hashed[None, :] ^ self.seeds[:, None]).min(axis=1).view(np.int64)
+
+    def band_buckets(self, signature):
+        """One bucket per band, hashed from the rows of the band."""
+        rows = np.asarray(signature, dtype=np.int64).view(np.uint64).reshape(self.bands, self.rows)
+        buckets = np.zeros(self.bands, dtype=np.uint64)
+        for row in range(self.rows):
+            buckets = mix64(buckets ^ rows[:, row])
+        return buckets.view(np.int64)
+
+    @staticmethod
+    def estimate(signature, signatures):
+        """Estimated Jaccard similarity between one signature and each row of a 2-D array of signatures."""
+        return (np.asarray(signatures) == np.asarray(signature)[None, :]).mean(axis=1)
+
+    @staticmethod
+    def ensure_tables():
+        """Create the signature and band tables, run once at startup."""
+        with Database() as db:
+            db.execute_query(CREATE_MINHASH_TABLES_SQL)
+
+    @staticmethod
+    def quadkey_sets(traj_ids):
+        """traj_id -> set of link_qk quadkeys of the trajectory, for the trajectories that have link_qk rows."""
+        with Database() as db:
+            rows = db.fetch_all(TRAJECTORY_QUADKEY_SETS_SQL, [[int(traj_id) for traj_id in traj_ids]]) or []
+        return {traj_id: set(quadkeys) for traj_id, quadkeys in rows}
+
+    def index_trajectories(self, traj_ids=None):
+        """
+        Compute and store the signatures and band buckets of the trajectories, replacing their previous ones.
+        Without traj_ids, every trajectory with link_qk rows that is not indexed yet is indexed.
+        :return: number of trajectories indexed
+        """
+        if traj_ids is None:
+            with Database() as db:
+                traj_ids = [row[0] for row in db.fetch_all(UNINDEXED_TRAJECTORIES_SQL) or []]
+        traj_ids = [int(traj_id) for traj_id in traj_ids]
+        if not traj_ids:
+            return 0
+
+        sets = self.quadkey_sets(traj_ids)
+        with Database() as db:
+            times = {traj_id: (ts_ini, ts_end) for traj_id, ts_ini, ts_end in db.fetch_all(TRAJECTORY_TIMES_SQL, [traj_ids]) or []}
+
+        minhash_rows = []
+        band_rows = []
+        for traj_id, quadkeys in sets.items():
+            signature = self.signature(list(quadkeys))
+            ts_ini, ts_end = times.get(traj_id, (None, None))
+            minhash_rows.append((traj_id, ts_ini, ts_end, to_pg_array(signature.tolist())))
+            band_rows.extend((band, int(bucket), traj_id) for band, bucket in enumerate(self.band_buckets(signature)))
+
+        with Database() as db, db.transaction():
+            db.execute_query("delete from traj_lsh_band where traj_id = ANY(%s)", [traj_ids])
+            db.execute_query("delete from traj_minhash where traj_id = ANY(%s)", [traj_ids])
+            db.copy_rows("traj_minhash", ["traj_id", "ts_ini", "ts_end", "signature"], minhash_rows)
+            db.copy_rows("traj_lsh_band", ["band", "bucket", "traj_id"], band_rows)
+        print("Indexed {} trajectories".format(len(minhash_rows)))
+        return len(minhash_rows)
+
+    def query(self, traj_id: int, k: int = 10, time_diff: int = 10, exact: bool = False):
+        """
+        Top k trajectories most similar to the given one, among those starting within time_diff minutes of it.
+        :param traj_id: an indexed trajectory, indexed first if it is not
+        :param k:
+        :param time_diff: minutes
+        :param exact: re-score the best k * RERANK_FACTOR candidates with the exact Jaccard similarity of their
+                      quadkey sets and rank by it
+        :return: DataFrame of traj_id and estimated_similarity, plus similarity when exact, best first
+        """
+        with Database() as db:
+            row = db.fetch_one(SIGNATURE_SQL, [traj_id])
+        if row is None:
+            if not self.index_trajectories([traj_id]):
+                raise ValueError("Trajectory {} has no link quadkeys".format(traj_id))
+            with Database() as db:
+                row = db.fetch_one(SIGNATURE_SQL, [traj_id])
+        signature, ts_ini = np.asarray(row[0], dtype=np.int64), row[1]
+
+        buckets = self.band_buckets(signature)
+        window = timedelta(minutes=time_diff)
+        with Database() as db:
+            rows = db.fetch_all(LSH_CANDIDATES_SQL, [list(range(self.bands)), buckets.tolist(), traj_id,
+                                                     ts_ini, window, ts_ini, window]) or []
+
+        columns = ["traj_id", "estimated_similarity"] + (["similarity"] if exact else [])
+        if not rows:
+            return pd.DataFrame(columns=columns)
+
+        df = pd.DataFrame({"traj_id": [candidate for candidate, _ in rows],
+                           "estimated_similarity": self.estimate(signature, [sig for _, sig in rows])})
+        df = df.sort_values(["estimated_similarity", "traj_id"], ascending=[False, True], kind="stable")
+        if not exact:
+            return df.head(k).reset_index(drop=True)
+
+        df = df.head(k * RERANK_FACTOR).copy()
+        sets = self.quadkey_sets([traj_id] + df["traj_id"].tolist())
+        query_set = sets.get(traj_id, set())
+        df["similarity"] = [jaccard_similarity(query_set, sets.get(candidate, set())) for candidate in df["traj_id"]]
+        df = df.sort_values(["similarity", "estimated_similarity"], ascending=False, kind="stable")
+        return df.head(k).reset_index(drop=True)[columns]
+
+
+minhash_lsh = MinHashLSH()
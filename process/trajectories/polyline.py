@@ -0,0 +1,153 @@
+from typing import List, Sequence
+from numba import jit
+import numpy as np
+
+
+# Most characters a 64 bit value can take, 5 bits per character
+MAX_VALUE_CHARS = 13
+
+
+@jit(nopython=True)
+def encode_values(values, out, ends):
+    """
+    Write the characters of zigzag encoded values into out, 5 bits per character starting from the lowest ones.
+    :param ends: filled with the position in out after each value
+    """
+    n = 0
+    for i in range(values.shape[0]):
+        value = values[i]
+        while value >= 0x20:
+            out[n] = (0x20 | (value & 0x1f)) + 63
+            n += 1
+            value >>= 5
+        out[n] = value + 63
+        n += 1
+        ends[i] = n
+
+
+@jit(nopython=True)
+def decode_values(data, bounds, out, counts):
+    """
+    Decode the polylines stored one after the other in data into their points, in units of 1e-5 degree.
+    :param bounds: start of each polyline in data, followed by the end of the last one
+    :param out: (n, 2) array large enough for every point
+    :param counts: filled with the number of points of each polyline
+    """
+    point = 0
+    for p in range(bounds.shape[0] - 1):
+        index = bounds[p]
+        end = bounds[p + 1]
+        first = point
+        coordinate = 0
+        previous = np.zeros(2, dtype=np.int64)
+        while index < end:
+            result = 0
+            shift = 0
+            while True:
+                if index >= end:
+                    raise ValueError("Truncated polyline")
+                b = np.int64(data[index]) - 63
+                index += 1
+                result |= (b & 0x1f) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            delta = ~(result >> 1) if (result & 1) != 0 else (result >> 1)
+            previous[coordinate] += delta
+            out[point, coordinate] = previous[coordinate]
+            if coordinate == 1:
+                point += 1
+            coordinate = 1 - coordinate
+        if coordinate == 1:
+            raise ValueError("Truncated polyline")
+        counts[p] = point - first
+
+
+def encode_polylines(point_arrays: Sequence) -> List[str]:
+    """Encodes many lists or (n, 2) arrays of lat/lng points into polyline strings at once.
+
+    Gives the same strings as encode_polyline on each of them: the coordinates are rounded half to even to 1e-5
+    degree, as round does.
+
+    :param point_arrays: lists of (lat, lng) pairs or float64 arrays of shape (n, 2)
+    :type point_arrays: sequence
+
+    :rtype: list of strings
+    """
+    arrays = [np.asarray(points, dtype=np.float64).reshape(-1, 2) for points in point_arrays]
+    if not arrays:
+        return []
+    sizes = np.array([len(points) for points in arrays], dtype=np.int64)
+    e5 = np.rint(np.concatenate(arrays) * 1e5).astype(np.int64)
+
+    # Deltas from the previous point of the same polyline, from 0 for the first one
+    deltas = np.diff(e5, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    starts = np.cumsum(sizes) - sizes
+    firsts = starts[sizes > 0]
+    deltas[firsts] = e5[firsts]
+    values = deltas.ravel()
+    values = (values << 1) ^ (values >> 63)
+
+    out = np.empty(len(values) * MAX_VALUE_CHARS, dtype=np.uint8)
+    ends = np.empty(len(values), dtype=np.int64)
+    encode_values(values, out, ends)
+
+    # Character bounds of each polyline: the end of its last value
+    bounds = np.concatenate(([0], ends))[2 * np.cumsum(sizes)]
+    text = out[:bounds[-1]].tobytes().decode('ascii')
+    return [text[start:end] for start, end in zip(np.concatenate(([0], bounds[:-1])), bounds)]
+
+
+def decode_polylines(polylines: Sequence[str]) -> List[np.ndarray]:
+    """Decodes many polyline strings at once.
+
+    :param polylines: encoded polylines
+    :type polylines: sequence of strings
+
+    :rtype: list of float64 arrays of shape (n, 2), lat and lng
+    """
+    if not polylines:
+        return []
+    data = np.frombuffer(''.join(polylines).encode('ascii'), dtype=np.uint8)
+    bounds = np.cumsum([0] + [len(polyline) for polyline in polylines]).astype(np.int64)
+    # Every point takes at least two characters
+    out = np.empty((len(data) // 2, 2), dtype=np.int64)
+    counts = np.empty(len(polylines), dtype=np.int64)
+    decode_values(data, bounds, out, counts)
+    points = out[:counts.sum()] * 1e-5
+    return np.split(points, np.cumsum(counts)[:-1])
+
+
+def encode_polyline_array(points) -> str:
+    """Encodes a float64 array of shape (n, 2), or any list of lat/lng points, into a polyline string."""
+    return encode_polylines([points])[0]
+
+
+def decode_polyline_array(polyline: str) -> np.ndarray:
+    """Decodes a polyline string into a float64 array of shape (n, 2), lat and lng."""
+    return decode_polylines([polyline])[0]
+
+
+def decode_polyline(polyline) -> list:
+    """Decodes a Polyline string into a list of lat/lng pairs.
+
+    See the developer docs for a detailed description of this encoding:
+    https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+
+    :param polyline: An encoded polyline
+    :type polyline: string
+
+    :rtype: list of [lat, lng] lists
+    """
+    return decode_polyline_array(polyline).tolist()
+
+
+def encode_polyline(points) -> str:
+    """Encodes a list of lat/lng points into a polyline string.
+
+    :param points: A list of tuples or lists containing latitude and longitude, or an array of shape (n, 2)
+    :type points: list of tuples/lists
+
+    :rtype: string
+    """
+    return encode_polyline_array(points)
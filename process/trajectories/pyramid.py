@@ -0,0 +1,105 @@
+from database import Database, read_config
+from pyquadkey2 import quadkey
+import argparse
+import os
+
+
+# Levels of the coarse cell ids stored with each link when the config has no matching.quadkey_levels
+DEFAULT_LEVELS = (14, 16, 18)
+BASE_LEVEL = 20
+
+
+def pyramid_levels(config_file='config.json'):
+    """Levels of the qk_<level> columns of the link table, from matching.quadkey_levels in the config."""
+    config = read_config(os.path.abspath(config_file))
+    return tuple(sorted(int(level) for level in config.get('matching', {}).get('quadkey_levels', DEFAULT_LEVELS)))
+
+
+def pyramid_column(level: int):
+    return "qk_{}".format(int(level))
+
+
+def pyramid_columns():
+    return [pyramid_column(level) for level in pyramid_levels()]
+
+
+def cell_id(cell: str):
+    """
+    Integer id of a quadkey cell: its key bits, the same value as the base level quadint of any link in it shifted
+    down to the cell's level. Cells of one level have distinct ids, so they can be compared with equality.
+    """
+    return quadkey.from_str(cell).to_quadint() >> (64 - 2 * len(cell))
+
+
+def pyramid_cells(quad):
+    """The coarse cell ids of a base level link quadint, one per pyramid level, or Nones without a quadint."""
+    if quad is None:
+        return (None,) * len(pyramid_levels())
+    return tuple(int(quad) >> (2 * (BASE_LEVEL - level)) for level in pyramid_levels())
+
+
+def with_pyramid(link):
+    """A (traj_id, signal_ini, signal_end, ts_ini, ts_end, quadkey) link row followed by its coarse cell ids."""
+    return tuple(link) + pyramid_cells(link[5])
+
+
+# Links updated per transaction by the backfill, so it never holds the locks of the whole table
+BACKFILL_BATCH = 50_000
+
+MISSING_PYRAMID_COLUMNS_SQL = """
+    select wanted.name
+    from unnest(%s::text[]) as wanted (name)
+    where not exists (select 1 from information_schema.columns c
+                      where c.table_schema = current_schema() and c.table_name = 'link'
+                        and c.column_name = wanted.name)
+    """
+
+
+def check_link_pyramid():
+    """
+    Cheap startup check that the qk_<level> columns of the configured levels exist, the links are written with them.
+    :raise RuntimeError: naming the missing columns and the migration to run
+    """
+    with Database() as db:
+        rows = db.fetch_all(MISSING_PYRAMID_COLUMNS_SQL, [pyramid_columns()])
+    if rows:
+        raise RuntimeError("The link table has no {} column, run python -m process.trajectories.pyramid first".format(
+            ", ".join(row[0] for row in rows)))
+
+
+def migrate_link_pyramid(batch_size=BACKFILL_BATCH):
+    """
+    One-off migration: add the missing qk_<level> columns and their (qk_<level>, ts_ini) indexes to the link table and
+    backfill them from the base level quadkey. The indexes are built concurrently and the backfill runs in batches of
+    link ids, so the table stays writable. Links written since carry the columns already, only null rows are updated.
+    """
+    with Database() as db:
+        # CREATE INDEX CONCURRENTLY cannot run in a transaction
+        db.connection.autocommit = True
+        try:
+            for level in pyramid_levels():
+                column = pyramid_column(level)
+                db.execute_query("alter table link add column if not exists {} bigint".format(column))
+                db.execute_query("create index concurrently if not exists link_{}_ts_ini_idx on link ({}, ts_ini)"
+                                 .format(column, column))
+            max_link_id = db.fetch_one("select coalesce(max(link_id), 0) from link")[0]
+            for start in range(0, max_link_id + 1, batch_size):
+                for level in pyramid_levels():
+                    column = pyramid_column(level)
+                    db.execute_query("update link set {} = quadkey >> %s where link_id >= %s and link_id < %s "
+                                     "and {} is null and quadkey is not null".format(column, column),
+                                     [2 * (BASE_LEVEL - level), start, start + batch_size])
+                print("Backfilled the coarse cells of links {} to {}".format(start, start + batch_size - 1))
+        finally:
+            db.connection.autocommit = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add and backfill the qk_<level> columns of the link table")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH, help="links updated per transaction")
+    args = parser.parse_args()
+    migrate_link_pyramid(args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+from database import read_config
+from process.trajectories.polyline import encode_polyline
+from process.trajectories.support_func import haversine_distance
+from abc import ABC, abstractmethod
+from datetime import datetime
+from dotenv import load_dotenv
+import math
+import os
+import threading
+
+
+load_dotenv()
+
+# Speed model of the local provider: km/h off peak and during the 7-9 and 17-19 weekday peaks, and the ratio of the
+# road distance to the great-circle distance
+LOCAL_SPEED = 40
+LOCAL_PEAK_SPEED = 25
+LOCAL_DETOUR_FACTOR = 1.3
+# Metres between two points of a local route polyline, and the longest step of a route
+LOCAL_POINT_SPACING = 50
+LOCAL_STEP_LENGTH = 1000
+
+
+class RoutingProvider(ABC):
+    """
+    Source of the routes behind get_directions and get_distance_matrix. Both methods return the shape of the Google
+    Maps client results, the directions as a list of routes with legs, steps and encoded polylines, the distance
+    matrix as a dict of rows of elements, so the code reading them does not depend on the provider.
+    """
+
+    name = None
+
+    @abstractmethod
+    def directions(self, origin, destination, mode="driving", departure_time: datetime = None):
+        """Routes from origin to destination, as googlemaps.Client.directions returns them."""
+
+    @abstractmethod
+    def distance_matrix(self, origins, destinations, mode="driving", departure_time: datetime = None):
+        """Distance and duration between every origin and destination, as googlemaps.Client.distance_matrix."""
+
+
+class GoogleRoutingProvider(RoutingProvider):
+    """Google Maps Directions and Distance Matrix APIs. The client is created on first use, from GOOGLE_MAP_API_KEY."""
+
+    name = "google"
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key
+        self._lock = threading.Lock()
+        self._client = None
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import googlemaps
+                self._client = googlemaps.Client(key=self.api_key or os.getenv("GOOGLE_MAP_API_KEY"))
+            return self._client
+
+    def directions(self, origin, destination, mode="driving", departure_time: datetime = None):
+        return self.client.directions(origin, destination, mode=mode, departure_time=departure_time)
+
+    def distance_matrix(self, origins, destinations, mode="driving", departure_time: datetime = None):
+        return self.client.distance_matrix(origins, destinations, mode=mode, departure_time=departure_time)
+
+
+class LocalRoutingProvider(RoutingProvider):
+    """
+    Offline stand-in for load tests and benchmarks. A route is the great circle between the two points, its length
+    stretched by detour_factor and driven at a speed depending on the departure time, cut into steps of at most
+    LOCAL_STEP_LENGTH metres with a point every LOCAL_POINT_SPACING metres. Locations must be (lat, lng) pairs.
+    """
+
+    name = "local"
+
+    def __init__(self, speed=LOCAL_SPEED, peak_speed=LOCAL_PEAK_SPEED, detour_factor=LOCAL_DETOUR_FACTOR):
+        self.speed = speed
+        self.peak_speed = peak_speed
+        self.detour_factor = detour_factor
+
+    def speed_at(self, departure_time: datetime = None):
+        """Metres per second when leaving at departure_time."""
+        if departure_time is not None and departure_time.weekday() < 5 \
+                and (7 <= departure_time.hour < 9 or 17 <= departure_time.hour < 19):
+            return self.peak_speed / 3.6
+        return self.speed / 3.6
+
+    @staticmethod
+    def location(location):
+        if isinstance(location, str):
+            raise ValueError("The local routing provider cannot geocode the address '{}'".format(location))
+        lat, lng = location
+        return float(lat), float(lng)
+
+    def road(self, origin, destination, departure_time: datetime = None):
+        """(distance, duration) of the route, in metres and seconds."""
+        distance = haversine_distance(origin, destination) * self.detour_factor
+        return distance, distance / self.speed_at(departure_time)
+
+    @staticmethod
+    def value(value, unit):
+        text = "{:.1f} km".format(value / 1000) if unit == "m" else "{} mins".format(max(1, round(value / 60)))
+        return {"text": text, "value": int(round(value))}
+
+    def directions(self, origin, destination, mode="driving", departure_time: datetime = None):
+        origin, destination = self.location(origin), self.location(destination)
+        distance, duration = self.road(origin, destination, departure_time)
+        great_circle = haversine_distance(origin, destination)
+        count = max(1, math.ceil(great_circle / LOCAL_POINT_SPACING))
+        # Points along the straight line in degrees, close enough to the great circle over a commute
+        points = [(origin[0] + (destination[0] - origin[0]) * i / count,
+                   origin[1] + (destination[1] - origin[1]) * i / count) for i in range(count + 1)]
+
+        step_points = max(1, math.ceil(LOCAL_STEP_LENGTH / LOCAL_POINT_SPACING))
+        steps = []
+        for start in range(0, count, step_points):
+            stop = min(start + step_points, count)
+            share = (stop - start) / count
+            steps.append({
+                "distance": self.value(distance * share, "m"),
+                "duration": self.value(duration * share, "s"),
+                "start_location": {"lat": points[start][0], "lng": points[start][1]},
+                "end_location": {"lat": points[stop][0], "lng": points[stop][1]},
+                "polyline": {"points": encode_polyline(points[start:stop + 1])},
+                "travel_mode": mode.upper(),
+            })
+
+        leg = {
+            "distance": self.value(distance, "m"),
+            "duration": self.value(duration, "s"),
+            "start_location": {"lat": origin[0], "lng": origin[1]},
+            "end_location": {"lat": destination[0], "lng": destination[1]},
+            "start_address": "{},{}".format(*origin),
+            "end_address": "{},{}".format(*destination),
+            "steps": steps,
+        }
+        return [{
+            "legs": [leg],
+            "overview_polyline": {"points": encode_polyline(points)},
+            "summary": "local",
+            "warnings": [],
+        }]
+
+    def distance_matrix(self, origins, destinations, mode="driving", departure_time: datetime = None):
+        origins = [self.location(origin) for origin in origins]
+        destinations = [self.location(destination) for destination in destinations]
+        rows = []
+        for origin in origins:
+            elements = []
+            for destination in destinations:
+                distance, duration = self.road(origin, destination, departure_time)
+                elements.append({"status": "OK", "distance": self.value(distance, "m"),
+                                 "duration": self.value(duration, "s")})
+            rows.append({"elements": elements})
+        return {
+            "status": "OK",
+            "origin_addresses": ["{},{}".format(*origin) for origin in origins],
+            "destination_addresses": ["{},{}".format(*destination) for destination in destinations],
+            "rows": rows,
+        }
+
+
+PROVIDERS = {
+    GoogleRoutingProvider.name: GoogleRoutingProvider,
+    LocalRoutingProvider.name: LocalRoutingProvider,
+}
+
+
+def routing_provider_name(config_file='config.json'):
+    """The ROUTING_PROVIDER environment variable, otherwise routing.provider of the config, google by default."""
+    config = read_config(os.path.abspath(config_file))
+    return os.getenv("ROUTING_PROVIDER") or config.get("routing", {}).get("provider", GoogleRoutingProvider.name)
+
+
+routing_lock = threading.Lock()
+current_provider = None
+
+
+def routing_provider():
+    """The routing provider of the process, created on first use."""
+    global current_provider
+    with routing_lock:
+        if current_provider is None:
+            name = routing_provider_name()
+            if name not in PROVIDERS:
+                raise ValueError("Unknown routing provider '{}'".format(name))
+            current_provider = PROVIDERS[name]()
+        return current_provider
+
+
+def set_routing_provider(provider: RoutingProvider):
+    """Replace the routing provider of the process, e.g. with a LocalRoutingProvider in a benchmark."""
+    global current_provider
+    with routing_lock:
+        current_provider = provider
@@ -0,0 +1,277 @@
+from database import read_config
+from process.trajectories.routing import routing_provider
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from collections import deque
+from datetime import datetime
+import os
+import threading
+import time
+
+
+# Defaults of the routing section of the config
+DEFAULT_SETTINGS = {
+    # Requests per second sent to the provider, and how many can be sent at once after an idle period
+    "qps": 50,
+    "burst": 50,
+    # Seconds a call may take, waiting for the rate limiter included, before it fails with RoutingTimeout
+    "deadline": 10.0,
+    # Send a second request when the first one is slower than the p95 of the recent calls, hedge_after seconds
+    # until enough calls were seen
+    "hedge": True,
+    "hedge_after": 2.0,
+    "workers": 32,
+}
+
+# Calls the p95 is computed on, and how many are needed before it replaces hedge_after
+LATENCY_WINDOW = 500
+LATENCY_MIN_SAMPLES = 20
+
+
+def routing_settings(config_file='config.json'):
+    config = read_config(os.path.abspath(config_file))
+    return {**DEFAULT_SETTINGS, **config.get('routing', {})}
+
+
+class RoutingTimeout(TimeoutError):
+    """A routing call did not get an answer, or a slot of the rate limiter, before its deadline."""
+
+
+class TokenBucket:
+    """
+    Rate limiter shared by the threads of the process: rate tokens per second, at most capacity of them saved up.
+    A token taken while the bucket is empty is a reservation, and the caller sleeps until it is due, so the waiting
+    callers are served in order.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def refill(self):
+        """Callers hold the lock."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def tokens(self):
+        with self._lock:
+            self.refill()
+            return self._tokens
+
+    def acquire(self, timeout):
+        """
+        Take a token, sleeping until it is due.
+        :return: the seconds slept, or None when the token would not be due within timeout, nothing is taken then
+        """
+        with self._lock:
+            self.refill()
+            wait_time = max(0.0, (1 - self._tokens) / self.rate)
+            if wait_time > timeout:
+                return None
+            self._tokens -= 1
+        if wait_time > 0:
+            time.sleep(wait_time)
+        return wait_time
+
+    def try_acquire(self):
+        """Take a token only if one is available right away."""
+        with self._lock:
+            self.refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RoutingClient:
+    """
+    Guard in front of the routing provider of the process, for the bursts of identical requests a popular trip
+    brings and the QPS quota of the Maps APIs.
+
+    - Identical calls in flight are coalesced: the first one is sent, the others wait for its result. Calls are
+      identical when they share a key, by default their arguments; get_directions passes its cache key so that the
+      requests the directions cache would answer with one route also share one call.
+    - Every request sent, hedges included, takes a token of a bucket refilled at qps per second. A call sleeps for
+      its token and fails when the token is not due before its deadline.
+    - The request runs on a worker thread and the call gives up at its deadline with RoutingTimeout. The request
+      itself cannot be interrupted and finishes in the background.
+    - With hedging on, a call still running after the p95 latency of the recent calls sends the same request a second
+      time, if a token is free right away, and returns whichever answers first.
+    """
+
+    def __init__(self, qps=None, burst=None, deadline=None, hedge=None, hedge_after=None, workers=None):
+        settings = routing_settings()
+        self.qps = qps if qps is not None else settings["qps"]
+        self.burst = burst if burst is not None else settings["burst"]
+        self.deadline = deadline if deadline is not None else settings["deadline"]
+        self.hedge = hedge if hedge is not None else settings["hedge"]
+        self.hedge_after = hedge_after if hedge_after is not None else settings["hedge_after"]
+        self.workers = workers if workers is not None else settings["workers"]
+        self.bucket = TokenBucket(self.qps, self.burst)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="routing")
+        self._lock = threading.Lock()
+        self._in_flight = {}  # key -> Future of the call being sent
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.calls = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    @property
+    def name(self):
+        return routing_provider().name
+
+    def directions(self, origin, destination, mode="driving", departure_time: datetime = None, key=None,
+                   deadline=None):
+        """RoutingProvider.directions through the guard. key identifies the identical calls, deadline is in seconds."""
+        key = ("directions", key) if key is not None else \
+            ("directions", repr(origin), repr(destination), mode, departure_time)
+        return self.call(key, "directions", (origin, destination),
+                         {"mode": mode, "departure_time": departure_time}, deadline)
+
+    def distance_matrix(self, origins, destinations, mode="driving", departure_time: datetime = None, key=None,
+                        deadline=None):
+        """RoutingProvider.distance_matrix through the guard, see directions."""
+        key = ("distance_matrix", key) if key is not None else \
+            ("distance_matrix", repr(origins), repr(destinations), mode, departure_time)
+        return self.call(key, "distance_matrix", (origins, destinations),
+                         {"mode": mode, "departure_time": departure_time}, deadline)
+
+    def call(self, key, method, args, kwargs, deadline=None):
+        deadline_at = time.monotonic() + (deadline if deadline is not None else self.deadline)
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if leader:
+            try:
+                future.set_result(self.send(method, args, kwargs, deadline_at))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+            return future.result()
+
+        try:
+            return future.result(timeout=max(0.0, deadline_at - time.monotonic()))
+        except FutureTimeoutError:
+            if future.done():
+                raise
+            with self._lock:
+                self.timeouts += 1
+            raise RoutingTimeout("No routing result within the deadline")
+
+    def submit(self, method, args, kwargs):
+        """Run a request on a worker, recording its latency when it succeeds."""
+        started = time.monotonic()
+        future = self._executor.submit(getattr(routing_provider(), method), *args, **kwargs)
+
+        def record(done):
+            if not done.cancelled() and done.exception() is None:
+                with self._lock:
+                    self._latencies.append(time.monotonic() - started)
+
+        future.add_done_callback(record)
+        with self._lock:
+            self.sent += 1
+        return future
+
+    def send(self, method, args, kwargs, deadline_at):
+        """Send one request, and its hedge when it is slow, under the rate limit and the deadline."""
+        waited = self.bucket.acquire(deadline_at - time.monotonic())
+        with self._lock:
+            if waited is None:
+                self.rejected += 1
+            elif waited > 0:
+                self.throttled += 1
+        if waited is None:
+            raise RoutingTimeout("No routing request slot before the deadline")
+
+        primary = self.submit(method, args, kwargs)
+        pending = {primary}
+        hedge_after = self.hedge_threshold()
+        if self.hedge and hedge_after is not None:
+            done, _ = wait(pending, timeout=max(0.0, min(hedge_after, deadline_at - time.monotonic())))
+            if not done and time.monotonic() < deadline_at and self.bucket.try_acquire():
+                pending.add(self.submit(method, args, kwargs))
+                with self._lock:
+                    self.hedged += 1
+
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline_at - time.monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return future.result()
+                error = future.exception()
+
+        with self._lock:
+            if pending:
+                self.timeouts += 1
+            else:
+                self.errors += 1
+        if pending:
+            raise RoutingTimeout("No routing result within the deadline")
+        raise error
+
+    def latency_p95(self):
+        """p95 in seconds of the recent successful requests, None until LATENCY_MIN_SAMPLES were seen."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < LATENCY_MIN_SAMPLES:
+            return None
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def hedge_threshold(self):
+        """Seconds after which a request is hedged."""
+        p95 = self.latency_p95()
+        return p95 if p95 is not None else self.hedge_after
+
+    def stats(self):
+        p95 = self.latency_p95()
+        with self._lock:
+            return {
+                "provider": self.name,
+                "qps": self.qps,
+                "burst": self.burst,
+                "tokens": self.bucket.tokens,
+                "deadline": self.deadline,
+                "hedge": self.hedge,
+                "hedge_after": p95 if p95 is not None else self.hedge_after,
+                "latency_p95": p95,
+                "in_flight": len(self._in_flight),
+                "calls": self.calls,
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+                "throttled": self.throttled,
+                "rejected": self.rejected,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+            }
+
+
+routing_client = RoutingClient()
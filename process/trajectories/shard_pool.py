@@ -0,0 +1,256 @@
+from database import read_config
+from process.trajectories.link_index import LinkIndex, SHARD_LEVEL
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import multiprocessing
+import os
+import threading
+import pandas as pd
+
+
+BASE_LEVEL = 20
+
+
+def shard_count(config_file='config.json'):
+    """Number of link index shards from matching.shards in the config. Below 2 the serving process holds the index."""
+    config = read_config(os.path.abspath(config_file))
+    return int(config.get('matching', {}).get('shards', 0))
+
+
+def shard_of(quadint, shards):
+    """Shard holding the link with this base level quadint."""
+    return (int(quadint) >> (2 * (BASE_LEVEL - SHARD_LEVEL))) % shards
+
+
+def range_shards(lo, hi, shards):
+    """Shards holding the links of the base level quadint range [lo, hi). Any shard answers an empty range."""
+    if hi <= lo:
+        return [0]
+    shift = 2 * (BASE_LEVEL - SHARD_LEVEL)
+    first, last = int(lo) >> shift, (int(hi) - 1) >> shift
+    if last - first + 1 >= shards:
+        return list(range(shards))
+    return sorted({prefix % shards for prefix in range(first, last + 1)})
+
+
+# The part of the link index held by a worker process
+shard_index = None
+
+
+def init_shard(shard, shards):
+    global shard_index
+    shard_index = LinkIndex(shard, shards)
+    shard_index.load()
+
+
+def shard_lookup(tasks):
+    """Run (min_quadint, max_quadint, min_ts, max_ts) lookups on the links of the worker."""
+    return [shard_index.lookup(*task) for task in tasks]
+
+
+def shard_nearest(tasks):
+    """Nearest link of each trajectory for (quad_ranges, min_ts, max_ts, location, time_start) tasks on the worker."""
+    return [shard_index.nearest(*task) for task in tasks]
+
+
+def shard_refresh():
+    return shard_index.refresh()
+
+
+def shard_add_links(df):
+    return shard_index.add_links(df)
+
+
+def shard_size():
+    return len(shard_index)
+
+
+def merge_range(frames):
+    """Links of one quadint range from the frames of its shards, in the (quadkey, link_id) order of a full index."""
+    non_empty = [frame for frame in frames if not frame.empty]
+    if not non_empty:
+        return frames[0]
+    if len(non_empty) == 1:
+        return non_empty[0]
+    df = pd.concat(non_empty, ignore_index=True)
+    return df.sort_values(['quadkey', 'link_id'], kind='stable').reset_index(drop=True)
+
+
+def merge_nearest(frames):
+    """Nearest link of each trajectory from the nearest links of its shards, the one a full index would keep."""
+    non_empty = [frame for frame in frames if not frame.empty]
+    if not non_empty:
+        return frames[0].drop(columns='quadkey')
+    if len(non_empty) == 1:
+        return non_empty[0].drop(columns='quadkey')
+    df = pd.concat(non_empty, ignore_index=True)
+    df = df.sort_values(['traj_id', 'distance', 'quadkey', 'link_id'], kind='stable').drop_duplicates('traj_id')
+    return df.drop(columns='quadkey').reset_index(drop=True)
+
+
+class ShardPool:
+    """
+    The link index split across worker processes, so the lookups of a search or of a batch run on several cores.
+
+    Shard i runs in a process of its own and holds a LinkIndex of the links whose SHARD_LEVEL cell id modulo the
+    number of shards is i. Lookups are scattered to the shards holding each of their quadint ranges and the frames
+    returned are merged back per range in (quadkey, link_id) order, the order of a full index, so the result is the
+    same as lookup_quad_ranges on the link index of the serving process.
+    Searches only need the nearest link of each trajectory: nearest runs the distances and the reduction in the
+    shards, which return one row per trajectory instead of their links.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executors = []
+
+    @property
+    def started(self):
+        return bool(self._executors)
+
+    @property
+    def shards(self):
+        return len(self._executors)
+
+    def start(self, shards=None):
+        """
+        Start one worker process per shard and load its links. Nothing is started with fewer than two shards.
+        :param shards: number of shards, matching.shards of the config by default
+        """
+        shards = shard_count() if shards is None else shards
+        if shards < 2:
+            return
+        # Spawned workers open their own database connections instead of inheriting the pool of this process
+        context = multiprocessing.get_context('spawn')
+        executors = [ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=init_shard,
+                                         initargs=(shard, shards)) for shard in range(shards)]
+        sizes = [future.result() for future in [executor.submit(shard_size) for executor in executors]]
+        with self._lock:
+            previous, self._executors = self._executors, executors
+        for executor in previous:
+            executor.shutdown(wait=False, cancel_futures=True)
+        print("Link index loaded in {} shards with {} links".format(shards, sum(sizes)))
+
+    def stop(self):
+        with self._lock:
+            executors, self._executors = self._executors, []
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def scatter(self, lookups):
+        """
+        Submit (quad_ranges, min_ts_time, max_ts_time) lookups to the shards holding their ranges.
+        :return: (the (lookup, range) position of each task of each shard, future of each shard)
+        """
+        executors = self._executors
+        positions = [[] for _ in executors]
+        tasks = [[] for _ in executors]
+        for position, (quad_ranges, min_ts_time, max_ts_time) in enumerate(lookups):
+            for range_position, (lo, hi) in enumerate(quad_ranges or [(0, 0)]):
+                for shard in range_shards(lo, hi, len(executors)):
+                    positions[shard].append((position, range_position))
+                    tasks[shard].append((int(lo), int(hi), min_ts_time, max_ts_time))
+        futures = {shard: executors[shard].submit(shard_lookup, tasks[shard])
+                   for shard in range(len(executors)) if tasks[shard]}
+        return positions, futures
+
+    @staticmethod
+    def gather(lookups, positions, results):
+        """
+        Merge the frames returned by the shards into one frame per lookup.
+        :param results: shard -> frames returned for its tasks
+        """
+        parts = [[[] for _ in (quad_ranges or [(0, 0)])] for quad_ranges, _, _ in lookups]
+        for shard, frames in results.items():
+            for (position, range_position), frame in zip(positions[shard], frames):
+                parts[position][range_position].append(frame)
+        return [pd.concat([merge_range(frames) for frames in ranges], ignore_index=True) for ranges in parts]
+
+    def lookup(self, lookups):
+        """
+        Links of each (quad_ranges, min_ts_time, max_ts_time) lookup, the same frames as lookup_quad_ranges.
+        The lookups of all shards run in parallel.
+        """
+        positions, futures = self.scatter(lookups)
+        return self.gather(lookups, positions, {shard: future.result() for shard, future in futures.items()})
+
+    async def lookup_async(self, lookups):
+        """
+        Async version of lookup.
+        """
+        positions, futures = self.scatter(lookups)
+        shards = list(futures)
+        frames = await asyncio.gather(*[asyncio.wrap_future(futures[shard]) for shard in shards])
+        return self.gather(lookups, positions, dict(zip(shards, frames)))
+
+    def scatter_nearest(self, searches):
+        """
+        Submit (quad_ranges, min_ts_time, max_ts_time, location, time_start) searches to the shards holding their
+        ranges. Each shard gets all the ranges of a search, the ranges it does not hold are empty there.
+        :return: (the search position of each task of each shard, future of each shard)
+        """
+        executors = self._executors
+        positions = [[] for _ in executors]
+        tasks = [[] for _ in executors]
+        for position, (quad_ranges, min_ts_time, max_ts_time, location, time_start) in enumerate(searches):
+            quad_ranges = [(int(lo), int(hi)) for lo, hi in quad_ranges]
+            shards = sorted({shard for lo, hi in quad_ranges or [(0, 0)]
+                             for shard in range_shards(lo, hi, len(executors))})
+            for shard in shards:
+                positions[shard].append(position)
+                tasks[shard].append((quad_ranges, min_ts_time, max_ts_time, location, time_start))
+        futures = {shard: executors[shard].submit(shard_nearest, tasks[shard])
+                   for shard in range(len(executors)) if tasks[shard]}
+        return positions, futures
+
+    @staticmethod
+    def gather_nearest(searches, positions, results):
+        """
+        Merge the nearest links returned by the shards into one frame per search.
+        :param results: shard -> frames returned for its tasks
+        """
+        parts = [[] for _ in searches]
+        for shard, frames in results.items():
+            for position, frame in zip(positions[shard], frames):
+                parts[position].append(frame)
+        return [merge_nearest(frames) for frames in parts]
+
+    def nearest(self, searches):
+        """
+        Nearest link of each trajectory for each (quad_ranges, min_ts_time, max_ts_time, location, time_start)
+        search, the same frames as trajectories_cross_df on the lookup_quad_ranges links. The shards run in parallel.
+        """
+        positions, futures = self.scatter_nearest(searches)
+        return self.gather_nearest(searches, positions,
+                                   {shard: future.result() for shard, future in futures.items()})
+
+    async def nearest_async(self, searches):
+        """
+        Async version of nearest.
+        """
+        positions, futures = self.scatter_nearest(searches)
+        shards = list(futures)
+        frames = await asyncio.gather(*[asyncio.wrap_future(futures[shard]) for shard in shards])
+        return self.gather_nearest(searches, positions, dict(zip(shards, frames)))
+
+    def refresh(self):
+        """
+        Pull the links added by other processes into every shard.
+        :return: the links that were not in the shards yet, None if no shard had any
+        """
+        futures = [executor.submit(shard_refresh) for executor in self._executors]
+        new_links = [frame for frame in (future.result() for future in futures) if frame is not None]
+        return pd.concat(new_links, ignore_index=True) if new_links else None
+
+    def add_links(self, df):
+        """Merge new links into the shards holding them, like LinkIndex.add_links."""
+        if df.empty:
+            return
+        executors = self._executors
+        shards = df['quadkey'].map(lambda quadint: shard_of(quadint, len(executors)))
+        futures = [executors[shard].submit(shard_add_links, rows) for shard, rows in df.groupby(shards)]
+        for future in futures:
+            future.result()
+
+
+shard_pool = ShardPool()
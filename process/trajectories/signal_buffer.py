@@ -0,0 +1,175 @@
+from database import Database
+from psycopg2 import OperationalError, IntegrityError, DataError
+from fastapi.concurrency import run_in_threadpool
+from collections import deque
+import asyncio
+
+
+# Rows held in memory before new signals are refused
+SIGNAL_BUFFER_CAPACITY = 100_000
+# Rows written per COPY
+SIGNAL_BATCH_SIZE = 5_000
+# Seconds between two flushes when fewer than SIGNAL_BATCH_SIZE rows are waiting
+SIGNAL_FLUSH_INTERVAL = 1.0
+# Seconds a request waits for room in a full buffer before it is refused
+SIGNAL_PUT_TIMEOUT = 2.0
+
+LOCATION_SIGNAL_COLUMNS = ["user_id", "time_stamp", "latitude", "longitude"]
+
+
+class SignalBuffer:
+    """
+    Write-behind buffer of signal rows for one table, so the request path only appends to memory.
+
+    Rows are kept in arrival order in a bounded deque. A background task writes them with COPY in batches of
+    batch_size, as soon as a full batch is waiting or every flush_interval seconds otherwise. When the buffer is full,
+    put waits for a flush to make room and gives up after its timeout, which the caller reports as a retryable error.
+    A batch that fails on a connection error is put back in front and retried on the next flush. A batch the
+    database rejects for its content is split in halves until the offending rows are isolated; only those are dropped
+    and counted.
+
+    The buffer belongs to the event loop of the app: put, flush and the flusher must run on it.
+    """
+
+    def __init__(self, table, columns, capacity=SIGNAL_BUFFER_CAPACITY, batch_size=SIGNAL_BATCH_SIZE,
+                 flush_interval=SIGNAL_FLUSH_INTERVAL):
+        self.table = table
+        self.columns = columns
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._rows = deque()
+        self._in_flight = 0
+        self._space = asyncio.Condition()
+        self._ready = asyncio.Event()
+        self._task = None
+        self._closed = False
+        self.accepted = 0
+        self.rejected = 0
+        self.written = 0
+        self.dropped = 0
+        self.failures = 0
+
+    @property
+    def pending(self):
+        """Rows accepted and not written yet, including the batch being written."""
+        return len(self._rows) + self._in_flight
+
+    async def put(self, rows, timeout=SIGNAL_PUT_TIMEOUT):
+        """
+        Append rows, waiting up to timeout seconds for room when the buffer is full.
+        :param rows: tuples in the order of the buffer's columns
+        :return: True when the rows were accepted, False when the buffer stayed full or is closed
+        """
+        rows = list(rows)
+        if len(rows) > self.capacity:
+            raise ValueError("Cannot buffer more than {} rows at once".format(self.capacity))
+        async with self._space:
+            try:
+                await asyncio.wait_for(self._space.wait_for(
+                    lambda: self._closed or self.pending + len(rows) <= self.capacity), timeout)
+            except asyncio.TimeoutError:
+                self.rejected += len(rows)
+                return False
+            if self._closed:
+                self.rejected += len(rows)
+                return False
+            self._rows.extend(rows)
+            self.accepted += len(rows)
+        if len(self._rows) >= self.batch_size:
+            self._ready.set()
+        return True
+
+    def write(self, rows):
+        with Database() as db, db.transaction():
+            db.copy_rows(self.table, self.columns, rows)
+
+    async def write_bisect(self, batch):
+        """
+        Write a batch. The parts the database rejects for their content, with an IntegrityError or a DataError, are
+        split in halves until the offending rows are isolated and dropped; a part failing otherwise is dropped whole.
+        :return: the rows not written yet when a connection error stopped it, in order, empty when it completed
+        """
+        parts = [batch]
+        while parts:
+            part = parts.pop()
+            try:
+                await run_in_threadpool(self.write, part)
+                self.written += len(part)
+            except OperationalError as e:
+                left = [row for remaining in [part] + parts[::-1] for row in remaining]
+                self.failures += 1
+                print(f"The error '{e}' occurred while writing {len(left)} rows into {self.table}, retrying later.")
+                return left
+            except (IntegrityError, DataError) as e:
+                if len(part) > 1:
+                    middle = len(part) // 2
+                    parts.extend([part[middle:], part[:middle]])
+                    continue
+                self.dropped += 1
+                self.failures += 1
+                print(f"The error '{e}' occurred while writing a row into {self.table}, dropping it: {part[0]}")
+            except Exception as e:
+                self.dropped += len(part)
+                self.failures += 1
+                print(f"The error '{e}' occurred while writing {len(part)} rows into {self.table}, dropping them.")
+        return []
+
+    async def flush(self):
+        """
+        Write every waiting row, batch by batch.
+        :return: False when rows had to be put back after a connection error
+        """
+        while self._rows:
+            batch = [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+            self._in_flight = len(batch)
+            try:
+                left = await self.write_bisect(batch)
+                self._rows.extendleft(reversed(left))
+            finally:
+                self._in_flight = 0
+                async with self._space:
+                    self._space.notify_all()
+            if left:
+                return False
+        return True
+
+    async def run(self):
+        """Flusher loop, until stop is called."""
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._ready.clear()
+            await self.flush()
+
+    def start(self):
+        self._closed = False
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Refuse new rows, let the flusher finish its batch and write whatever is left."""
+        self._closed = True
+        async with self._space:
+            self._space.notify_all()
+        self._ready.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "table": self.table,
+            "capacity": self.capacity,
+            "pending": self.pending,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failures": self.failures,
+        }
+
+
+location_signal_buffer = SignalBuffer("location_signal", LOCATION_SIGNAL_COLUMNS)
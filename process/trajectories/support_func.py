@@ -3,6 +3,7 @@ import numpy as np
 import numba
 from numba import jit
 import math
+from datetime import datetime, time
 
 
 def jaccard_similarity(set0, set1):
@@ -29,10 +30,17 @@ def get_qk_line_test(loc0, loc1, level):
     line = smooth_line(tx0, ty0, tx1, ty1)
     return [(quadkey.from_str(tile_to_str(int(p[0]), int(p[1]), int(level))), p[2]) for p in line if p[2] > 0.0]
 
+# Latitude range of the Web Mercator projection the quadkeys are defined on
+MIN_LATITUDE = -85.05112878
+MAX_LATITUDE = 85.05112878
+
+
+@jit(nopython=True)
 def decimal_part(x):
     return x - int(x)
 
 
+@jit(nopython=True)
 def smooth_line(x0: int, y0: int, x1: int, y1: int):
     steep = (abs(y1 - y0) > abs(x1 - x0))
 
@@ -92,6 +100,104 @@ def smooth_line(x0: int, y0: int, x1: int, y1: int):
     return line
 
 
+@jit(nopython=True)
+def geo_to_tile(lat, lon, level):
+    """
+    Tile coordinates of a location at the level, the same tile as quadkey.from_geo((lat, lon), level).to_tile()
+    Code adapted from https://docs.microsoft.com/en-us/bingmaps/articles/bing-maps-tile-system
+    """
+    lat = min(max(lat, MIN_LATITUDE), MAX_LATITUDE)
+    lon = min(max(lon, -180.0), 180.0)
+    x = (lon + 180.0) / 360.0
+    sin_lat = math.sin(lat * math.pi / 180.0)
+    y = 0.5 - math.log((1.0 + sin_lat) / (1.0 - sin_lat)) / (4.0 * math.pi)
+    map_size = 256 << level
+    pixel_x = int(min(max(x * map_size + 0.5, 0.0), map_size - 1))
+    pixel_y = int(min(max(y * map_size + 0.5, 0.0), map_size - 1))
+    return pixel_x // 256, pixel_y // 256
+
+
+@jit(nopython=True)
+def line_size(lat0, lon0, lat1, lon1, level):
+    tx0, ty0 = geo_to_tile(lat0, lon0, level)
+    tx1, ty1 = geo_to_tile(lat1, lon1, level)
+    return 2 * (max(abs(tx1 - tx0), abs(ty1 - ty0)) + 1)
+
+
+@jit(nopython=True)
+def fill_qk_line(lat0, lon0, lat1, lon1, level, quadints, densities, start):
+    """
+    Write the cells of get_qk_line from position start of the output arrays, including the cells of density 0.
+    :return: the position after the last cell written
+    """
+    tx0, ty0 = geo_to_tile(lat0, lon0, level)
+    tx1, ty1 = geo_to_tile(lat1, lon1, level)
+    line = smooth_line(tx0, ty0, tx1, ty1)
+    for i in range(line.shape[0]):
+        quadints[start + i] = tile_to_qk(int(line[i, 0]), int(line[i, 1]), level)
+        densities[start + i] = line[i, 2]
+    return start + line.shape[0]
+
+
+@jit(nopython=True)
+def qk_line(lat0, lon0, lat1, lon1, level):
+    size = line_size(lat0, lon0, lat1, lon1, level)
+    quadints = np.empty(size, dtype=np.int64)
+    densities = np.empty(size, dtype=np.float64)
+    fill_qk_line(lat0, lon0, lat1, lon1, level, quadints, densities, 0)
+    keep = densities > 0.0
+    return quadints[keep], densities[keep]
+
+
+@jit(nopython=True)
+def qk_segments(lats0, lons0, lats1, lons1, level):
+    n = len(lats0)
+    sizes = np.zeros(n + 1, dtype=np.int64)
+    for i in range(n):
+        sizes[i + 1] = sizes[i] + line_size(lats0[i], lons0[i], lats1[i], lons1[i], level)
+
+    pairs = np.empty(sizes[-1], dtype=np.int64)
+    quadints = np.empty(sizes[-1], dtype=np.int64)
+    densities = np.empty(sizes[-1], dtype=np.float64)
+    for i in range(n):
+        fill_qk_line(lats0[i], lons0[i], lats1[i], lons1[i], level, quadints, densities, sizes[i])
+        pairs[sizes[i]:sizes[i + 1]] = i
+    keep = densities > 0.0
+    return pairs[keep], quadints[keep], densities[keep]
+
+
+def get_qk_line_np(loc0, loc1, level):
+    """
+    Compiled get_qk_line returning arrays instead of QuadKey objects.
+    :return: (quadints, densities) where the quadints are the key bits of the cells, the same value as
+             QuadKey.to_quadint() >> (64 - 2 * level), i.e. what link_qk stores at level 20
+    """
+    return qk_line(float(loc0[0]), float(loc0[1]), float(loc1[0]), float(loc1[1]), int(level))
+
+
+def get_qk_lines_np(locations, level):
+    """
+    get_qk_line_np for every pair of consecutive locations of a trajectory, in one compiled call.
+    :param locations: (latitude, longitude) rows
+    :return: (pairs, quadints, densities) where pairs is the index of the first location of the pair of each cell
+    """
+    locations = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+    return get_qk_segments_np(locations[:-1], locations[1:], level)
+
+
+def get_qk_segments_np(starts, ends, level):
+    """
+    get_qk_line_np for independent segments starts[i] -> ends[i], in one compiled call.
+    :param starts: (latitude, longitude) rows
+    :param ends: (latitude, longitude) rows
+    :return: (pairs, quadints, densities) where pairs is the index of the segment of each cell
+    """
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+    return qk_segments(np.ascontiguousarray(starts[:, 0]), np.ascontiguousarray(starts[:, 1]),
+                       np.ascontiguousarray(ends[:, 0]), np.ascontiguousarray(ends[:, 1]), int(level))
+
+
 def haversine_distance(coord1, coord2):
     """
     Calculate the great-circle distance between two points on the Earth. Convert the distance to metric units.
@@ -105,6 +211,65 @@ def haversine_distance(coord1, coord2):
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
     return R * c
 
+
+def haversine_distance_np(coord, lats, lons):
+    """
+    Vectorised haversine_distance from one point to arrays of latitudes and longitudes, in metres.
+    """
+    R = 6378137.0
+    lat1, lon1 = coord
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    dlat = np.radians(lats - lat1)
+    dlon = np.radians(lons - lon1)
+    a = np.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * np.cos(np.radians(lats)) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return R * c
+
+
+def point_segment_distance_np(coord, lats0, lons0, lats1, lons1):
+    """
+    Vectorised distance in metres from one point to arrays of segments (lats0, lons0) -> (lats1, lons1).
+    The segments are projected on a plane tangent at the point (equirectangular), which is accurate for the few
+    kilometres a pickup or drop-off detour is measured over.
+    :return: (distances, t) with t in [0, 1] the position of the closest point along each segment
+    """
+    R = 6378137.0
+    lat, lon = coord
+    scale_x = R * math.cos(math.radians(lat))
+    x0 = np.radians(np.asarray(lons0, dtype=np.float64) - lon) * scale_x
+    y0 = np.radians(np.asarray(lats0, dtype=np.float64) - lat) * R
+    x1 = np.radians(np.asarray(lons1, dtype=np.float64) - lon) * scale_x
+    y1 = np.radians(np.asarray(lats1, dtype=np.float64) - lat) * R
+
+    dx, dy = x1 - x0, y1 - y0
+    length_sq = dx * dx + dy * dy
+    # The point is the origin, so the projection of it on the segment is at -p0 . d / |d|^2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(length_sq > 0, -(x0 * dx + y0 * dy) / length_sq, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(x0 + t * dx, y0 + t * dy), t
+
+
+def time_to_microseconds(value):
+    """Microseconds since midnight of a time (or the time part of a datetime), as an exact integer."""
+    if isinstance(value, datetime):
+        value = value.time()
+    return ((value.hour * 60 + value.minute) * 60 + value.second) * 1_000_000 + value.microsecond
+
+
+def time_diff_seconds_np(ts_us, time_start):
+    """
+    Vectorised abs((datetime.combine(datetime.today(), t) - time_start).total_seconds()) for times given as
+    microseconds since midnight, the ts_us columns read along with the links.
+    A datetime time_start is taken relative to today's midnight, like the row-wise version.
+    """
+    if isinstance(time_start, time):
+        start_seconds = time_to_microseconds(time_start) / 1e6
+    else:
+        start_seconds = (time_start - datetime.combine(datetime.today(), time.min)).total_seconds()
+    return np.abs(np.asarray(ts_us, dtype=np.int64) / 1e6 - start_seconds)
+
 @jit(nopython=True)
 def tile_to_str(x, y, level):
     """
@@ -135,9 +300,11 @@ def tile_to_qk(x, y, level):
     :param x: Tile x coordinate
     :param y: Tile y coordinate
     :param level: Detail leve;
-    :return: QuadKey
+    :return: QuadKey as an integer, the key bits of QuadKey.to_quadint() >> (64 - 2 * level)
     """
-    q = numba.types.uint64(0)
+    # An int64 holds the 2 * level key bits for every level up to 31, and unlike a uint64 it can be shifted and added
+    # to the int64 masks without numba falling back to floats
+    q = 0
     for i in range(level, 0, -1):
         mask = 1 << (i - 1)
 
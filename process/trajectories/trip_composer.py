@@ -0,0 +1,60 @@
+from process.trajectories.gmapfunction import get_route_info
+from process.trajectories.directions_cache import directions_cache
+from process.trajectories.support_func import haversine_distance
+from fastapi.concurrency import run_in_threadpool
+from datetime import datetime, timedelta
+import asyncio
+
+
+# Used to guess when each leg leaves before the previous one is routed: straight-line distance times DETOUR_FACTOR
+# at ESTIMATE_SPEED metres per second (30 km/h)
+ESTIMATE_SPEED = 30 / 3.6
+DETOUR_FACTOR = 1.3
+
+
+def estimate_duration(start_location, end_location):
+    """Rough driving time in seconds between two (lat, lng) points, 0 when one of them is an address."""
+    if isinstance(start_location, str) or isinstance(end_location, str):
+        return 0
+    return haversine_distance(start_location, end_location) * DETOUR_FACTOR / ESTIMATE_SPEED
+
+
+def same_slot(departure, other):
+    """Whether two departures share their directions cache slot, and so get the same route."""
+    return directions_cache.time_bucket(departure) == directions_cache.time_bucket(other)
+
+
+async def route_leg(start_location, end_location, departure: datetime):
+    distance, duration, polyline = await run_in_threadpool(get_route_info, start_location, end_location, departure)
+    return start_location, end_location, departure, distance, duration, polyline
+
+
+async def compose_trip(stops, departure: datetime):
+    """
+    Route the legs between consecutive stops, each leaving when the previous one arrives.
+
+    Every leg is requested at once, leaving at a time estimated from the straight-line distances of the legs before
+    it. The legs are then chained with their actual durations; a leg whose actual departure falls in another slot of
+    the directions cache than its estimate is routed again. Every leg is thus routed for the slot it actually leaves
+    in, the granularity the directions cache serves routes at anyway, and a trip usually costs one routing call of
+    latency instead of one per leg.
+    :param stops: locations, (lat, lng) or addresses
+    :param departure: when the first leg leaves
+    :return: (list of (start_location, end_location, departure, distance, duration, polyline), arrival)
+    """
+    legs = list(zip(stops, stops[1:]))
+    estimates = [departure]
+    for start_location, end_location in legs[:-1]:
+        estimates.append(estimates[-1] + timedelta(seconds=estimate_duration(start_location, end_location)))
+
+    routed = await asyncio.gather(*[route_leg(start_location, end_location, estimate)
+                                    for (start_location, end_location), estimate in zip(legs, estimates)])
+
+    trip = []
+    current = departure
+    for (start_location, end_location), estimate, leg in zip(legs, estimates, routed):
+        if not same_slot(estimate, current):
+            leg = await route_leg(start_location, end_location, current)
+        trip.append((start_location, end_location, current) + leg[3:])
+        current += timedelta(seconds=leg[4])
+    return trip, current
@@ -0,0 +1,71 @@
+import math
+from datetime import datetime, time, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+from pyquadkey2 import quadkey
+from pyquadkey2.quadkey import TileAnchor
+
+from process.trajectories import corridor
+from process.trajectories.corridor import corridor_level, EARTH_CIRCUMFERENCE
+from process.trajectories.support_func import haversine_distance_np, time_to_microseconds
+
+
+def cell_width(location, level):
+    """Ground width in metres of the quadkey cell of the location, along its latitude."""
+    cell = quadkey.from_geo(location, level)
+    west = cell.to_geo(TileAnchor.ANCHOR_NW)[1]
+    east = cell.to_geo(TileAnchor.ANCHOR_NE)[1]
+    return (east - west) / 360 * EARTH_CIRCUMFERENCE * math.cos(math.radians(location[0]))
+
+
+@pytest.mark.parametrize("location", [(0.0, 0.0), (40.4168, -3.7038), (-33.87, 151.21), (60.17, 24.94),
+                                      (78.22, 15.65)])
+@pytest.mark.parametrize("radius", [5, 50, 200, 500, 1000, 5000, 50000])
+def test_corridor_level_cell_covers_radius(location, radius):
+    level = corridor_level(location, radius)
+    assert 1 <= level <= 20
+    if level < 20:
+        assert cell_width(location, level) >= radius
+        # The next level is already too small
+        assert cell_width(location, level + 1) < radius
+
+
+def test_corridor_level_clamped():
+    assert corridor_level((40.4168, -3.7038), 0.01) == 20
+    assert corridor_level((40.4168, -3.7038), EARTH_CIRCUMFERENCE) == 1
+
+
+def straight_trajectory(traj_id, start, end, departure, minutes, points=46):
+    """Segments of a driver going from start to end in a straight line, as CORRIDOR_SEGMENTS_SQL returns them."""
+    lats = np.linspace(start[0], end[0], points)
+    lons = np.linspace(start[1], end[1], points)
+    times = [departure + timedelta(minutes=minutes * i / (points - 1)) for i in range(points)]
+    return pd.DataFrame({
+        'traj_id': traj_id, 'user_id': traj_id, 'link_id': np.arange(points - 1),
+        'ini_lat': lats[:-1], 'ini_lon': lons[:-1], 'end_lat': lats[1:], 'end_lon': lons[1:],
+        'ts_ini': times[:-1], 'ts_end': times[1:],
+        'ts_ini_us': [time_to_microseconds(t) for t in times[:-1]],
+        'ts_end_us': [time_to_microseconds(t) for t in times[1:]],
+    })
+
+
+def test_corridor_matches_long_commute(monkeypatch):
+    start = (40.40, -3.70)
+    # About 40 minutes at DETOUR_SPEED on the road
+    end = (40.40 + 40 * 60 * corridor.DETOUR_SPEED / corridor.ROAD_FACTOR / 111_195, -3.70)
+    assert 35 * 60 < corridor.expected_ride_seconds(start, end) < 45 * 60
+    segments = straight_trajectory(7, start, end, datetime(2026, 1, 5, 8, 0), minutes=45)
+
+    def links_near(location, radius, min_ts_time, max_ts_time):
+        near = haversine_distance_np(location, segments['ini_lat'].to_numpy(), segments['ini_lon'].to_numpy())
+        times = segments['ts_ini'].map(lambda ts: ts.time())
+        return segments[(near <= 2 * radius) & (times >= min_ts_time) & (times <= max_ts_time)]
+
+    monkeypatch.setattr(corridor, 'links_near', links_near)
+    monkeypatch.setattr(corridor, 'load_segments', lambda traj_ids: segments[segments['traj_id'].isin(traj_ids)])
+
+    df = corridor.search_corridor_matches(start, end, time(8, 5), radius=500, time_diff=20)
+    assert df['traj_id'].tolist() == [7]
+    assert df['pickup_distance'].iloc[0] < 1 and df['dropoff_distance'].iloc[0] < 1
@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+
+from process.trajectories.polyline import encode_polyline, decode_polyline, encode_polylines, decode_polylines
+
+
+def reference_decode_polyline(polyline):
+    """The pure Python decoder gmapfunction had before the NumPy codec."""
+    points = []
+    index = lat = lng = 0
+
+    while index < len(polyline):
+        result = 1
+        shift = 0
+        while True:
+            b = ord(polyline[index]) - 63 - 1
+            index += 1
+            result += b << shift
+            shift += 5
+            if b < 0x1f:
+                break
+        lat += (~result >> 1) if (result & 1) != 0 else (result >> 1)
+
+        result = 1
+        shift = 0
+        while True:
+            b = ord(polyline[index]) - 63 - 1
+            index += 1
+            result += b << shift
+            shift += 5
+            if b < 0x1f:
+                break
+        lng += ~(result >> 1) if (result & 1) != 0 else (result >> 1)
+
+        points.append([lat * 1e-5, lng * 1e-5])
+
+    return points
+
+
+def reference_encode_polyline(points):
+    """The pure Python encoder gmapfunction had before the NumPy codec."""
+    result = []
+
+    prev_lat = 0
+    prev_lng = 0
+
+    for lat, lng in points:
+        lat = int(round(lat * 1e5))
+        lng = int(round(lng * 1e5))
+
+        d_lat = lat - prev_lat
+        d_lng = lng - prev_lng
+
+        prev_lat = lat
+        prev_lng = lng
+
+        for coord in [d_lat, d_lng]:
+            coord = ~(coord << 1) if coord < 0 else (coord << 1)
+
+            while coord >= 0x20:
+                result.append(chr((0x20 | (coord & 0x1f)) + 63))
+                coord >>= 5
+
+            result.append(chr(coord + 63))
+
+    return ''.join(result)
+
+
+def random_tracks(seed, count=200, max_points=50):
+    rng = np.random.default_rng(seed)
+    tracks = []
+    for _ in range(count):
+        size = int(rng.integers(0, max_points + 1))
+        if rng.random() < 0.5:
+            # A drive: small steps from a random start
+            start = [rng.uniform(-85, 85), rng.uniform(-180, 180)]
+            points = start + np.cumsum(rng.normal(0, 1e-3, (size, 2)), axis=0)
+        else:
+            points = np.column_stack([rng.uniform(-90, 90, size), rng.uniform(-180, 180, size)])
+        tracks.append([(float(lat), float(lng)) for lat, lng in points])
+    return tracks
+
+
+def tie_points():
+    """Coordinates exactly half way between two 1e-5 degree steps once scaled, both signs."""
+    values = [(k + 0.5) * 1e-5 for k in range(-2000, 2000)]
+    values = [value for value in values if (value * 1e5) % 1 == 0.5]
+    assert len(values) > 100
+    return [(lat, lng) for lat, lng in zip(values, reversed(values))]
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_encode_polyline_matches_reference(seed):
+    for points in random_tracks(seed):
+        assert encode_polyline(points) == reference_encode_polyline(points)
+        assert encode_polyline(np.array(points, dtype=np.float64).reshape(-1, 2)) == reference_encode_polyline(points)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_decode_polyline_matches_reference(seed):
+    for points in random_tracks(seed):
+        polyline = reference_encode_polyline(points)
+        assert decode_polyline(polyline) == reference_decode_polyline(polyline)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_batch_matches_reference(seed):
+    tracks = random_tracks(seed)
+    polylines = [reference_encode_polyline(points) for points in tracks]
+    assert encode_polylines(tracks) == polylines
+    decoded = decode_polylines(polylines)
+    assert len(decoded) == len(polylines)
+    for points, polyline in zip(decoded, polylines):
+        assert points.shape == (len(points), 2)
+        assert points.tolist() == reference_decode_polyline(polyline)
+
+
+def test_empty_and_single_point():
+    assert encode_polyline([]) == reference_encode_polyline([]) == ""
+    assert decode_polyline("") == reference_decode_polyline("") == []
+    assert encode_polylines([]) == []
+    assert decode_polylines([]) == []
+
+    point = [(38.5, -120.2)]
+    assert encode_polyline(point) == reference_encode_polyline(point) == "_p~iF~ps|U"
+    assert decode_polyline("_p~iF~ps|U") == reference_decode_polyline("_p~iF~ps|U")
+
+
+def test_rounding_ties():
+    points = tie_points()
+    assert encode_polyline(points) == reference_encode_polyline(points)
+    for point in points:
+        assert encode_polyline([point]) == reference_encode_polyline([point])
+        assert encode_polyline([(-point[0], -point[1])]) == reference_encode_polyline([(-point[0], -point[1])])
+    polyline = reference_encode_polyline(points)
+    assert decode_polyline(polyline) == reference_decode_polyline(polyline)
+
+
+def test_batch_with_empty_members():
+    tracks = [[], [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)], [], [(0.0, 0.0)], []]
+    polylines = encode_polylines(tracks)
+    assert polylines == [reference_encode_polyline(points) for points in tracks]
+    assert polylines[1] == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+
+    decoded = decode_polylines(polylines)
+    assert [len(points) for points in decoded] == [0, 3, 0, 1, 0]
+    assert [points.tolist() for points in decoded] == [reference_decode_polyline(polyline) for polyline in polylines]
+    assert decode_polylines(["", "", ""])[1].shape == (0, 2)